@@ -0,0 +1,114 @@
+# advice_prompt.py — AI アドバイス用プロンプトの組み立て（成績・不足単位・履修要件を1つの表にまとめる）
+import json
+import re
+
+try:
+    import tiktoken  # 任意。入っていればモデルと同じ数え方をする
+except ImportError:
+    tiktoken = None
+
+FOREIGN_PREFIX = "外国語必修内訳_"
+TOTAL_RE = re.compile(r"取得済み単位数:\s*(\d+)")
+GRADUATION_UNITS = 124
+
+_encoding = None
+
+
+def count_tokens(text):
+    """
+    入力トークン数。tiktoken があれば o200k_base（gpt-4o 系）で数え、
+    無ければ概算（日本語などの非 ASCII は1文字1トークン、ASCII は4文字1トークン）。
+    """
+    global _encoding
+    text = text or ""
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def count_message_tokens(messages):
+    """chat messages 全体（1メッセージあたりの区切り分 4 トークンを含む）"""
+    return sum(count_tokens(m.get("content")) + 4 for m in messages) + 2
+
+
+def merge_rows(grades_list, reqs):
+    """
+    成績（pdf_reader の区分ごとの取得/必要）と履修要件（curriculum_docs）を区分ごとに1行へまとめる。
+    必要単位は履修要件を優先する。外国語必修内訳は別に返す。
+    戻り値: (rows, foreign) いずれも [(category, earned, required)]
+    """
+    rows = {}
+    foreign = []
+    for g in grades_list or []:
+        cat = str(g.get("category") or "")
+        earned = g.get("earned") or 0
+        required = g.get("required") or 0
+        if cat.startswith(FOREIGN_PREFIX):
+            foreign.append((cat[len(FOREIGN_PREFIX):], earned, required))
+        elif cat:
+            rows[cat] = [earned, required]
+    for r in reqs or []:
+        cat = r.get("category")
+        if not cat:
+            continue
+        entry = rows.setdefault(cat, [0, 0])
+        if r.get("required_units") is not None:
+            entry[1] = r.get("required_units")
+    return [(cat, e, req) for cat, (e, req) in rows.items()], foreign
+
+
+def _fmt(cat, earned, required):
+    deficit = required - earned
+    return f"{cat} {earned}/{required}" + (f" 不足{deficit}" if deficit > 0 else "")
+
+
+def build_advice_content(grades_text, grades_list, reqs, max_tokens=600):
+    """
+    アドバイス用の user メッセージ本文を作る（成績レポート・不足単位チェック・JSON の3重送信をやめ、1表にする）。
+    max_tokens を超える場合は重要度の低い行（外国語内訳の充足分 → 充足済み区分 → 外国語内訳の不足 → 不足の小さい区分）から省く。
+    """
+    rows, foreign = merge_rows(grades_list, reqs)
+    unmet = sorted([r for r in rows if r[1] < r[2]], key=lambda r: r[1] - r[2])
+    met = [r for r in rows if r[1] >= r[2]]
+
+    head = []
+    m = TOTAL_RE.search(grades_text or "")
+    if m:
+        head.append(f"総取得 {m.group(1)}/{GRADUATION_UNITS}単位")
+    head.append("区分 取得/必要 不足（不足の大きい順）")
+
+    # (重要度, 行) 重要度が小さいものから省く
+    body = []
+    for i, r in enumerate(unmet):
+        body.append((100 - i, _fmt(*r)))
+    for r in foreign:
+        body.append((50 if r[1] < r[2] else 10, "外国語内訳 " + _fmt(*r)))
+    if met:
+        body.append((20, "充足: " + "、".join(_fmt(*r) for r in met)))
+    if not unmet:
+        body.append((100, "未充足の区分なし"))
+
+    def render(items, omitted):
+        lines = head + [line for _, line in items]
+        if omitted:
+            lines.append(f"（他 {omitted} 行省略）")
+        return "\n".join(lines)
+
+    kept = list(body)
+    content = render(kept, 0)
+    while kept and count_tokens(content) > max_tokens:
+        kept.remove(min(kept, key=lambda x: x[0]))
+        content = render(kept, len(body) - len(kept))
+    return content
+
+
+def build_legacy_content(grades_text, shortage_report, grades_list):
+    """従来のプロンプト本文（比較用）"""
+    return (
+        f"成績レポート:\n{grades_text}\n\n"
+        f"不足単位チェック:\n{shortage_report}\n\n"
+        f"構造化データ:\n{json.dumps(grades_list, ensure_ascii=False)}"
+    )
@@ -0,0 +1,11 @@
+-- advice_results.sql — AI アドバイスの保存先（成績・履修要件・プロンプト版のハッシュで再利用を判定）
+-- Supabase の SQL Editor で一度実行する。
+
+create table if not exists advice_results (
+    user_id         text primary key,
+    fingerprint     text not null,  -- sha256(成績データ + 履修要件 + プロンプト版 + モデル)
+    prompt_version  text not null,
+    advice          text not null,
+    shortage_report text,           -- 不足単位チェック結果（/advice_precompute で作ったものをそのまま返すため）
+    created_at      timestamptz not null default now()
+);
@@ -1,10 +1,16 @@
 # app.py — 修正版（検証済み）
 import os
-import sys
+import re
 import json
+import hashlib
+import atexit
+import time
 import tempfile
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, abort, jsonify
+from linebot import LineBotApi, WebhookParser
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, FileMessage,
@@ -14,12 +20,29 @@ from linebot.models import PostbackEvent
 from supabase import create_client, Client
 from openai import OpenAI
 import pdf_reader  # あなたが提供している pdf_reader.py を使う想定
+import webhook_worker
+import dedup_cache
+import write_buffer
+import timetable_index
+import calendar_cache
+import syllabus_index
+import reference_data
+import lru_cache
+import response_cache
+import last_seen
+import intent_router
+import job_store
+import state_store
+import deadline_runner
+import llm_limiter
+import advice_prompt
+import refresh_stamp
+from log_util import debug_log
 from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
-from linebot.models import TemplateSendMessage, ButtonsTemplate, PostbackAction
+from linebot.models import TemplateSendMessage, ButtonsTemplate, PostbackAction, ImageSendMessage
 
-# SPI分析用セッション管理
-spi_sessions = {}
+# SPI分析用セッションは flow_states の "spi" フロー（STATE_BACKEND 参照）
 
 # 質問フロー定義
 QUESTIONS = [
@@ -39,6 +62,87 @@ QUESTIONS = [
 
 JST = ZoneInfo("Asia/Tokyo")
 NOTIFY_SECRET = os.getenv("NOTIFY_SECRET", None)
+# Webhook の非同期処理（1 で有効: 署名検証後すぐ 200 を返し、ワーカーで処理）
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+# 再送 Webhook の重複排除（memory / sqlite / off）。複数ワーカーで共有するなら sqlite
+WEBHOOK_DEDUP_BACKEND = os.getenv("WEBHOOK_DEDUP_BACKEND", "memory")
+WEBHOOK_DEDUP_PATH = os.getenv("WEBHOOK_DEDUP_PATH", os.path.join(tempfile.gettempdir(), "webhook_dedup.sqlite3"))
+WEBHOOK_DEDUP_TTL = int(os.getenv("WEBHOOK_DEDUP_TTL", 3600))
+# 会話フロー（登録途中の状態）の保存先（memory / sqlite）。複数ワーカーで共有するなら sqlite
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_PATH = os.getenv("STATE_PATH", os.path.join(tempfile.gettempdir(), "flow_states.sqlite3"))
+STATE_TTL = int(os.getenv("STATE_TTL", 1800))
+# 一斉配信（multicast は1リクエスト最大500人）
+MULTICAST_CHUNK_SIZE = 500
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", 4))
+# PostgREST のページサイズ（既定の行数上限 1000 以下にする）と in フィルタ1回あたりの件数（URL 長対策）
+SUPABASE_PAGE_SIZE = 1000
+SUPABASE_IN_CHUNK = 150
+# 時間割インデックスの再読込間隔（秒）。他ワーカーでの授業登録はこの間隔で取り込まれる
+TIMETABLE_TTL = int(os.getenv("TIMETABLE_TTL", 300))
+# 学事カレンダーのキャッシュ有効期間（秒）。更新時は /calendar_refresh で全ワーカーに反映
+CALENDAR_TTL = int(os.getenv("CALENDAR_TTL", 6 * 3600))
+# シラバス索引の再構築間隔（秒）。再インポート後は /syllabus_refresh で全ワーカーに反映
+SYLLABUS_INDEX_TTL = int(os.getenv("SYLLABUS_INDEX_TTL", 24 * 3600))
+# 参照テーブル（curriculum_docs / inquiry_contacts）のスナップショット有効期間（秒）
+REFERENCE_MAX_AGE = int(os.getenv("REFERENCE_MAX_AGE", 24 * 3600))
+# *_refresh で書き換える版数ファイルの置き場所（同じホストの全ワーカーがこれを見て作り直す）と確認間隔（秒）
+REFRESH_STAMP_DIR = os.getenv("REFRESH_STAMP_DIR", tempfile.gettempdir())
+REFRESH_STAMP_INTERVAL = float(os.getenv("REFRESH_STAMP_INTERVAL", 1))
+# ユーザーごとのプロフィール・成績キャッシュ（件数上限と TTL。TTL は他ワーカーでの更新を取り込むまでの最大遅延）
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 2000))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 120))
+# 雑談応答の SQLite キャッシュ（0 で無効）。ファイルは再起動後も残り、ワーカー間で共有される
+CHAT_CACHE = os.getenv("CHAT_CACHE", "1") == "1"
+CHAT_CACHE_PATH = os.getenv("CHAT_CACHE_PATH", os.path.join(tempfile.gettempdir(), "chat_cache.sqlite3"))
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", 7 * 24 * 3600))
+CHAT_CACHE_MAX = int(os.getenv("CHAT_CACHE_MAX", 5000))
+CHAT_MODEL = "gpt-4o-mini"
+CHAT_SYSTEM_PROMPT = "あなたは明治大学の学生をサポートするアシスタントです。"
+# OpenAI 応答の待ち時間上限（秒）。超えたら「生成中」を reply し、完成後に push で届ける
+OPENAI_REPLY_BUDGET = float(os.getenv("OPENAI_REPLY_BUDGET", 8))
+OPENAI_DEADLINE_WORKERS = int(os.getenv("OPENAI_DEADLINE_WORKERS", 8))
+# 上の実行スレッドが埋まっているときに待たせてよい件数（超えたら「混雑中」）
+OPENAI_DEADLINE_QUEUE = int(os.getenv("OPENAI_DEADLINE_QUEUE", 8))
+# OpenAI 呼び出し1回の打ち切り時間（秒）とストリーミング（0 で従来の一括応答）
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 60))
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "1") == "1"
+GENERATING_MESSAGE = "⏳ 回答を生成しています…。完成したらお送りします。"
+# OpenAI の流量制限（回/秒・バースト・同時実行数・待ち行列の深さ・最大待ち秒）と SDK 側の再試行回数
+OPENAI_RATE = float(os.getenv("OPENAI_RATE", 5))
+OPENAI_BURST = int(os.getenv("OPENAI_BURST", 10))
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", 8))
+OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE", 50))
+OPENAI_MAX_WAIT = float(os.getenv("OPENAI_MAX_WAIT", 5))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 1))
+BUSY_MESSAGE = "🙏 ただいま混み合っています。少し時間をおいてからもう一度お試しください。"
+# アドバイス生成のプロンプト版（プロンプトを変えたら上げる。保存済みアドバイスが作り直される）
+ADVICE_PROMPT_VERSION = "v2"
+ADVICE_MODEL = "gpt-4o-mini"
+ADVICE_SYSTEM_PROMPT = (
+    "あなたは明治大学の学生をサポートするアシスタントです。"
+    "以下に与える成績状況と不足単位チェック結果を参考に、"
+    "卒業要件の達成状況、優先して履修すべき科目、履修順序や注意点を具体的に助言してください。"
+    "アドバイスは簡潔かつ要点を押さえてください。"
+)
+# アドバイス用 user メッセージのトークン上限（超えたら重要度の低い行から省く）
+ADVICE_PROMPT_TOKENS = int(os.getenv("ADVICE_PROMPT_TOKENS", 600))
+# /advice_precompute（夜間バッチ）の同時生成数と1回あたりの上限人数
+ADVICE_PRECOMPUTE_CONCURRENCY = int(os.getenv("ADVICE_PRECOMPUTE_CONCURRENCY", 4))
+ADVICE_PRECOMPUTE_LIMIT = int(os.getenv("ADVICE_PRECOMPUTE_LIMIT", 5000))
+# /advice_precompute のジョブ状態（全ワーカーで共有）と、更新が途絶えた実行中ジョブを打ち切りとみなすまでの秒数
+ADVICE_JOBS_PATH = os.getenv("ADVICE_JOBS_PATH", os.path.join(tempfile.gettempdir(), "advice_jobs.sqlite3"))
+ADVICE_JOB_STALE_AFTER = int(os.getenv("ADVICE_JOB_STALE_AFTER", 1800))
+# 起動時に各キャッシュを読み込んでおく（0 なら初回参照時）
+PRELOAD_CACHES = os.getenv("PRELOAD_CACHES", "1") == "1"
+# last_seen の一括書き込み間隔（秒）
+LAST_SEEN_FLUSH_INTERVAL = float(os.getenv("LAST_SEEN_FLUSH_INTERVAL", 30))
+# Supabase 書き込みの write-behind（last_seen・通知ログなど。0 で従来どおり同期書き込み）。出欠・課題の登録は常に同期
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", 200))
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", 1.0))
 # 明治大学 共通時間割（開始・終了時刻）
 PERIOD_TIMES = {
     1: {"start": "09:00", "end": "10:40"},
@@ -48,6 +152,9 @@ PERIOD_TIMES = {
     5: {"start": "17:10", "end": "18:50"},
     6: {"start": "19:00", "end": "20:40"},
 }
+# 終了時刻 "HH:MM" → 時限（/class_notify で毎分引く）
+PERIOD_BY_END = {times["end"]: period for period, times in PERIOD_TIMES.items()}
+WEEKDAYS_JA = ["月", "火", "水", "木", "金", "土", "日"]
 
 
 
@@ -64,16 +171,35 @@ if not all([LINE_CHANNEL_SECRET, LINE_CHANNEL_ACCESS_TOKEN, SUPABASE_URL, SUPABA
     raise ValueError("環境変数が不足しています。LINE_CHANNEL_SECRET, LINE_CHANNEL_ACCESS_TOKEN, SUPABASE_URL, SUPABASE_KEY, OPENAI_API_KEY を確認してください")
 
 line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+parser = WebhookParser(LINE_CHANNEL_SECRET)
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=OPENAI_MAX_RETRIES)
 
 
-# ---- ヘルパー関数 ----
-def debug_log(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
+def _execute_bulk(table, op, rows):
+    q = supabase.table(table)
+    if op == "upsert":
+        q.upsert(rows).execute()
+    else:
+        q.insert(rows).execute()
+
+
+writes = write_buffer.WriteBehindBuffer(
+    _execute_bulk,
+    max_batch=WRITE_BEHIND_BATCH,
+    flush_interval=WRITE_BEHIND_INTERVAL,
+    enabled=WRITE_BEHIND,
+)
 
+# last_seen は畳み込んでから write-behind バッファへ（終了時は先に畳み込み分を流す）
+seen_tracker = last_seen.LastSeenTracker(
+    lambda rows: writes.add_many("subscribers", rows, op="upsert", key="user_id"),
+    interval=LAST_SEEN_FLUSH_INTERVAL,
+)
+atexit.register(writes.shutdown)
+atexit.register(seen_tracker.flush)
 
+# ---- ヘルパー関数 ----
 def safe_reply(reply_token, text):
     try:
         line_bot_api.reply_message(reply_token, TextSendMessage(text=text))
@@ -82,6 +208,100 @@ def safe_reply(reply_token, text):
     except Exception as e:
         debug_log("Unexpected error replying:", e)
 
+def chunked(seq, size):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _send_multicast_chunk(user_ids, messages, on_chunk=None):
+    start = time.perf_counter()
+    error = None
+    try:
+        line_bot_api.multicast(user_ids, messages)
+    except Exception as e:
+        debug_log("multicast error:", e)
+        error = str(e)
+    result = {
+        "size": len(user_ids),
+        "ok": error is None,
+        "error": error,
+        "ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+    if on_chunk:
+        try:
+            on_chunk(user_ids, result)
+        except Exception as e:
+            debug_log("multicast on_chunk error:", e)
+    return result
+
+
+def multicast_batches(jobs, on_chunk=None):
+    """
+    jobs: [(user_ids, messages), ...]。それぞれを 500 人ずつの multicast に分け、
+    すべてのチャンクを1つのプールで並列送信する。
+    on_chunk(chunk_user_ids, result) は各チャンクの送信後に呼ばれる（ログ書き込み等）。
+    チャンクごとの結果（人数・成否・所要ms）のリストを返す。
+    """
+    tasks = [(c, messages) for user_ids, messages in jobs for c in chunked(user_ids, MULTICAST_CHUNK_SIZE)]
+    if not tasks:
+        return []
+    with ThreadPoolExecutor(max_workers=min(NOTIFY_CONCURRENCY, len(tasks))) as ex:
+        futures = [ex.submit(_send_multicast_chunk, c, messages, on_chunk) for c, messages in tasks]
+        return [f.result() for f in futures]
+
+
+def multicast_in_chunks(user_ids, messages, on_chunk=None):
+    """同じメッセージを 500 人ずつの multicast に分けて並列送信する"""
+    return multicast_batches([(user_ids, messages)], on_chunk=on_chunk)
+
+
+def push_many(messages_by_user):
+    """
+    {user_id: [messages]} を並列に push_message する（NOTIFY_CONCURRENCY 並列）。
+    (成功数, 失敗数) を返す。
+    """
+    def _push(item):
+        uid, messages = item
+        try:
+            line_bot_api.push_message(uid, messages)
+            return True
+        except Exception as e:
+            debug_log(f"push error to {uid}:", e)
+            return False
+
+    items = list(messages_by_user.items())
+    if not items:
+        return 0, 0
+    with ThreadPoolExecutor(max_workers=min(NOTIFY_CONCURRENCY, len(items))) as ex:
+        results = list(ex.map(_push, items))
+    sent = sum(1 for ok in results if ok)
+    return sent, len(results) - sent
+
+
+def iter_pages(build_query, page_size=SUPABASE_PAGE_SIZE):
+    """
+    build_query() が返すクエリ（order 指定済み）を range でページングし、1ページずつ返す。
+    PostgREST の行数上限で結果が黙って切り詰められるのを防ぐ。
+    order は一意になるように（主キーか最後に id を）指定すること。同じ値の行があるとページ境界で読み飛ばし・二重読みが起きる。
+    """
+    offset = 0
+    while True:
+        res = build_query().range(offset, offset + page_size - 1).execute()
+        page = res.data if getattr(res, "data", None) else []
+        yield page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def fetch_all_pages(build_query, page_size=SUPABASE_PAGE_SIZE):
+    rows = []
+    for page in iter_pages(build_query, page_size):
+        rows.extend(page)
+    return rows
+
+
 def get_attendance_risk_report(user_id):
     """
     ユーザーの全授業について危険度を評価し、危険順に並べて返す
@@ -97,21 +317,24 @@ def get_attendance_risk_report(user_id):
         if not classes:
             return "❌ 授業が登録されていません。まずは授業登録してください。"
 
+        # 集計テーブル（attendance_counters.sql）から一括取得
+        classes = list(dict.fromkeys(classes))  # 曜日違いで同じ授業が複数行ある場合
+        res = supabase.table("attendance_counters") \
+            .select("subject, late, absent, score") \
+            .eq("user_id", user_id) \
+            .in_("subject", classes) \
+            .execute()
+        counters = {r["subject"]: r for r in res.data} if res and res.data else {}
+
         report = []
 
         for subject in classes:
-            res = supabase.table("attendance") \
-                .select("status") \
-                .eq("user_id", user_id) \
-                .eq("subject", subject) \
-                .execute()
-            records = res.data if res and res.data else []
-
-            absents = sum(1 for r in records if r["status"] == "absent")
-            lates = sum(1 for r in records if r["status"] == "late")
-
-            # 危険度スコアをつける（数値化するとランキング可能）
-            score = absents * 2 + lates  # 欠席を重くカウント
+            c = counters.get(subject, {})
+            absents = c.get("absent", 0)
+            lates = c.get("late", 0)
+
+            # 危険度スコア（欠席を重くカウント: absent * 2 + late）
+            score = c.get("score", absents * 2 + lates)
             if score >= 3:
                 level = "🚨 危険"
             elif score >= 2:
@@ -141,8 +364,9 @@ def get_attendance_risk_report(user_id):
         return f"⚠️ 出席状況の集計でエラーが発生しました: {e}"
 
 
-def send_attendance_request(user_id, subject):
-    message = TemplateSendMessage(
+def build_attendance_request(subject):
+    """出欠ボタン（同じ授業の学生には同一内容なので multicast で使い回せる）"""
+    return TemplateSendMessage(
         alt_text=f"{subject} の出欠を記録してください",
         template=ButtonsTemplate(
             title=f"{subject} 出欠確認",
@@ -154,12 +378,14 @@ def send_attendance_request(user_id, subject):
             ]
         )
     )
-    line_bot_api.push_message(user_id, message)
+
 
 def save_attendance(user_id, subject, status):
     """
     出欠データを Supabase に保存する
     status: present / late / absent
+    attendance_counters は DB トリガーで同じトランザクション内に加算される
+    ユーザーに「記録しました」と返すので、write-behind には載せず同期で書く
     """
     try:
         supabase.table("attendance").insert({
@@ -176,12 +402,69 @@ def save_attendance(user_id, subject, status):
 
 
 
-def call_openai_chat(messages, model="gpt-4o-mini"):
+# OpenAI の待ち時間上限と TTFT の記録
+llm_deadline = deadline_runner.DeadlineRunner(
+    budget=OPENAI_REPLY_BUDGET, workers=OPENAI_DEADLINE_WORKERS, max_pending=OPENAI_DEADLINE_QUEUE
+)
+
+
+def _call_openai_stream(messages, model):
+    """ストリーミングで受け取り、連結した本文を返す（最初のトークンまでの時間を記録）"""
+    start = time.perf_counter()
+    stream = client.chat.completions.create(model=model, messages=messages, stream=True, timeout=OPENAI_TIMEOUT)
+    parts = []
+    first = True
+    for chunk in stream:
+        choices = getattr(chunk, "choices", None)
+        if not choices:
+            continue
+        delta = getattr(choices[0], "delta", None)
+        text = getattr(delta, "content", None)
+        if text:
+            if first:
+                llm_deadline.record_ttft(time.perf_counter() - start)
+                first = False
+            parts.append(text)
+    return "".join(parts) if parts else None
+
+
+# OpenAI 呼び出しの流量制限（アドバイスを雑談より先に通す）
+openai_limiter = llm_limiter.PriorityLimiter(
+    rate=OPENAI_RATE,
+    burst=OPENAI_BURST,
+    max_in_flight=OPENAI_MAX_IN_FLIGHT,
+    max_queue=OPENAI_MAX_QUEUE,
+    max_wait=OPENAI_MAX_WAIT,
+)
+# reply_within_budget が受付時に取った枠（このスレッドの最初の OpenAI 呼び出しで使う）
+_admitted = threading.local()
+
+
+def call_openai_chat(messages, model="gpt-4o-mini", priority=llm_limiter.PRIORITY_CHAT):
+    """
+    OpenAI 呼び出し（openai_limiter の枠を取ってから）。
+    混雑で枠が取れなければ llm_limiter.Busy を投げる。
+    """
+    if getattr(_admitted, "held", False):
+        # 枠は受付済み（解放は reply_within_budget のタスク側）
+        _admitted.held = False
+        return _call_openai(messages, model)
+    with openai_limiter.slot(priority):
+        return _call_openai(messages, model)
+
+
+def _call_openai(messages, model):
     """
     OpenAI 呼び出し。戻り値の構造差に頑強に対応して文字列を返す（失敗時 None）。
     """
+    if OPENAI_STREAM:
+        try:
+            return _call_openai_stream(messages, model)
+        except Exception as e:
+            debug_log("OpenAI stream error:", e)
+            return None
     try:
-        resp = client.chat.completions.create(model=model, messages=messages)
+        resp = client.chat.completions.create(model=model, messages=messages, timeout=OPENAI_TIMEOUT)
         # 互換的取り出し
         try:
             choice = resp.choices[0]
@@ -211,38 +494,127 @@ def call_openai_chat(messages, model="gpt-4o-mini"):
         return None
 
 
+chat_cache = response_cache.ResponseCache(CHAT_CACHE_PATH, ttl=CHAT_CACHE_TTL, max_entries=CHAT_CACHE_MAX) if CHAT_CACHE else None
+
+
+def lookup_chat_cache(user_text, system_prompt=CHAT_SYSTEM_PROMPT, model=CHAT_MODEL):
+    """キャッシュ済みの雑談応答（無ければ None）"""
+    if not chat_cache:
+        return None
+    try:
+        return chat_cache.get(model, system_prompt, user_text)
+    except Exception as e:
+        debug_log("chat cache read error:", e)
+        return None
+
+
+def call_openai_chat_cached(user_text, system_prompt=CHAT_SYSTEM_PROMPT, model=CHAT_MODEL, skip_lookup=False):
+    """
+    雑談用。同じ質問（正規化後）への応答は SQLite キャッシュから返す。
+    個人情報を含みそうな入力はキャッシュを使わない。
+    呼び出し側で lookup_chat_cache 済みなら skip_lookup=True（ミスを二重に数えないように）。
+    """
+    if not skip_lookup:
+        cached = lookup_chat_cache(user_text, system_prompt, model)
+        if cached is not None:
+            return cached
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_text}
+    ]
+    ai_text = call_openai_chat(messages, model=model)
+    if chat_cache and ai_text is not None:
+        try:
+            chat_cache.put(model, system_prompt, user_text, ai_text)
+        except Exception as e:
+            debug_log("chat cache write error:", e)
+    return ai_text
+
+
+# プロフィールと最新成績のキャッシュ（PDF アップロード / プロフィール保存時に無効化）
+user_cache = lru_cache.LRUCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def _load_saved_grades(user_id):
+    res = supabase.table("grades_text").select("*").eq("user_id", user_id).order("created_at", desc=True).limit(1).execute()
+    if res and getattr(res, "data", None):
+        return _decode_grades_row(res.data[0])
+    return None, None
+
+
+def _decode_grades_row(row):
+    """grades_text の1行を (content, raw_data) にする"""
+    content = row.get("content")
+    raw = row.get("raw_data")
+    # content が JSON 文字列になっている古いケースに対応
+    if isinstance(content, str):
+        s = content.strip()
+        if (s.startswith("[") and s.endswith("]")) or (s.startswith("{") and s.endswith("}")):
+            try:
+                parsed = json.loads(content)
+                if raw is None:
+                    raw = parsed
+            except Exception:
+                pass
+    return content, raw
+
+
 def fetch_saved_grades(user_id):
     """
-    Supabase から最新の成績レコードを取得して (content, raw_data) を返す。
+    最新の成績レコードを (content, raw_data) で返す（デコード済みの結果をキャッシュ）。
     見つからなければ (None, None)
     """
     try:
-        res = supabase.table("grades_text").select("*").eq("user_id", user_id).order("created_at", desc=True).limit(1).execute()
-        if res and getattr(res, "data", None):
-            row = res.data[0]
-            content = row.get("content")
-            raw = row.get("raw_data")
-            # content が JSON 文字列になっている古いケースに対応
-            if isinstance(content, str):
-                s = content.strip()
-                if (s.startswith("[") and s.endswith("]")) or (s.startswith("{") and s.endswith("}")):
-                    try:
-                        parsed = json.loads(content)
-                        if raw is None:
-                            raw = parsed
-                    except Exception:
-                        pass
-            return content, raw
+        return user_cache.get_or_load(("grades", user_id), lambda: _load_saved_grades(user_id))
     except Exception as e:
         debug_log("Supabase fetch error:", e)
     return None, None
 
+
+def fetch_profile(user_id):
+    """users テーブルのプロフィール（無ければ None）。キャッシュ付き"""
+    def _load():
+        res = supabase.table("users").select("*").eq("line_user_id", user_id).execute()
+        return res.data[0] if res and res.data else None
+    return user_cache.get_or_load(("profile", user_id), _load)
+
+# メモリ上の索引・キャッシュの版数（*_refresh で進めると全ワーカーが作り直す）
+refresh_stamps = {
+    name: refresh_stamp.RefreshStamp(
+        os.path.join(REFRESH_STAMP_DIR, f"line_bot_{name}.stamp"), check_interval=REFRESH_STAMP_INTERVAL
+    )
+    for name in ("syllabus", "calendar", "reference", "timetable")
+}
+
 # === シラバス検索機能 ===
+def load_syllabus():
+    return fetch_all_pages(
+        lambda: supabase.table("syllabus").select("*")
+        .order("subject_teacher", desc=False)
+        .order("semester", desc=False)
+        .order("campus", desc=False)
+        .order("grade_year", desc=False)
+        .order("id", desc=False)
+    )
+
+
+syllabus = syllabus_index.SyllabusIndex(load_syllabus, ttl=SYLLABUS_INDEX_TTL, version=refresh_stamps["syllabus"].version)
+
+
 def search_syllabus_by_name(keyword: str):
     """
-    Supabase の syllabus テーブルから授業名 or 教員名を検索する。
-    subject_teacher カラムに両方入っている前提。
+    syllabus テーブルの n-gram 索引から授業名 or 教員名を検索し、順位付きで返す（完全一致は全件、それ以外は合わせて5件まで）。
+    subject_teacher カラムに両方入っている前提。索引が使えない場合は DB を直接検索する。
     """
+    try:
+        return syllabus.search(keyword, k=5)
+    except Exception as e:
+        debug_log("syllabus index error:", e)
+        return search_syllabus_by_name_db(keyword)
+
+
+def search_syllabus_by_name_db(keyword: str):
+    """PostgREST で直接検索する（完全一致 → 部分一致）"""
     try:
         # 完全一致
         res = supabase.table("syllabus").select("*").eq("subject_teacher", keyword).execute()
@@ -312,24 +684,46 @@ def normalize_text(s: str) -> str:
         return ""
     return s.strip().lower()
 
-def upsert_subscriber(user_id, opt_in=False):
-    payload = {"user_id": user_id, "opt_in": opt_in, "last_seen": datetime.now(tz=JST).isoformat()}
-    supabase.table("subscribers").upsert(payload).execute()
+def upsert_subscriber(user_id):
+    """
+    最終アクセスを記録する（初回は行が作られ、opt_in は DB の既定値のまま）。
+    書き込みは LAST_SEEN_FLUSH_INTERVAL 秒ごとにまとめて行う。opt_in の変更は set_subscription で。
+    """
+    seen_tracker.record(user_id, datetime.now(tz=JST).isoformat())
 
 def set_subscription(user_id, opt_in: bool):
-    supabase.table("subscribers").upsert({"user_id": user_id, "opt_in": opt_in, "last_seen": datetime.now(tz=JST).isoformat()}).execute()
-    return True
+    # opt_in だけを書く（last_seen は upsert_subscriber 側でまとめて書く）。結果を返信するので同期で書く
+    try:
+        supabase.table("subscribers").upsert({"user_id": user_id, "opt_in": opt_in}).execute()
+        return True
+    except Exception as e:
+        debug_log("set_subscription error:", e)
+        return False
 
 def get_subscribed_user_ids():
-    res = supabase.table("subscribers").select("user_id").eq("opt_in", True).execute()
-    return [r['user_id'] for r in res.data] if getattr(res, "data", None) else []
+    rows = fetch_all_pages(
+        lambda: supabase.table("subscribers").select("user_id").eq("opt_in", True).order("user_id", desc=False)
+    )
+    return [r['user_id'] for r in rows]
+
+def load_academic_calendar():
+    return fetch_all_pages(
+        lambda: supabase.table("academic_calendar").select("*").order("date", desc=False).order("id", desc=False)
+    )
+
+
+academic_calendar = calendar_cache.CalendarCache(
+    load_academic_calendar, ttl=CALENDAR_TTL, version=refresh_stamps["calendar"].version
+)
+
 
 def fetch_events_between(start_date: date, end_date: date):
-    res = supabase.table("academic_calendar").select("*") \
-        .gte("date", start_date.isoformat()) \
-        .lte("date", end_date.isoformat()) \
-        .order("date", desc=False).execute()
-    return res.data if getattr(res, "data", None) else []
+    """メモリ上の学事カレンダーから期間内の予定を返す（DB へは TTL ごとに1回だけ）"""
+    try:
+        return academic_calendar.between(start_date, end_date)
+    except Exception as e:
+        debug_log("fetch_events_between error:", e)
+        return []
 
 def format_events_human(events):
     if not events:
@@ -364,15 +758,31 @@ def format_events_human(events):
         lines.append(f"- {d} {t} {title} [{cat}]\n  {note}")
     return "\n".join(lines)
 
+reference = reference_data.ReferenceSnapshot(
+    {
+        "curriculum_docs": lambda: fetch_all_pages(
+            lambda: supabase.table("curriculum_docs")
+            .select("faculty, department, category_group, category, required_units")
+            .order("faculty", desc=False)
+            .order("department", desc=False)
+            .order("category_group", desc=False)
+            .order("category", desc=False)
+            .order("id", desc=False)
+        ),
+        "inquiry_contacts": lambda: fetch_all_pages(
+            lambda: supabase.table("inquiry_contacts").select("*").order("department", desc=False).order("id", desc=False)
+        ),
+    },
+    max_age=REFERENCE_MAX_AGE,
+    dept_keywords=intent_router.DEPT_KEYWORDS.keys(),
+    shared_version=refresh_stamps["reference"].version,
+)
+
+
 def fetch_curriculum_docs(faculty: str, department: str):
+    """履修要件（参照スナップショットから。DB へは読み込み時のみ）"""
     try:
-        res = supabase.table("curriculum_docs") \
-            .select("category_group, category, required_units") \
-            .eq("faculty", faculty) \
-            .eq("department", department) \
-            .order("category_group", desc=False) \
-            .execute()
-        return res.data if getattr(res, "data", None) else []
+        return reference.curriculum(faculty, department)
     except Exception as e:
         debug_log("fetch_curriculum_docs error:", e)
         return []
@@ -382,45 +792,298 @@ def compare_grades_with_requirements(user_id):
     ユーザーの成績と必修条件を比較して不足単位を算出する。
     """
     try:
-        # 1. プロフィール取得
-        res_user = supabase.table("users").select("*").eq("line_user_id", user_id).execute()
-        if not res_user.data:
-            return "❌ まずプロフィールを登録してください。"
-        profile = res_user.data[0]
-        faculty = profile.get("faculty")
-        department = profile.get("department", "経営学科")  # デフォルト値
-
-        # 2. カリキュラム要件取得
-        reqs = fetch_curriculum_docs(faculty, department)
-        if not reqs:
-            return f"❌ {faculty} {department} の履修要件が見つかりません。"
-
-        # 3. 成績データ取得
+        profile = fetch_profile(user_id)
+        reqs = fetch_requirements_for_profile(profile) if profile else []
         grades_text, grades_list = fetch_saved_grades(user_id)
-        if not grades_list:
-            return "❌ 成績データが見つかりません。まずPDFをアップロードしてください。"
-
-        # 4. 突き合わせ
-        earned_by_cat = {g.get("category"): g.get("earned", 0) for g in grades_list}
-        lines = ["📊 不足単位チェック結果"]
-
-        for r in reqs:
-            cat = r.get("category")
-            required = r.get("required_units", 0)
-            earned = earned_by_cat.get(cat, 0)
-            deficit = required - earned
-            if deficit > 0:
-                lines.append(f"- {cat}: あと {deficit} 単位必要（{earned}/{required}）")
-            else:
-                lines.append(f"- {cat}: ✅ クリア（{earned}/{required}）")
-
-        return "\n".join(lines)
+        return build_shortage_report(profile, reqs, grades_list)
 
     except Exception as e:
         debug_log("compare_grades_with_requirements error:", e)
         return "❌ 不足単位チェック中にエラーが発生しました。"
 
 
+def build_shortage_report(profile, reqs, grades_list):
+    """プロフィール・カリキュラム要件・成績から不足単位チェック結果の文面を作る"""
+    # 1. プロフィール
+    if not profile:
+        return "❌ まずプロフィールを登録してください。"
+    faculty = profile.get("faculty")
+    department = profile.get("department", "経営学科")  # デフォルト値
+
+    # 2. カリキュラム要件
+    if not reqs:
+        return f"❌ {faculty} {department} の履修要件が見つかりません。"
+
+    # 3. 成績データ
+    if not grades_list:
+        return "❌ 成績データが見つかりません。まずPDFをアップロードしてください。"
+
+    # 4. 突き合わせ
+    earned_by_cat = {g.get("category"): g.get("earned", 0) for g in grades_list}
+    lines = ["📊 不足単位チェック結果"]
+
+    for r in reqs:
+        cat = r.get("category")
+        required = r.get("required_units", 0)
+        earned = earned_by_cat.get(cat, 0)
+        deficit = required - earned
+        if deficit > 0:
+            lines.append(f"- {cat}: あと {deficit} 単位必要（{earned}/{required}）")
+        else:
+            lines.append(f"- {cat}: ✅ クリア（{earned}/{required}）")
+
+    return "\n".join(lines)
+
+
+def fetch_requirements_for_profile(profile):
+    """プロフィールの学部・学科に対応する履修要件（プロフィールが無ければ []）"""
+    if not profile:
+        return []
+    return fetch_curriculum_docs(profile.get("faculty"), profile.get("department", "経営学科"))
+
+
+def fetch_requirements_for_user(user_id):
+    """プロフィールの学部・学科に対応する履修要件（プロフィールが無ければ []）"""
+    return fetch_requirements_for_profile(fetch_profile(user_id))
+
+
+def advice_fingerprint(grades_list, reqs):
+    """成績データ・履修要件・プロンプト版・モデルの内容ハッシュ"""
+    payload = {
+        "grades": sorted(grades_list or [], key=lambda g: str(g.get("category"))),
+        "requirements": sorted(
+            [(r.get("category"), r.get("required_units")) for r in reqs or []], key=lambda x: str(x)
+        ),
+        "prompt_version": ADVICE_PROMPT_VERSION,
+        "model": ADVICE_MODEL,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def fetch_stored_advice(user_id):
+    """advice_results の保存済みアドバイス（無ければ None）。キャッシュ付き"""
+    def _load():
+        res = (
+            supabase.table("advice_results")
+            .select("fingerprint, advice, shortage_report")
+            .eq("user_id", user_id)
+            .limit(1)
+            .execute()
+        )
+        return res.data[0] if res and res.data else None
+    return user_cache.get_or_load(("advice", user_id), _load)
+
+
+def store_advice(user_id, fingerprint, advice, shortage_report=None, cache=True):
+    """advice_results へ保存。cache=False（夜間バッチ）ならユーザーキャッシュには入れず、古いものを消すだけ"""
+    row = {
+        "user_id": user_id,
+        "fingerprint": fingerprint,
+        "prompt_version": ADVICE_PROMPT_VERSION,
+        "advice": advice,
+        "shortage_report": shortage_report,
+        "created_at": datetime.now(tz=JST).isoformat(),
+    }
+    if cache:
+        user_cache.put(("advice", user_id), {"fingerprint": fingerprint, "advice": advice, "shortage_report": shortage_report})
+    else:
+        user_cache.invalidate(("advice", user_id))
+    writes.add("advice_results", row, op="upsert", key="user_id")
+
+
+def generate_advice(user_id, priority=llm_limiter.PRIORITY_ADVICE, reuse_only=False, inputs=None):
+    """
+    不足単位チェックと AI アドバイスを返す: {"shortage_report", "advice", "cached"}。
+    成績が無ければ None、生成に失敗したら advice が None。
+    成績・履修要件・プロンプト版が前回と同じなら保存済み（夜間バッチで作成済み）のものをそのまま返す。
+    reuse_only=True のときは保存済みが使えなくても OpenAI は呼ばず、advice=None を返す。
+    inputs（夜間バッチが一括で読んだ {"grades_text", "grades_list", "profile"}）があれば
+    DB・ユーザーキャッシュを読まずにそれを使い、保存済みとの照合も省く（スキャン時に照合済み）。
+    """
+    if inputs is None:
+        grades_text, grades_list = fetch_saved_grades(user_id)
+        profile = fetch_profile(user_id) if grades_text or grades_list else None
+    else:
+        grades_text, grades_list, profile = inputs["grades_text"], inputs["grades_list"], inputs["profile"]
+    if not grades_text and not grades_list:
+        return None
+
+    reqs = fetch_requirements_for_profile(profile)
+    fingerprint = advice_fingerprint(grades_list, reqs)
+    if inputs is None:
+        try:
+            stored = fetch_stored_advice(user_id)
+        except Exception as e:
+            debug_log("fetch_stored_advice error:", e)
+            stored = None
+        if stored and stored.get("fingerprint") == fingerprint:
+            shortage_report = stored.get("shortage_report") or build_shortage_report(profile, reqs, grades_list)
+            return {"shortage_report": shortage_report, "advice": stored.get("advice"), "cached": True}
+        if reuse_only:
+            return {"shortage_report": None, "advice": None, "cached": False}
+
+    # 不足単位チェックを追加
+    shortage_report = build_shortage_report(profile, reqs, grades_list)
+
+    # 成績・不足単位・履修要件を1つの表にまとめる（同じデータを3通りに送らない）
+    user_content = advice_prompt.build_advice_content(
+        grades_text, grades_list, reqs, max_tokens=ADVICE_PROMPT_TOKENS
+    )
+
+    messages = [
+        {"role": "system", "content": ADVICE_SYSTEM_PROMPT},
+        {"role": "user", "content": user_content}
+    ]
+
+    ai_text = call_openai_chat(messages, model=ADVICE_MODEL, priority=priority)
+    if ai_text is not None:
+        try:
+            store_advice(user_id, fingerprint, ai_text, shortage_report, cache=inputs is None)
+        except Exception as e:
+            debug_log("store_advice error:", e)
+    return {"shortage_report": shortage_report, "advice": ai_text, "cached": False}
+
+
+def find_stale_advice_users(limit=ADVICE_PRECOMPUTE_LIMIT):
+    """
+    成績・履修要件・プロンプト版が前回のアドバイス作成時から変わったユーザーを探す。
+    grades_text / users / advice_results をそれぞれページングで1回ずつ読み、
+    指紋（advice_fingerprint）を突き合わせる。
+    読んだ行は共有のユーザーキャッシュには入れず（対話中のユーザーを追い出さないように）、
+    generate_advice の inputs としてそのまま渡す。
+    戻り値: ([(user_id, inputs)], scanned_users)
+    """
+    latest = {}
+    for page in iter_pages(
+        lambda: supabase.table("grades_text")
+        .select("user_id, content, raw_data, created_at")
+        .order("user_id", desc=False)
+        .order("created_at", desc=True)
+        .order("id", desc=True)
+    ):
+        for r in page:
+            latest.setdefault(r.get("user_id"), r)
+    latest.pop(None, None)
+
+    profiles = {}
+    for page in iter_pages(lambda: supabase.table("users").select("*").order("line_user_id", desc=False)):
+        for r in page:
+            profiles[r.get("line_user_id")] = r
+
+    stored = {}
+    for page in iter_pages(
+        lambda: supabase.table("advice_results").select("user_id, fingerprint").order("user_id", desc=False)
+    ):
+        for r in page:
+            stored[r.get("user_id")] = r.get("fingerprint")
+
+    stale = []
+    for uid, row in latest.items():
+        grades_text, grades_list = _decode_grades_row(row)
+        if not grades_text and not grades_list:
+            continue
+        profile = profiles.get(uid)
+        if stored.get(uid) == advice_fingerprint(grades_list, fetch_requirements_for_profile(profile)):
+            continue
+        stale.append((uid, {"grades_text": grades_text, "grades_list": grades_list, "profile": profile}))
+        if len(stale) >= limit:
+            break
+    return stale, len(latest)
+
+
+def precompute_advice(stale, concurrency=ADVICE_PRECOMPUTE_CONCURRENCY, job_id=None):
+    """
+    stale（find_stale_advice_users の [(user_id, inputs)]）のアドバイスを最大 concurrency 並列で作り、
+    advice_results に保存する。OpenAI の枠は対話より低い優先度で取る。
+    job_id（advice_jobs のジョブ）があれば進み具合をそこへ書き込む。戻り値: (generated, failures)
+    """
+    failures = []
+
+    def _one(item):
+        uid, inputs = item
+        try:
+            result = generate_advice(uid, priority=llm_limiter.PRIORITY_BATCH, inputs=inputs)
+        except llm_limiter.Busy as e:
+            return uid, f"busy: {e}"
+        except Exception as e:
+            return uid, f"error: {e}"
+        if result is None:
+            return uid, "no grades"
+        if result["advice"] is None:
+            return uid, "generation failed"
+        return uid, None
+
+    generated = 0
+    processed = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for uid, err in pool.map(_one, stale):
+            if err is None:
+                generated += 1
+            else:
+                failures.append({"user_id": uid, "error": err})
+            processed += 1
+            if job_id is not None:
+                advice_jobs.update(job_id, processed=processed, generated=generated, failed=len(failures))
+    writes.flush()
+    return generated, failures
+
+
+# ---- アドバイス事前生成のジョブ（/advice_precompute がバックグラウンドで動かす）----
+# 状態はローカル SQLite に置き、同じホストの全ワーカーで共有する（直近 ADVICE_JOBS_KEEP 件）
+ADVICE_JOBS_KEEP = 20
+advice_jobs = job_store.JobStore(ADVICE_JOBS_PATH, keep=ADVICE_JOBS_KEEP, stale_after=ADVICE_JOB_STALE_AFTER)
+
+
+def start_advice_precompute(limit, concurrency):
+    """
+    スキャン・生成を別スレッドで始めてジョブ（dict）を返す。
+    どのワーカーかで実行中のジョブがあれば新しくは始めず、それを返す（started=False）。
+    """
+    job, started = advice_jobs.start("advice_precompute", {
+        "job_id": uuid.uuid4().hex[:12],
+        "started_at": datetime.now(tz=JST).isoformat(),
+        "limit": limit,
+        "concurrency": concurrency,
+        "users_scanned": None,
+        "stale": None,
+        "processed": 0,
+        "generated": 0,
+        "failed": 0,
+        "failures": [],
+    })
+    if not started:
+        return job, False
+    job_id = job["job_id"]
+
+    def _run():
+        start = time.perf_counter()
+        try:
+            stale, scanned = find_stale_advice_users(limit=limit)
+            scan_ms = (time.perf_counter() - start) * 1000
+            advice_jobs.update(job_id, users_scanned=scanned, stale=len(stale), scan_ms=round(scan_ms, 1))
+            generated, failures = precompute_advice(stale, concurrency=concurrency, job_id=job_id)
+            gen_elapsed = time.perf_counter() - start - scan_ms / 1000
+            result = {
+                "state": "done",
+                "generated": generated,
+                "failed": len(failures),
+                "failures": failures[:20],
+                "users_per_s": round(len(stale) / gen_elapsed, 2) if stale and gen_elapsed > 0 else 0.0,
+            }
+        except Exception as e:
+            debug_log("advice precompute job error:", e)
+            result = {"state": "error", "error": str(e)}
+        result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        result["finished_at"] = datetime.now(tz=JST).isoformat()
+        try:
+            advice_jobs.update(job_id, **result)
+        except Exception as e:
+            debug_log("advice precompute job state error:", e)
+
+    threading.Thread(target=_run, name="advice-precompute", daemon=True).start()
+    return job, True
+
 
 def format_curriculum_docs(faculty, department, rows):
     if not rows:
@@ -443,12 +1106,9 @@ def format_curriculum_docs(faculty, department, rows):
 
     return "\n".join(lines)
 
-# ---- プロフィール登録用 ----
-user_states = {}
-# ---- 授業登録用 ----
-class_states = {}
-# ---- 課題登録用 ----
-assignment_states = {}
+# ---- 登録フローの状態（プロフィール / 授業 / 課題）----
+# ワーカー間で共有し、STATE_TTL 秒操作が無いフローは破棄する
+flow_states = state_store.create_state_store(STATE_BACKEND, path=STATE_PATH, ttl=STATE_TTL)
 
 
 def save_profile(user_id, data):
@@ -465,9 +1125,11 @@ def save_profile(user_id, data):
         debug_log(f"Saved profile for {user_id}: {data}")
     except Exception as e:
         debug_log("save_profile error:", e)
+    finally:
+        user_cache.invalidate(("profile", user_id))
 
 def save_assignment(user_id, title, due_date):
-    """課題を Supabase に保存"""
+    """課題を Supabase に保存（登録完了を返信するので同期で書く）"""
     try:
         # due_date を ISO 文字列に変換
         if isinstance(due_date, (datetime, date)):
@@ -475,14 +1137,13 @@ def save_assignment(user_id, title, due_date):
         else:
             due_date_str = str(due_date)
 
-        res = supabase.table("assignments").insert({
+        supabase.table("assignments").insert({
             "user_id": user_id,
             "title": title,
             "due_date": due_date_str,
             "created_at": datetime.now(tz=JST).isoformat()
         }).execute()
-        
-        debug_log(f"save_assignment result: {res}")
+        debug_log(f"Saved assignment: {user_id}, {title}, {due_date_str}")
         return True
     except Exception as e:
         debug_log("save_assignment error:", e)
@@ -498,6 +1159,42 @@ def fetch_assignments(user_id, until_date=None):
     return res.data if res and res.data else []
 
 
+def load_user_classes():
+    return fetch_all_pages(
+        lambda: supabase.table("user_classes")
+        .select("user_id, subject, day_of_week, period")
+        .order("user_id", desc=False)
+        .order("day_of_week", desc=False)
+        .order("period", desc=False)
+        .order("id", desc=False)
+    )
+
+
+timetable = timetable_index.TimetableIndex(load_user_classes, ttl=TIMETABLE_TTL, version=refresh_stamps["timetable"].version)
+
+
+def fetch_assignments_for_users(user_ids, until_date):
+    """
+    複数ユーザーの締切済み課題を in フィルタでまとめて取得し、user_id ごとに締切順で返す。
+    ユーザー数が多い場合は SUPABASE_IN_CHUNK 件ずつに分け、各クエリはページングする。
+    """
+    grouped = {}
+    for chunk in chunked(user_ids, SUPABASE_IN_CHUNK):
+        rows = fetch_all_pages(
+            lambda: supabase.table("assignments")
+            .select("user_id, title, due_date")
+            .in_("user_id", chunk)
+            .lte("due_date", until_date.isoformat())
+            .order("due_date", desc=False)
+            .order("user_id", desc=False)
+            .order("title", desc=False)
+            .order("id", desc=False)
+        )
+        for r in rows:
+            grouped.setdefault(r["user_id"], []).append(r)
+    return grouped
+
+
 
 # ---- ルート ----
 @app.route("/")
@@ -506,343 +1203,507 @@ def index():
 
 
 # ---- Webhook ----
+# イベントの種類 → ハンドラ（MessageEvent はメッセージの種類ごと）
+event_handlers = {}
+
+
+def on_event(event_type, message=None):
+    """event_handlers にハンドラを登録するデコレータ"""
+    def decorator(func):
+        event_handlers[(event_type, message)] = func
+        return func
+    return decorator
+
+
+def dispatch_event(event):
+    """event_handlers に登録済みのハンドラへ1イベントを振り分ける"""
+    func = None
+    if isinstance(event, MessageEvent):
+        func = event_handlers.get((type(event), type(event.message)))
+    if func is None:
+        func = event_handlers.get((type(event), None))
+    if func is None:
+        debug_log("No handler for", event.__class__.__name__)
+        return
+    func(event)
+
+
+webhook_dedup = dedup_cache.create_deduplicator(
+    WEBHOOK_DEDUP_BACKEND, path=WEBHOOK_DEDUP_PATH, ttl=WEBHOOK_DEDUP_TTL
+)
+
+
+def claim_event(event):
+    """webhookEventId を記録する。再送済みで処理不要なら False"""
+    if webhook_dedup and not webhook_dedup.should_process(event):
+        debug_log("Skipping redelivered event:", getattr(event, "webhook_event_id", None))
+        return False
+    return True
+
+
+def run_claimed_event(event):
+    """claim_event 済みのイベントをハンドラへ渡す"""
+    try:
+        dispatch_event(event)
+    except Exception:
+        # 失敗した配信は処理済みにしない（再送を弾かないように）
+        if webhook_dedup:
+            webhook_dedup.release(event)
+        raise
+
+
+def process_event(event):
+    """再送済みイベントを弾いてからハンドラへ渡す"""
+    if claim_event(event):
+        run_claimed_event(event)
+
+
+webhook_pool = webhook_worker.WebhookWorkerPool(
+    run_claimed_event, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE
+)
+
+
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
     debug_log("Webhook received (truncated):", body[:1000])
     try:
-        handler.handle(body, signature)
+        payload = parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
         debug_log("Invalid signature for webhook")
         abort(400)
+    if WEBHOOK_ASYNC:
+        # 署名検証とパースだけ行い、処理はワーカーに任せてすぐ返す
+        # 重複排除の記録はキューに入れる時点で行う（503 で再送された同じイベントを二重に処理しないように）
+        dropped = 0
+        for ev in payload.events:
+            if not claim_event(ev):
+                continue
+            if not webhook_pool.submit(ev):
+                # キューに入らなかったものは記録を消し、再送で処理し直す
+                if webhook_dedup:
+                    webhook_dedup.release(ev)
+                dropped += 1
+        if dropped:
+            # キューが溢れたら 503 を返して LINE の再送に任せる
+            return ("Busy", 503)
+        return "OK"
+    try:
+        for ev in payload.events:
+            process_event(ev)
     except Exception as e:
-        debug_log("handler.handle threw:", e)
+        debug_log("event handler threw:", e)
         abort(500)
     return "OK"
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    token = request.args.get("token") or request.headers.get("X-Notify-Token")
+    if NOTIFY_SECRET and token != NOTIFY_SECRET:
+        return ("Unauthorized", 401)
+    return jsonify({
+        "webhook_queue": webhook_pool.stats(),
+        "webhook_dedup": webhook_dedup.stats() if webhook_dedup else None,
+        "write_buffer": writes.stats(),
+        "last_seen": seen_tracker.stats(),
+        "timetable": timetable.stats(),
+        "academic_calendar": academic_calendar.stats(),
+        "syllabus_index": syllabus.stats(),
+        "reference": reference.stats(),
+        "user_cache": user_cache.stats(),
+        "chat_cache": chat_cache.stats() if chat_cache else None,
+        "flow_states": flow_states.stats(),
+        "openai": llm_deadline.stats(),
+        "openai_limiter": openai_limiter.stats(),
+    })
+
+
 # ---- テキストメッセージ ----
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text_message(event):
-    try:
-        user_id = event.source.user_id
-        text_raw = event.message.text or ""
-        debug_log(f"TextMessage from {user_id}: {text_raw}")
-        text = normalize_text(text_raw)
+SYLLABUS_STRIP_RE = re.compile(r"(シラバス|教えて)")
+YEAR_MONTH_RE = re.compile(r"(\d{4})[-/年](\d{1,2})")
+EASY_CLASS_FORM_URL = "https://docs.google.com/forms/d/e/1FAIpQLSfw654DpwVoSexb3lI8WLqsR6ex1lRYEX_6Yg1g-S57tw2JBQ/viewform?usp=header"
+ANNUAL_SCHEDULE_URLS = [
+    "https://zqihsfkgjaenzndopzpk.supabase.co/storage/v1/object/public/calendar/annual_schedule_1.png",
+    "https://zqihsfkgjaenzndopzpk.supabase.co/storage/v1/object/public/calendar/annual_schedule_2.png",
+]
 
-                # --- リッチメニュー専用の応答 ---
-        if text_raw == "使い方ガイド":
-            guide_text = (
-                "Campus Navigatorの使い方📖\n\n"
-                "1️⃣ 成績表をアップロード → 自動解析\n"
-                "2️⃣ シラバス検索 → 授業内容や条件を確認\n"
-                "3️⃣ 年間予定 → 行事をリマインド通知\n\n"
-                "メニューからいつでも選べます！"
-            )
-            safe_reply(event.reply_token, guide_text)
-            return
-        
-        if text_raw == "出席ランキング":
-            risk_report = get_attendance_risk_report(user_id)
-            safe_reply(event.reply_token, risk_report)
-            return
 
+def reply_guide(event, user_id, text_raw, route):
+    guide_text = (
+        "Campus Navigatorの使い方📖\n\n"
+        "1️⃣ 成績表をアップロード → 自動解析\n"
+        "2️⃣ シラバス検索 → 授業内容や条件を確認\n"
+        "3️⃣ 年間予定 → 行事をリマインド通知\n\n"
+        "メニューからいつでも選べます！"
+    )
+    safe_reply(event.reply_token, guide_text)
 
-        if text_raw == "年間行事予定":
-            urls = [
-                "https://zqihsfkgjaenzndopzpk.supabase.co/storage/v1/object/public/calendar/annual_schedule_1.png",
-                "https://zqihsfkgjaenzndopzpk.supabase.co/storage/v1/object/public/calendar/annual_schedule_2.png",
-            ]
-            messages = [
-                ImageSendMessage(
-                    original_content_url=url,
-                    preview_image_url=url
-                )
-                for url in urls
-            ]
-            line_bot_api.reply_message(event.reply_token, messages)
-            return
 
-        if text_raw == "プロフィール登録":
-            user_states[user_id] = {"step": 1, "data": {}}
-            safe_reply(event.reply_token, "学部を入力してください（例：経営学部）")
+def reply_attendance_ranking(event, user_id, text_raw, route):
+    risk_report = get_attendance_risk_report(user_id)
+    safe_reply(event.reply_token, risk_report)
+
+
+def reply_annual_schedule(event, user_id, text_raw, route):
+    messages = [
+        ImageSendMessage(
+            original_content_url=url,
+            preview_image_url=url
+        )
+        for url in ANNUAL_SCHEDULE_URLS
+    ]
+    line_bot_api.reply_message(event.reply_token, messages)
+
+
+def start_profile_register(event, user_id, text_raw, route):
+    flow_states.start("profile", user_id)
+    safe_reply(event.reply_token, "学部を入力してください（例：経営学部）")
+
+
+def start_class_register(event, user_id, text_raw, route):
+    flow_states.start("class", user_id)
+    safe_reply(event.reply_token, "授業名を入力してください（例: マーケティング論）")
+
+
+def start_assignment_register(event, user_id, text_raw, route):
+    flow_states.start("assignment", user_id)
+    safe_reply(event.reply_token, "課題のタイトルを入力してください（例: レポート提出）")
+
+
+def continue_class_register(event, user_id, text_raw, state):
+    step = state["step"]
+    data = state["data"]
+
+    if step == 1:
+        data["subject"] = text_raw
+        if not flow_states.advance("class", user_id, 1, 2, data):
+            debug_log(f"class flow step1 skipped (concurrent update) user={user_id}")
             return
+        # 曜日を QuickReply で選択
+        items = ["月", "火", "水", "木", "金", "土"]
+        buttons = [QuickReplyButton(action=MessageAction(label=day, text=day)) for day in items]
+        message = TextSendMessage(
+            text="曜日を選んでください 👇",
+            quick_reply=QuickReply(items=buttons)
+        )
+        line_bot_api.reply_message(event.reply_token, message)
+        return
 
-                # === 📚 授業登録機能 ===
-        if text_raw == "授業登録":
-            class_states[user_id] = {"step": 1, "data": {}}
-            safe_reply(event.reply_token, "授業名を入力してください（例: マーケティング論）")
+    elif step == 2:
+        data["day_of_week"] = text_raw
+        if not flow_states.advance("class", user_id, 2, 3, data):
+            debug_log(f"class flow step2 skipped (concurrent update) user={user_id}")
             return
+        safe_reply(event.reply_token, "何限ですか？（例: 2）")
+        return
 
-        if user_id in class_states:
-            state = class_states[user_id]
-            step = state["step"]
-
-            if step == 1:
-                state["data"]["subject"] = text_raw
-                state["step"] = 2
-                # 曜日を QuickReply で選択
-                items = ["月", "火", "水", "木", "金", "土"]
-                buttons = [QuickReplyButton(action=MessageAction(label=day, text=day)) for day in items]
-                message = TextSendMessage(
-                    text="曜日を選んでください 👇",
-                    quick_reply=QuickReply(items=buttons)
-                )
-                line_bot_api.reply_message(event.reply_token, message)
-                return
-
-            elif step == 2:
-                state["data"]["day_of_week"] = text_raw
-                state["step"] = 3
-                safe_reply(event.reply_token, "何限ですか？（例: 2）")
-                return
-
-            elif step == 3:
-                try:
-                    state["data"]["period"] = int(text_raw)
-                except ValueError:
-                    safe_reply(event.reply_token, "❌ 数字で入力してください（例: 2）")
-                    return
-
-                # Supabase に保存
-                supabase.table("user_classes").insert({
-                    "user_id": user_id,
-                    **state["data"]
-                }).execute()
-
-                del class_states[user_id]
-                safe_reply(event.reply_token, "✅ 授業を登録しました！")
-                return
-        # === 📚 授業登録ここまで ===
-        
-        # ---- 課題登録用 ----
-
-
-        if text_raw == "課題登録":
-            assignment_states[user_id] = {"step": 1, "data": {}}
-            safe_reply(event.reply_token, "課題のタイトルを入力してください（例: レポート提出）")
+    elif step == 3:
+        try:
+            data["period"] = int(text_raw)
+        except ValueError:
+            safe_reply(event.reply_token, "❌ 数字で入力してください（例: 2）")
             return
 
-        if user_id in assignment_states:
-            state = assignment_states[user_id]
-            step = state["step"]
-
-            if step == 1:
-                state["data"]["title"] = text_raw
-                state["step"] = 2
-                safe_reply(event.reply_token, "締切日を入力してください（例: 2025-10-05）")
-                return
-
-            elif step == 2:
-                try:
-                    due_date = datetime.fromisoformat(text_raw).date()
-                    state["data"]["due_date"] = due_date.isoformat()
-                    save_assignment(user_id, state["data"]["title"], due_date)
-                    del assignment_states[user_id]
-                    safe_reply(event.reply_token, "✅ 課題を登録しました！")
-                except Exception:
-                    safe_reply(event.reply_token, "❌ 日付の形式が正しくありません。例: 2025-10-05")
-                return
-
-        wants_advice = any(k in text for k in ["アドバイス".lower(), "助言".lower(), "advice"])
-        wants_grades_check = any(k in text for k in ["成績", "単位", "成績確認"])
-        asks_office = any(k in text for k in ["事務室", "連絡先", "電話番号", "電話"])
-        wants_easy_class = any(k in text for k in ["楽単", "ラク単", "らくたん", "easy class"])
-        wants_curriculum = any(k in text for k in ["履修条件", "卒業要件", "必要単位", "カリキュラム"])
-
-        # 学部判定（簡易）
-        dept_keywords = {
-            "経営": ["経営", "経営学部"],
-            "商学": ["商学", "商学部"],
-            "法学": ["法学", "法学部"],
-        }
-        matched_dept = None
-        for key, variants in dept_keywords.items():
-            for v in variants:
-                if v.lower() in text:
-                    matched_dept = key
-                    break
-            if matched_dept:
-                break
-        # 0) 楽単フォーム
-        if wants_easy_class:
-            debug_log("handling: easy class form")
-            form_url = "https://docs.google.com/forms/d/e/1FAIpQLSfw654DpwVoSexb3lI8WLqsR6ex1lRYEX_6Yg1g-S57tw2JBQ/viewform?usp=header"
-            safe_reply(event.reply_token, f"📝 楽単情報の投稿はこちらから！\n{form_url}")
+        # 先にフローを閉じる（同じ入力が別ワーカーで処理されても二重登録しない）
+        if not flow_states.finish("class", user_id, 3):
+            debug_log(f"class flow step3 skipped (concurrent update) user={user_id}")
             return
 
-        # --- 予定／カレンダー機能 ---
-        wants_calendar = any(k in text for k in ["予定", "スケジュール", "今日の予定", "明日の予定", "今月の予定", "calendar", "予定表"])
-        wants_subscribe = any(k in text for k in ["通知登録", "配信登録", "通知を受け取る", "subscribe", "登録する"])
-        wants_unsubscribe = any(k in text for k in ["通知停止", "配信停止", "unsubscribe", "停止する"])
+        # Supabase に保存
+        supabase.table("user_classes").insert({
+            "user_id": user_id,
+            **data
+        }).execute()
+        timetable.add(user_id, data["subject"], data["day_of_week"], data["period"])
 
-        # ユーザーを一旦DBに登録（初アクセス時）
-        upsert_subscriber(user_id, opt_in=False)
+        safe_reply(event.reply_token, "✅ 授業を登録しました！")
+        return
 
-        if wants_subscribe:
-            set_subscription(user_id, True)
-            safe_reply(event.reply_token, "✅ 通知登録しました！毎朝の予定をお送りします。停止は「通知停止」と送ってください。")
-            return
 
-        if wants_unsubscribe:
-            set_subscription(user_id, False)
-            safe_reply(event.reply_token, "✅ 通知を停止しました。")
+def continue_assignment_register(event, user_id, text_raw, state):
+    step = state["step"]
+    data = state["data"]
+
+    if step == 1:
+        data["title"] = text_raw
+        if not flow_states.advance("assignment", user_id, 1, 2, data):
+            debug_log(f"assignment flow step1 skipped (concurrent update) user={user_id}")
             return
+        safe_reply(event.reply_token, "締切日を入力してください（例: 2025-10-05）")
+        return
 
-        if wants_calendar:
-            if "今日" in text:
-                today = datetime.now(tz=JST).date()
-                events = fetch_events_between(today, today)
-                safe_reply(event.reply_token, "📅 今日の予定:\n\n" + format_events_human(events))
-                return
-            if "明日" in text:
-                tomorrow = datetime.now(tz=JST).date() + timedelta(days=1)
-                events = fetch_events_between(tomorrow, tomorrow)
-                safe_reply(event.reply_token, "📅 明日の予定:\n\n" + format_events_human(events))
-                return
-            if "今月" in text:
-                now = datetime.now(tz=JST)
-                start = date(now.year, now.month, 1)
-                end = (date(now.year, now.month + 1, 1) - timedelta(days=1)) if now.month < 12 else date(now.year, 12, 31)
-                events = fetch_events_between(start, end)
-                safe_reply(event.reply_token, f"📅 {now.year}年{now.month}月の予定:\n\n" + format_events_human(events))
-                return
-
-            import re
-            m = re.search(r"(\d{4})[-/年](\d{1,2})", text)
-            if m:
-                y, mth = int(m.group(1)), int(m.group(2))
-                start = date(y, mth, 1)
-                end = (date(y, mth + 1, 1) - timedelta(days=1)) if mth < 12 else date(y, 12, 31)
-                events = fetch_events_between(start, end)
-                safe_reply(event.reply_token, f"📅 {y}年{mth}月の予定:\n\n" + format_events_human(events))
-                return
-
-            start = datetime.now(tz=JST).date()
-            end = start + timedelta(days=7)
-            events = fetch_events_between(start, end)
-            safe_reply(event.reply_token, "📅 直近7日間の予定:\n\n" + format_events_human(events))
+    elif step == 2:
+        try:
+            due_date = datetime.fromisoformat(text_raw).date()
+        except ValueError:
+            safe_reply(event.reply_token, "❌ 日付の形式が正しくありません。例: 2025-10-05")
+            return
+        if not flow_states.finish("assignment", user_id, 2):
+            debug_log(f"assignment flow step2 skipped (concurrent update) user={user_id}")
             return
+        try:
+            save_assignment(user_id, data["title"], due_date)
+            safe_reply(event.reply_token, "✅ 課題を登録しました！")
+        except Exception as e:
+            debug_log(f"save_assignment error: {e}")
+            safe_reply(event.reply_token, "❌ 課題の登録に失敗しました。もう一度「課題登録」からやり直してください。")
+        return
+
+
+def reply_easy_class(event, user_id, text_raw, route):
+    debug_log("handling: easy class form")
+    safe_reply(event.reply_token, f"📝 楽単情報の投稿はこちらから！\n{EASY_CLASS_FORM_URL}")
+
+
+SUBSCRIPTION_ERROR_MESSAGE = "⚠️ 通知設定の保存に失敗しました。時間をおいてもう一度お試しください。"
+
+
+def reply_subscribe(event, user_id, text_raw, route):
+    if not set_subscription(user_id, True):
+        safe_reply(event.reply_token, SUBSCRIPTION_ERROR_MESSAGE)
+        return
+    safe_reply(event.reply_token, "✅ 通知登録しました！毎朝の予定をお送りします。停止は「通知停止」と送ってください。")
+
+
+def reply_unsubscribe(event, user_id, text_raw, route):
+    if not set_subscription(user_id, False):
+        safe_reply(event.reply_token, SUBSCRIPTION_ERROR_MESSAGE)
+        return
+    safe_reply(event.reply_token, "✅ 通知を停止しました。")
+
+
+def reply_calendar(event, user_id, text_raw, route):
+    text = route.text
+    if "今日" in text:
+        today = datetime.now(tz=JST).date()
+        events = fetch_events_between(today, today)
+        safe_reply(event.reply_token, "📅 今日の予定:\n\n" + format_events_human(events))
+        return
+    if "明日" in text:
+        tomorrow = datetime.now(tz=JST).date() + timedelta(days=1)
+        events = fetch_events_between(tomorrow, tomorrow)
+        safe_reply(event.reply_token, "📅 明日の予定:\n\n" + format_events_human(events))
+        return
+    if "今月" in text:
+        now = datetime.now(tz=JST)
+        start = date(now.year, now.month, 1)
+        end = (date(now.year, now.month + 1, 1) - timedelta(days=1)) if now.month < 12 else date(now.year, 12, 31)
+        events = fetch_events_between(start, end)
+        safe_reply(event.reply_token, f"📅 {now.year}年{now.month}月の予定:\n\n" + format_events_human(events))
+        return
+
+    m = YEAR_MONTH_RE.search(text)
+    if m:
+        y, mth = int(m.group(1)), int(m.group(2))
+        start = date(y, mth, 1)
+        end = (date(y, mth + 1, 1) - timedelta(days=1)) if mth < 12 else date(y, 12, 31)
+        events = fetch_events_between(start, end)
+        safe_reply(event.reply_token, f"📅 {y}年{mth}月の予定:\n\n" + format_events_human(events))
+        return
+
+    start = datetime.now(tz=JST).date()
+    end = start + timedelta(days=7)
+    events = fetch_events_between(start, end)
+    safe_reply(event.reply_token, "📅 直近7日間の予定:\n\n" + format_events_human(events))
+
+
+def reply_curriculum(event, user_id, text_raw, route):
+    faculty, department = "経営学部", "経営学科"  # 今は固定
+    rows = fetch_curriculum_docs(faculty, department)
+    safe_reply(event.reply_token, format_curriculum_docs(faculty, department, rows))
+
+
+def reply_within_budget(event, user_id, produce, failure_text, priority=llm_limiter.PRIORITY_CHAT):
+    """
+    produce()（返信テキストを返す。失敗時 None）を OPENAI_REPLY_BUDGET 秒まで待って reply する。
+    間に合わなければ「生成中」を reply し、完成したテキストは push_message で届ける。
+    OpenAI の枠はこのスレッドで先に取る（実行スレッドの空き待ちで優先度や待ち行列の上限が効かなくならないように）。
+    枠が取れない・実行待ちが溢れている（llm_limiter.Busy / deadline_runner.Saturated）ときはすぐに「混雑中」を返す。
+    """
+    def _push_late(text):
+        line_bot_api.push_message(user_id, TextSendMessage(text=text or failure_text))
 
+    def _task():
+        _admitted.held = True
+        try:
+            return produce()
+        finally:
+            _admitted.held = False
+            openai_limiter.release()
 
-        if wants_curriculum:
-              faculty, department = "経営学部", "経営学科"  # 今は固定
-              rows = fetch_curriculum_docs(faculty, department)
-              safe_reply(event.reply_token, format_curriculum_docs(faculty, department, rows))
-              return
+    start = time.perf_counter()
+    try:
+        openai_limiter.acquire(priority)
+    except llm_limiter.Busy as e:
+        debug_log(f"OpenAI busy ({e}), shedding user={user_id}")
+        safe_reply(event.reply_token, BUSY_MESSAGE)
+        return
+    # 枠待ちにかかった時間は応答時間の上限から差し引く
+    budget = max(0.0, OPENAI_REPLY_BUDGET - (time.perf_counter() - start))
+    try:
+        done, text = llm_deadline.run(_task, on_late=_push_late, budget=budget)
+    except deadline_runner.Saturated as e:
+        openai_limiter.release()
+        debug_log(f"OpenAI workers saturated ({e}), shedding user={user_id}")
+        safe_reply(event.reply_token, BUSY_MESSAGE)
+        return
+    if done:
+        safe_reply(event.reply_token, text or failure_text)
+    else:
+        safe_reply(event.reply_token, GENERATING_MESSAGE)
+
+
+def format_advice(result):
+    # AIアドバイスと不足単位チェックをまとめて返す
+    return f"{result['shortage_report']}\n\n💡 AIからのアドバイス:\n{result['advice']}"
+
+
+def reply_advice(event, user_id, text_raw, route):
+    debug_log("handling: advice")
+    no_grades = "❌ 成績データが見つかりません。まずはPDFを送ってください。"
+
+    # 保存済み（夜間バッチで作成済み）ならOpenAIの枠を取らずにそのまま返す
+    result = generate_advice(user_id, reuse_only=True)
+    if result is None:
+        safe_reply(event.reply_token, no_grades)
+        return
+    if result["advice"] is not None:
+        safe_reply(event.reply_token, format_advice(result))
+        return
+
+    def _produce():
+        result = generate_advice(user_id)
+        if result is None:
+            return no_grades
+        if result["advice"] is None:
+            return None
+        return format_advice(result)
+
+    reply_within_budget(event, user_id, _produce,
+                        "💡 アドバイス生成に失敗しました。時間をおいてもう一度試してください。",
+                        priority=llm_limiter.PRIORITY_ADVICE)
+
+
+def reply_grades(event, user_id, text_raw, route):
+    debug_log("handling: grades check")
+    grades_text, grades_list = fetch_saved_grades(user_id)
+    if grades_text:
+        safe_reply(event.reply_token, grades_text)
+    else:
+        safe_reply(event.reply_token, "❌ 成績データが見つかりません。PDFを送ってください。")
+
+
+def reply_office(event, user_id, text_raw, route):
+    debug_log("handling: inquiry contacts")
+    matched_dept = route.dept
+    try:
+        rows = reference.contacts(matched_dept)
+        if rows:
+            if matched_dept and len(rows) >= 1:
+                r = rows[0]
+                out = f"📞 {r.get('department')}:\n{r.get('phone')}\n{r.get('page_url') or ''}"
+                safe_reply(event.reply_token, out)
+            else:
+                lines = []
+                for r in rows[:10]:
+                    lines.append(f"{r.get('department')} ({r.get('target')}): {r.get('phone')}\n{r.get('page_url') or ''}")
+                safe_reply(event.reply_token, "📞 明治大学 各学部事務室の連絡先:\n\n" + "\n\n".join(lines))
+        else:
+            safe_reply(event.reply_token, "該当する事務室の連絡先が見つかりませんでした。学部名を教えてください（例: 経営学部）。")
+    except Exception as e:
+        debug_log("inquiry_contacts error:", e)
+        safe_reply(event.reply_token, "事務室情報の取得中にエラーが発生しました。後でもう一度お試しください。")
 
 
-        
-        # 1) アドバイス要求
-        if wants_advice:
-            debug_log("handling: advice")
-            grades_text, grades_list = fetch_saved_grades(user_id)
-            if not grades_text and not grades_list:
-                safe_reply(event.reply_token, "❌ 成績データが見つかりません。まずはPDFを送ってください。")
-                return
+def reply_syllabus_or_chat(event, user_id, text_raw, route):
+    # 4) シラバス検索
+    keyword = SYLLABUS_STRIP_RE.sub("", text_raw).strip()
 
-            # 不足単位チェックを追加
-            shortage_report = compare_grades_with_requirements(user_id)
+    if keyword:
+        syllabus_results = search_syllabus_by_name(keyword)
+        if syllabus_results:  # ヒットしたら必ず返す
+            safe_reply(event.reply_token, format_syllabus_result(syllabus_results))
+            return
 
-            prompt_system = (
-                "あなたは明治大学の学生をサポートするアシスタントです。"
-                "以下に与える成績状況と不足単位チェック結果を参考に、"
-                "卒業要件の達成状況、優先して履修すべき科目、履修順序や注意点を具体的に助言してください。"
-                "アドバイスは簡潔かつ要点を押さえてください。"
-            )
+    # 5) Fallback chat（雑談）
+    debug_log("handling: fallback chat")
+    cached = lookup_chat_cache(text_raw)
+    if cached is not None:
+        safe_reply(event.reply_token, cached)
+        return
+    reply_within_budget(event, user_id, lambda: call_openai_chat_cached(text_raw, skip_lookup=True),
+                        "💡 応答の生成に失敗しました。後ほど試してください。")
+
+
+# 意図 → ハンドラ（intent_router の EXACT_COMMANDS / INTENT_TABLE と対応）
+INTENT_HANDLERS = {
+    "guide": reply_guide,
+    "attendance_ranking": reply_attendance_ranking,
+    "annual_schedule": reply_annual_schedule,
+    "profile_register": start_profile_register,
+    "class_register": start_class_register,
+    "assignment_register": start_assignment_register,
+    "easy_class": reply_easy_class,
+    "subscribe": reply_subscribe,
+    "unsubscribe": reply_unsubscribe,
+    "calendar": reply_calendar,
+    "curriculum": reply_curriculum,
+    "advice": reply_advice,
+    "grades": reply_grades,
+    "office": reply_office,
+    None: reply_syllabus_or_chat,
+}
 
-            user_content = (
-                f"成績レポート:\n{grades_text}\n\n"
-                f"不足単位チェック:\n{shortage_report}\n\n"
-                f"構造化データ:\n{json.dumps(grades_list, ensure_ascii=False)}"
-            )
 
-            messages = [
-                {"role": "system", "content": prompt_system},
-                {"role": "user", "content": user_content}
-            ]
+@on_event(MessageEvent, message=TextMessage)
+def handle_text_message(event):
+    try:
+        user_id = event.source.user_id
+        text_raw = event.message.text or ""
+        debug_log(f"TextMessage from {user_id}: {text_raw}")
+        text = normalize_text(text_raw)
 
-            ai_text = call_openai_chat(messages)
-            if ai_text is None:
-                safe_reply(event.reply_token, "💡 アドバイス生成に失敗しました。時間をおいてもう一度試してください。")
-            else:
-                # AIアドバイスと不足単位チェックをまとめて返す
-                reply_text = f"{shortage_report}\n\n💡 AIからのアドバイス:\n{ai_text}"
-                safe_reply(event.reply_token, reply_text)
+        # --- リッチメニュー等の完全一致コマンド ---
+        # （課題登録は授業登録フローの入力として扱われうるため、フロー判定の後）
+        exact = intent_router.match_exact(text_raw)
+        if exact and exact != "assignment_register":
+            INTENT_HANDLERS[exact](event, user_id, text_raw, None)
             return
 
+        # 進行中のフローは1回の参照でまとめて取得
+        states = flow_states.get_all(user_id)
 
-        # 2) 成績表示
-        if wants_grades_check:
-            debug_log("handling: grades check")
-            grades_text, grades_list = fetch_saved_grades(user_id)
-            if grades_text:
-                safe_reply(event.reply_token, grades_text)
-            else:
-                safe_reply(event.reply_token, "❌ 成績データが見つかりません。PDFを送ってください。")
+        # === 📚 授業登録フロー ===
+        if "class" in states:
+            continue_class_register(event, user_id, text_raw, states["class"])
             return
 
-        # 3) 事務室問い合わせ
-        if asks_office:
-            debug_log("handling: inquiry contacts")
-            try:
-                if matched_dept:
-                    pattern = f"%{matched_dept}%"
-                    res = supabase.table("inquiry_contacts").select("*").ilike("department", pattern).execute()
-                else:
-                    res = supabase.table("inquiry_contacts").select("*").limit(50).execute()
-                if res and getattr(res, "data", None):
-                    rows = res.data
-                    if matched_dept and len(rows) >= 1:
-                        r = rows[0]
-                        out = f"📞 {r.get('department')}:\n{r.get('phone')}\n{r.get('page_url') or ''}"
-                        safe_reply(event.reply_token, out)
-                        return
-                    else:
-                        lines = []
-                        for r in rows[:10]:
-                            lines.append(f"{r.get('department')} ({r.get('target')}): {r.get('phone')}\n{r.get('page_url') or ''}")
-                        safe_reply(event.reply_token, "📞 明治大学 各学部事務室の連絡先:\n\n" + "\n\n".join(lines))
-                        return
-                else:
-                    safe_reply(event.reply_token, "該当する事務室の連絡先が見つかりませんでした。学部名を教えてください（例: 経営学部）。")
-                    return
-            except Exception as e:
-                debug_log("Supabase inquiry_contacts error:", e)
-                safe_reply(event.reply_token, "事務室情報の取得中にエラーが発生しました。後でもう一度お試しください。")
-                return
-
-        # 4) シラバス検索
-        import re
-        keyword = re.sub(r"(シラバス|教えて)", "", text_raw).strip()
-
-        if keyword:
-            syllabus_results = search_syllabus_by_name(keyword)
-            if syllabus_results:  # ヒットしたら必ず返す
-                safe_reply(event.reply_token, format_syllabus_result(syllabus_results))
-                return
-
-
-        # 5) Fallback chat（雑談）
-        debug_log("handling: fallback chat")
-        messages = [
-            {"role": "system", "content": "あなたは明治大学の学生をサポートするアシスタントです。"},
-            {"role": "user", "content": text_raw}
-        ]
-        ai_text = call_openai_chat(messages)
-        if ai_text is None:
-            safe_reply(event.reply_token, "💡 応答の生成に失敗しました。後ほど試してください。")
-        else:
-            safe_reply(event.reply_token, ai_text)
+        # ---- 課題登録フロー ----
+        if exact == "assignment_register":
+            INTENT_HANDLERS[exact](event, user_id, text_raw, None)
+            return
+
+        if "assignment" in states:
+            continue_assignment_register(event, user_id, text_raw, states["assignment"])
+            return
+
+        # --- キーワード意図（1パスで判定） ---
+        route = intent_router.classify(text)
+
+        if route.intent != "easy_class":
+            # ユーザーを一旦DBに登録（初アクセス時）
+            upsert_subscriber(user_id)
+
+        INTENT_HANDLERS[route.intent](event, user_id, text_raw, route)
 
     except Exception as e:
         debug_log("handle_text_message unexpected error:", e)
         safe_reply(event.reply_token, "予期せぬエラーが発生しました。管理者に問い合わせてください。")
 
-
 # ---- ファイル（PDFなど）ハンドラ ----
-@handler.add(MessageEvent, message=FileMessage)
+@on_event(MessageEvent, message=FileMessage)
 def handle_file_message(event):
     try:
         user_id = event.source.user_id
@@ -876,7 +1737,9 @@ def handle_file_message(event):
         try:
             payload = {"user_id": user_id, "content": grades_text, "raw_data": grades_list}
             supabase.table("grades_text").upsert(payload).execute()
+            user_cache.put(("grades", user_id), (grades_text, grades_list))
         except Exception as e:
+            user_cache.invalidate(("grades", user_id))
             debug_log("Supabase upsert error:", e)
             safe_reply(event.reply_token, "解析はできましたがデータの保存に失敗しました。管理者に連絡してください。")
 
@@ -894,10 +1757,10 @@ def handle_file_message(event):
         debug_log("handle_file_message unexpected error:", e)
         safe_reply(event.reply_token, "ファイルの処理中にエラーが発生しました。もう一度送ってください。")
 
-@handler.add(FollowEvent)
+@on_event(FollowEvent)
 def handle_follow(event):
     user_id = event.source.user_id
-    upsert_subscriber(user_id, opt_in=False)
+    upsert_subscriber(user_id)
 
     intro_text = """🎓 ようこそ！
 Campus Navigator @明治大学経営学部 へ 👋
@@ -957,17 +1820,66 @@ def notify_endpoint():
     message_body = f"📅 {target_date.isoformat()} の予定:\n\n" + format_events_human(events)
     user_ids = get_subscribed_user_ids()
 
-    successes, failures = 0, 0
-    for uid in user_ids:
-        try:
-            line_bot_api.push_message(uid, TextSendMessage(text=message_body))
-            successes += 1
-            supabase.table("notification_logs").insert({"user_id": uid, "event_id": None, "status": "sent"}).execute()
-        except Exception as e:
-            failures += 1
-            supabase.table("notification_logs").insert({"user_id": uid, "event_id": None, "status": "error", "error": str(e)}).execute()
+    def log_chunk(chunk_ids, result):
+        # チャンク単位でまとめて1回の insert
+        if result["ok"]:
+            rows = [{"user_id": uid, "event_id": None, "status": "sent"} for uid in chunk_ids]
+        else:
+            rows = [{"user_id": uid, "event_id": None, "status": "error", "error": result["error"]} for uid in chunk_ids]
+        writes.add_many("notification_logs", rows)
+
+    start = time.perf_counter()
+    chunks = multicast_in_chunks(user_ids, [TextSendMessage(text=message_body)], on_chunk=log_chunk)
+    successes = sum(c["size"] for c in chunks if c["ok"])
+    failures = sum(c["size"] for c in chunks if not c["ok"])
+
+    return jsonify({
+        "sent": successes,
+        "failed": failures,
+        "chunks": chunks,
+        "wall_ms": round((time.perf_counter() - start) * 1000, 1),
+    })
+
+@app.route("/calendar_refresh", methods=["POST", "GET"])
+def calendar_refresh():
+    token = request.args.get("token") or request.headers.get("X-Notify-Token")
+    if NOTIFY_SECRET and token != NOTIFY_SECRET:
+        return ("Unauthorized", 401)
+    refresh_stamps["calendar"].bump()  # 他のワーカーも次の参照時に読み直す
+    if request.args.get("mode") == "invalidate":
+        academic_calendar.invalidate()  # 次の参照時に読み直す
+    else:
+        academic_calendar.refresh()
+    return jsonify(academic_calendar.stats())
+
+
+@app.route("/syllabus_refresh", methods=["POST", "GET"])
+def syllabus_refresh():
+    token = request.args.get("token") or request.headers.get("X-Notify-Token")
+    if NOTIFY_SECRET and token != NOTIFY_SECRET:
+        return ("Unauthorized", 401)
+    refresh_stamps["syllabus"].bump()  # 他のワーカーも次の検索時に作り直す
+    if request.args.get("mode") == "invalidate":
+        syllabus.invalidate()  # 次の検索時に作り直す
+    else:
+        syllabus.refresh()
+    return jsonify(syllabus.stats())
+
+
+@app.route("/reference_refresh", methods=["POST", "GET"])
+def reference_refresh():
+    token = request.args.get("token") or request.headers.get("X-Notify-Token")
+    if NOTIFY_SECRET and token != NOTIFY_SECRET:
+        return ("Unauthorized", 401)
+    mode = request.args.get("mode")
+    if mode != "check":
+        refresh_stamps["reference"].bump()  # 他のワーカーも次の参照時に読み直す
+    if mode == "invalidate":
+        reference.invalidate()  # 次の参照時に読み直す
+    elif mode != "check":  # check は鮮度の確認のみ
+        reference.refresh()
+    return jsonify(reference.stats())
 
-    return (f"sent:{successes}, failed:{failures}", 200)
 
 @app.route("/assignment_notify", methods=["POST", "GET"])
 def assignment_notify():
@@ -975,22 +1887,26 @@ def assignment_notify():
     if NOTIFY_SECRET and token != NOTIFY_SECRET:
         return ("Unauthorized", 401)
 
+    start = time.perf_counter()
     today = datetime.now(tz=JST).date()
     user_ids = get_subscribed_user_ids()
-
-    for uid in user_ids:
-        assignments = fetch_assignments(uid, until_date=today)
-        if assignments:
-            lines = ["📌 今日までに提出の課題:"]
-            for a in assignments:
-                lines.append(f"- {a['title']}（締切 {a['due_date']}）")
-            body = "\n".join(lines)
-            try:
-                line_bot_api.push_message(uid, TextSendMessage(text=body))
-            except Exception as e:
-                debug_log("assignment_notify error:", e)
-
-    return ("done", 200)
+    due_by_user = fetch_assignments_for_users(user_ids, today)
+
+    digests = {}
+    for uid, assignments in due_by_user.items():
+        lines = ["📌 今日までに提出の課題:"]
+        for a in assignments:
+            lines.append(f"- {a['title']}（締切 {a['due_date']}）")
+        digests[uid] = TextSendMessage(text="\n".join(lines))
+
+    sent, failed = push_many(digests)
+    return jsonify({
+        "users": len(user_ids),
+        "with_assignments": len(digests),
+        "sent": sent,
+        "failed": failed,
+        "wall_ms": round((time.perf_counter() - start) * 1000, 1),
+    })
 
 @app.route("/timetable_notify", methods=["GET", "POST"])
 def timetable_notify():
@@ -1038,35 +1954,37 @@ def class_notify():
     if NOTIFY_SECRET and token != NOTIFY_SECRET:
         return ("Unauthorized", 401)
 
-    # 現在時刻を取得（例: "10:40"）
+    # 現在時刻を取得（例: "10:40"）。授業終了時刻ちょうどなら通知
     now = datetime.now(tz=JST)
-    weekday = ["月","火","水","木","金","土","日"][now.weekday()]
+    weekday = WEEKDAYS_JA[now.weekday()]
+    period = PERIOD_BY_END.get(now.strftime("%H:%M"))
+    matches = timetable.lookup(weekday, period) if period else []
 
-    matches = []
-    for period, times in PERIOD_TIMES.items():
-        end_time = datetime.strptime(times["end"], "%H:%M").replace(
-        year=now.year, month=now.month, day=now.day, tzinfo=JST
-        )
-        # 授業終了時刻ちょうどなら通知（例: 12:30）
-        if now.strftime("%H:%M") == times["end"]:
-            res = supabase.table("user_classes") \
-                .select("*") \
-                .eq("day_of_week", weekday) \
-                .eq("period", period) \
-                .execute()
-            if res and res.data:
-                matches.extend(res.data)
+    # 授業ごとにまとめ、同じ出欠ボタンを multicast で送信（授業間も並列）
+    users_by_subject = {}
+    for user_id, subject in matches:
+        users_by_subject.setdefault(subject, {})[user_id] = None
+    chunks = multicast_batches([
+        (list(user_ids), [build_attendance_request(subject)])
+        for subject, user_ids in users_by_subject.items()
+    ])
+    notified = sum(c["size"] for c in chunks if c["ok"])
 
+    return (f"notified:{notified}, subjects:{len(users_by_subject)}, api_calls:{len(chunks)}", 200)
 
 
-    # 出欠ボタンを送信
-    for row in matches:
-        try:
-            send_attendance_request(row["user_id"], row["subject"])
-        except Exception as e:
-            debug_log("class_notify error sending:", e)
+@app.route("/timetable_refresh", methods=["POST", "GET"])
+def timetable_refresh():
+    token = request.args.get("token") or request.headers.get("X-Notify-Token")
+    if NOTIFY_SECRET and token != NOTIFY_SECRET:
+        return ("Unauthorized", 401)
+    refresh_stamps["timetable"].bump()  # 他のワーカーも次の参照時に読み直す
+    if request.args.get("mode") == "invalidate":
+        timetable.invalidate()  # 次の参照時に読み直す
+    else:
+        timetable.refresh()
+    return jsonify(timetable.stats())
 
-    return (f"notified:{len(matches)}", 200)
 
 @app.route("/risk_notify", methods=["GET"])
 def risk_notify():
@@ -1074,45 +1992,80 @@ def risk_notify():
     if NOTIFY_SECRET and token != NOTIFY_SECRET:
         return ("Unauthorized", 401)
 
-    # attendanceに記録がある全ユーザーを対象
-    res = supabase.table("attendance").select("user_id").execute()
-    user_ids = list({row["user_id"] for row in res.data})  # 重複排除
+    start = time.perf_counter()
+
+    # リスク判定: 欠席2回 + 遅刻1回以上（該当する集計行だけをページングで取得）
+    risks_by_user = {}
+    rows_scanned = 0
+    pages = 0
+    for page in iter_pages(
+        lambda: supabase.table("attendance_counters")
+        .select("user_id, subject, late, absent")
+        .gte("absent", 2)
+        .gte("late", 1)
+        .order("user_id", desc=False)
+        .order("subject", desc=False)
+    ):
+        pages += 1
+        rows_scanned += len(page)
+        for r in page:
+            risks_by_user.setdefault(r["user_id"], []).append(
+                f"{r['subject']}（欠席{r['absent']}回・遅刻{r['late']}回）"
+            )
 
-    # 各ユーザーごとにリスク判定
-    for uid in user_ids:
-        risks = []
-        subjects_res = supabase.table("attendance") \
-            .select("subject, status") \
-            .eq("user_id", uid) \
-            .execute()
+    # 警告メッセージ送信
+    messages = {
+        uid: TextSendMessage(text="⚠️ 危険な授業があります！\n" + "\n".join(risks))
+        for uid, risks in risks_by_user.items()
+    }
+    sent, failed = push_many(messages)
 
-        # 授業ごとに集計
-        subject_stats = {}
-        for row in subjects_res.data:
-            subject = row["subject"]
-            status = row["status"]
-            if subject not in subject_stats:
-                subject_stats[subject] = {"absent": 0, "late": 0}
-            if status == "absent":
-                subject_stats[subject]["absent"] += 1
-            elif status == "late":
-                subject_stats[subject]["late"] += 1
-
-        # リスク判定: 欠席2回 + 遅刻1回以上
-        for subject, counts in subject_stats.items():
-            if counts["absent"] >= 2 and counts["late"] >= 1:
-                risks.append(f"{subject}（欠席{counts['absent']}回・遅刻{counts['late']}回）")
-
-        # 警告メッセージ送信
-        if risks:
-            message = "⚠️ 危険な授業があります！\n" + "\n".join(risks)
-            line_bot_api.push_message(uid, TextSendMessage(text=message))
+    return jsonify({
+        "rows_scanned": rows_scanned,
+        "pages": pages,
+        "users_warned": sent,
+        "failed": failed,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+    })
+
+
+@app.route("/advice_precompute", methods=["POST", "GET"])
+def advice_precompute():
+    """
+    成績・履修要件が変わったユーザーのアドバイスを夜間にまとめて作っておく（cron から呼ぶ）。
+    生成はバックグラウンドで行い、すぐに 202 とジョブ ID を返す（gunicorn のタイムアウトに掛からないように）。
+    ?job=<job_id> で進み具合、?dry_run=1 でスキャンだけ（同期）。
+    """
+    token = request.args.get("token") or request.headers.get("X-Notify-Token")
+    if NOTIFY_SECRET and token != NOTIFY_SECRET:
+        return ("Unauthorized", 401)
 
-    return ("done", 200)
+    job_id = request.args.get("job")
+    if job_id:
+        job = advice_jobs.get(job_id)
+        if job is None:
+            # 古くて消えたジョブ
+            return ("Unknown job", 404)
+        return jsonify(job)
 
+    try:
+        limit = int(request.args.get("limit", ADVICE_PRECOMPUTE_LIMIT))
+        concurrency = int(request.args.get("concurrency", ADVICE_PRECOMPUTE_CONCURRENCY))
+    except ValueError:
+        return ("Bad limit/concurrency", 400)
 
+    if request.args.get("dry_run") == "1":
+        start = time.perf_counter()
+        stale, scanned = find_stale_advice_users(limit=limit)
+        scan_ms = (time.perf_counter() - start) * 1000
+        return jsonify({"users_scanned": scanned, "stale": len(stale), "scan_ms": round(scan_ms, 1)})
 
-@handler.add(PostbackEvent)
+    job, started = start_advice_precompute(limit, concurrency)
+    return jsonify(dict(job, started=started)), 202
+
+
+
+@on_event(PostbackEvent)
 def handle_postback(event):
     try:
         user_id = event.source.user_id
@@ -1138,6 +2091,24 @@ def handle_postback(event):
 
 
 
+def warm_caches():
+    """メモリ上のキャッシュを先に読み込む（失敗しても初回参照時に再試行される）"""
+    for name, cache in [
+        ("academic_calendar", academic_calendar),
+        ("reference", reference),
+        ("syllabus", syllabus),
+        ("timetable", timetable),
+    ]:
+        try:
+            cache.refresh()
+        except Exception as e:
+            debug_log(f"warm_caches {name} error:", e)
+
+
+if PRELOAD_CACHES:
+    warm_caches()
+
+
 # ---- 起動 ----
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
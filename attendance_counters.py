@@ -0,0 +1,42 @@
+# attendance_counters.py — attendance_counters の再構築と整合性チェック
+# 使い方:
+#   python attendance_counters.py rebuild   # attendance から作り直してから検証
+#   python attendance_counters.py verify    # 検証のみ
+# 事前に attendance_counters.sql を Supabase で実行しておくこと。
+import os
+import sys
+
+from supabase import create_client
+
+
+def verify(supabase, max_samples=20):
+    """
+    集計テーブルと attendance の再集計を DB 側で突き合わせ、(食い違い件数, 先頭 max_samples 件) を返す。
+    両方を1つの SQL 文で読むので、検証中に attendance が書き込まれても誤検知しない。
+    """
+    res = supabase.rpc("verify_attendance_counters", {"max_samples": max_samples}).execute()
+    data = res.data or {}
+    return data.get("count", 0), data.get("samples", [])
+
+
+def rebuild(supabase):
+    res = supabase.rpc("rebuild_attendance_counters", {}).execute()
+    return res.data
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "verify"
+    client = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_KEY"])
+
+    if command == "rebuild":
+        print(f"✅ attendance_counters を再構築しました: {rebuild(client)} 行")
+    elif command != "verify":
+        sys.exit(f"unknown command: {command}")
+
+    count, samples = verify(client)
+    if count:
+        print(f"❌ 食い違い {count} 件")
+        for m in samples:
+            print(f"  {m['user_id']} {m['subject']}: attendance={m['want']} counters={m['got']}")
+        sys.exit(1)
+    print("✅ attendance_counters は attendance と一致しています")
@@ -0,0 +1,111 @@
+-- attendance_counters.sql — 出欠の (user, subject) 別集計テーブル
+-- Supabase の SQL Editor で一度実行する。attendance の insert / update / delete ごとにトリガーで増減するため、
+-- 出席ランキングと /risk_notify は attendance を再集計せずにこのテーブルだけを読む。
+
+create table if not exists attendance_counters (
+    user_id    text not null,
+    subject    text not null,
+    present    integer not null default 0,
+    late       integer not null default 0,
+    absent     integer not null default 0,
+    score      integer generated always as (absent * 2 + late) stored,  -- 欠席を重くカウント
+    updated_at timestamptz not null default now(),
+    primary key (user_id, subject)
+);
+
+create index if not exists idx_attendance_counters_risk on attendance_counters (absent, late);
+
+-- attendance への insert / update / delete と同じトランザクションで増減する
+-- update は旧行を引いてから新行を足す（user_id・subject・status のどれが変わっても合う）
+create or replace function bump_attendance_counter() returns trigger
+language plpgsql as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        update attendance_counters set
+            present    = present - (old.status = 'present')::int,
+            late       = late - (old.status = 'late')::int,
+            absent     = absent - (old.status = 'absent')::int,
+            updated_at = now()
+        where user_id = old.user_id and subject = old.subject;
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        insert into attendance_counters (user_id, subject, present, late, absent, updated_at)
+        values (
+            new.user_id,
+            new.subject,
+            (new.status = 'present')::int,
+            (new.status = 'late')::int,
+            (new.status = 'absent')::int,
+            now()
+        )
+        on conflict (user_id, subject) do update set
+            present    = attendance_counters.present + excluded.present,
+            late       = attendance_counters.late + excluded.late,
+            absent     = attendance_counters.absent + excluded.absent,
+            updated_at = now();
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists trg_attendance_counters on attendance;
+create trigger trg_attendance_counters
+    after insert or update of user_id, subject, status or delete on attendance
+    for each row execute function bump_attendance_counter();
+
+-- attendance から作り直す（python attendance_counters.py rebuild から呼ぶ）
+-- 集計中の insert と食い違わないよう attendance を書き込みロックしてから入れ替える
+create or replace function rebuild_attendance_counters() returns integer
+language plpgsql as $$
+declare
+    n integer;
+begin
+    lock table attendance in share mode;
+    delete from attendance_counters;
+    insert into attendance_counters (user_id, subject, present, late, absent, updated_at)
+    select user_id,
+           subject,
+           count(*) filter (where status = 'present'),
+           count(*) filter (where status = 'late'),
+           count(*) filter (where status = 'absent'),
+           now()
+    from attendance
+    group by user_id, subject;
+    get diagnostics n = row_count;
+    return n;
+end;
+$$;
+
+-- 集計テーブルと attendance の再集計を突き合わせる（python attendance_counters.py verify から呼ぶ）
+-- 1つの SQL 文の中で両方を読むので、検証中の insert があっても同じスナップショット同士を比べる
+-- 戻り値: {"count": 食い違い件数, "samples": 先頭 max_samples 件}
+create or replace function verify_attendance_counters(max_samples integer default 20) returns jsonb
+language sql stable as $$
+    with expected as (
+        select user_id,
+               subject,
+               count(*) filter (where status = 'present') as present,
+               count(*) filter (where status = 'late') as late,
+               count(*) filter (where status = 'absent') as absent
+        from attendance
+        group by user_id, subject
+    ),
+    diff as (
+        select coalesce(e.user_id, c.user_id) as user_id,
+               coalesce(e.subject, c.subject) as subject,
+               jsonb_build_object('present', coalesce(e.present, 0), 'late', coalesce(e.late, 0), 'absent', coalesce(e.absent, 0)) as want,
+               jsonb_build_object('present', coalesce(c.present, 0), 'late', coalesce(c.late, 0), 'absent', coalesce(c.absent, 0)) as got
+        from expected e
+        full join attendance_counters c on c.user_id = e.user_id and c.subject = e.subject
+    ),
+    mismatches as (
+        select * from diff where want <> got
+    )
+    select jsonb_build_object(
+        'count', (select count(*) from mismatches),
+        'samples', coalesce((
+            select jsonb_agg(jsonb_build_object('user_id', user_id, 'subject', subject, 'want', want, 'got', got))
+            from (select * from mismatches order by user_id, subject limit max_samples) m
+        ), '[]'::jsonb)
+    );
+$$;
@@ -0,0 +1,359 @@
+# bench.py — ローカル代替（fake_backends）を使った app.py のベンチマーク
+# 使い方: python bench.py assignment_notify --users 10000
+import argparse
+import os
+import random
+import time
+from datetime import date, timedelta
+
+import fake_backends
+
+
+def load_app(supabase=None, line=None):
+    """ダミーの環境変数で app を読み込み、外部クライアントをローカル代替に差し替える"""
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "dummy-secret")
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "dummy-token")
+    os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+    os.environ.setdefault("SUPABASE_KEY", "dummy.dummy.dummy")
+    os.environ.setdefault("OPENAI_API_KEY", "dummy")
+    os.environ.setdefault("WRITE_BEHIND", "0")
+    os.environ.setdefault("PRELOAD_CACHES", "0")
+    import app
+    if supabase is not None:
+        app.supabase = supabase
+    if line is not None:
+        app.line_bot_api = line
+    return app
+
+
+def _user_id(i):
+    return f"U{i:032d}"
+
+
+def bench_assignment_notify(users=10000, latency=0.001):
+    rnd = random.Random(0)
+    today = date.today()
+    subscribers = [{"user_id": _user_id(i), "opt_in": True} for i in range(users)]
+    assignments = []
+    for i in range(users):
+        if rnd.random() < 0.3:
+            for k in range(rnd.randint(1, 3)):
+                due = today + timedelta(days=rnd.randint(-3, 10))
+                assignments.append({"user_id": _user_id(i), "title": f"課題{k}", "due_date": due.isoformat()})
+
+    def fresh():
+        return (
+            fake_backends.FakeSupabase({"subscribers": subscribers, "assignments": assignments}, latency=latency),
+            fake_backends.FakeLineBotApi(latency=latency),
+        )
+
+    # 旧実装: ユーザーごとに fetch_assignments + 逐次 push
+    db, line = fresh()
+    app = load_app(db, line)
+    start = time.perf_counter()
+    for uid in app.get_subscribed_user_ids():
+        rows = app.fetch_assignments(uid, until_date=today)
+        if rows:
+            body = "\n".join(["📌 今日までに提出の課題:"] + [f"- {a['title']}（締切 {a['due_date']}）" for a in rows])
+            line.push_message(uid, app.TextSendMessage(text=body))
+    legacy_s = time.perf_counter() - start
+    legacy = (db.round_trips, line.total_calls, legacy_s)
+
+    # 新実装: /assignment_notify
+    db, line = fresh()
+    app = load_app(db, line)
+    start = time.perf_counter()
+    res = app.app.test_client().get("/assignment_notify")
+    new_s = time.perf_counter() - start
+
+    print(f"users={users} assignments={len(assignments)} latency={latency * 1000:.1f}ms/round trip")
+    print(f"legacy   : supabase round trips={legacy[0]:6d} line calls={legacy[1]:6d} wall={legacy[2]:.2f}s")
+    print(f"optimized: supabase round trips={db.round_trips:6d} line calls={line.total_calls:6d} wall={new_s:.2f}s")
+    print("response:", res.get_json())
+
+
+def bench_syllabus(users=5000, latency=0.001):
+    """users は syllabus の行数として使う"""
+    rnd = random.Random(0)
+    subjects = ["経営学", "マーケティング論", "会計学", "簿記原理", "経営戦略論", "ミクロ経済学",
+                "統計学", "英語（初級）", "中国語", "情報処理", "組織論", "ファイナンス"]
+    teachers = ["山田太郎", "佐藤花子", "鈴木一郎", "田中美咲", "高橋健", "伊藤直子"]
+    rows = []
+    for i in range(users):
+        name = f"{rnd.choice(subjects)}{rnd.choice(['', 'Ⅰ', 'Ⅱ', 'A', 'B'])} {rnd.choice(teachers)}"
+        rows.append({"subject_teacher": name, "units": "2", "grade_year": "1", "semester": "春",
+                     "campus": "和泉", "evaluation": "試験", "category": "専門"})
+    queries = ["マーケティング論", "まーけてぃんぐ", "ｍａｒｋｅｔｉｎｇ", "簿記原理 山田太郎", "山田太郎",
+               "経営戦略", "統計学Ⅱ", "おはよう", "図書館の開館時間は？", "佐藤"]
+
+    db = fake_backends.FakeSupabase({"syllabus": rows}, latency=latency)
+    app = load_app(db, fake_backends.FakeLineBotApi())
+
+    start = time.perf_counter()
+    legacy_hits = [len(app.search_syllabus_by_name_db(q)) for q in queries]
+    legacy_s = time.perf_counter() - start
+    legacy_trips = db.round_trips
+
+    app.syllabus.refresh()
+    build_trips = db.round_trips - legacy_trips
+    start = time.perf_counter()
+    index_hits = [len(app.search_syllabus_by_name(q)) for q in queries]
+    index_s = time.perf_counter() - start
+
+    print(f"syllabus rows={users} queries={len(queries)} latency={latency * 1000:.1f}ms/round trip")
+    print(f"postgrest: {legacy_s / len(queries) * 1000:8.3f} ms/query round trips={legacy_trips} hits={legacy_hits}")
+    print(f"n-gram   : {index_s / len(queries) * 1000:8.3f} ms/query round trips=0 hits={index_hits}"
+          f" (build {app.syllabus.stats()['last_build_ms']} ms, {build_trips} round trips)")
+
+
+def bench_advice_prompt(users=10000, latency=0.001):
+    """
+    users 人分の成績サンプルで、従来（3重送信）と新しいアドバイス用プロンプトを比較する。
+    トークン数は全員分、応答時間は先頭 20 人分を FakeOpenAI（入力トークン比例の TTFT）で測る。
+    """
+    import advice_prompt
+    import pdf_reader
+
+    rnd = random.Random(0)
+    curriculum = [
+        {"faculty": "経営学部", "department": "経営学科", "category_group": f"{i:02d}", "category": cat, "required_units": req}
+        for i, (cat, req) in enumerate(pdf_reader.UNIT_REQUIREMENTS.items())
+    ]
+    users_rows, grades_rows = [], []
+    for i in range(users):
+        results = {cat: (max(0, req + rnd.randint(-req, 6)), req) for cat, req in pdf_reader.UNIT_REQUIREMENTS.items()}
+        foreign = {cat: (rnd.choice([0, 2, req]), req) for cat, req in pdf_reader.FOREIGN_LANG_REQ.items()}
+        text = pdf_reader.analyze_results(results, foreign, sum(o for o, _ in results.values()))
+        grades = [{"category": c, "earned": o, "required": r} for c, (o, r) in results.items()]
+        grades += [{"category": f"外国語必修内訳_{c}", "earned": o, "required": r} for c, (o, r) in foreign.items()]
+        users_rows.append({"line_user_id": _user_id(i), "faculty": "経営学部", "department": "経営学科"})
+        grades_rows.append({"user_id": _user_id(i), "content": text, "raw_data": grades, "created_at": "2025-04-01"})
+
+    db = fake_backends.FakeSupabase(
+        {"users": users_rows, "grades_text": grades_rows, "curriculum_docs": curriculum}, latency=latency
+    )
+    llm = fake_backends.FakeOpenAI(reply="履修の優先順位は次のとおりです。" * 10,
+                                   first_token_latency=0.05, per_input_token=0.0005, per_chunk=0.001)
+    app = load_app(db, fake_backends.FakeLineBotApi())
+    app.client = llm
+
+    def legacy_messages(uid):
+        grades_text, grades_list = app.fetch_saved_grades(uid)
+        content = advice_prompt.build_legacy_content(grades_text, app.compare_grades_with_requirements(uid), grades_list)
+        return [{"role": "system", "content": app.ADVICE_SYSTEM_PROMPT}, {"role": "user", "content": content}]
+
+    def new_messages(uid):
+        grades_text, grades_list = app.fetch_saved_grades(uid)
+        content = advice_prompt.build_advice_content(
+            grades_text, grades_list, app.fetch_requirements_for_user(uid), max_tokens=app.ADVICE_PROMPT_TOKENS
+        )
+        return [{"role": "system", "content": app.ADVICE_SYSTEM_PROMPT}, {"role": "user", "content": content}]
+
+    uids = [_user_id(i) for i in range(users)]
+    print(f"advice prompt: users={users} token budget={app.ADVICE_PROMPT_TOKENS}"
+          f" counter={'tiktoken' if advice_prompt.tiktoken else 'estimate'}")
+    for label, build in (("legacy", legacy_messages), ("compact", new_messages)):
+        start = time.perf_counter()
+        tokens = sorted(advice_prompt.count_message_tokens(build(uid)) for uid in uids)
+        build_ms = (time.perf_counter() - start) / len(uids) * 1000
+        sample = uids[:20]
+        app.llm_deadline = app.deadline_runner.DeadlineRunner()
+        start = time.perf_counter()
+        for uid in sample:
+            app.call_openai_chat(build(uid), model=app.ADVICE_MODEL)
+        call_ms = (time.perf_counter() - start) / len(sample) * 1000
+        ttft = app.llm_deadline.stats()["ttft_ms"]
+        print(f"{label:8s}: input tokens avg={sum(tokens) / len(tokens):6.1f} p50={tokens[len(tokens) // 2]:4d}"
+              f" max={tokens[-1]:4d} build={build_ms:6.3f} ms/user"
+              f" fake TTFT p50={ttft['p50']} ms call={call_ms:6.1f} ms")
+    print("example compact prompt:")
+    print(new_messages(uids[0])[1]["content"])
+
+
+def _cid_hex(text):
+    return "".join(f"{ord(c):04X}" for c in text)
+
+
+def write_transcript_pdf(path, pages=10, status_page=None, seed=0):
+    """
+    ベンチマーク用の成績通知書 PDF を作る（フォント埋め込みなし・ToUnicode 付きの CID フォントで日本語を書く）。
+    status_page（既定は最終ページ）に単位修得状況表と備考欄、それ以外のページに科目一覧を置く。
+    """
+    rnd = random.Random(seed)
+    status_page = pages - 1 if status_page is None else status_page
+    subjects = ["マーケティング論", "簿記原理", "経営戦略論", "統計学", "英語（初級）", "組織論", "ミクロ経済学", "会計学"]
+
+    def course_lines():
+        lines = [(40, "科目一覧")]
+        for i in range(60):
+            lines.append((60 + i * 12, f"{rnd.choice([2022, 2023, 2024])} {rnd.choice(['春', '秋'])} {rnd.choice(subjects)}"
+                                       f" {rnd.choice([1, 2, 4])} {rnd.choice('SABC')} 教員{rnd.randint(1, 99)}"))
+        return lines
+
+    def status_lines():
+        lines = [(40, "単位修得状況"), (60, "区分 必要 25 24 23 22 計")]
+        top = 80
+        for cat, req in [("学部必修科目区分", 12), ("教養科目区分", 24), ("外国語科目区分", 16), ("体育実技科目区分", 2),
+                         ("経営学科基礎専門科目", 14), ("経営学科専門科目", 32)]:
+            lines.append((top, f"{cat} {req} 2 4 4 2 {req - 2}"))
+            top += 14
+        for cat, units in [("他学科専門科目", 4), ("全学共通総合講座", 2), ("演習科目（演習Ⅰ）", 2)]:
+            lines.append((top, f"{cat} {units}"))
+            top += 14
+        lines.append((top, "合 計 124 30 32 28 14 104"))
+        lines += [(440, "備考"), (460, "英語（初級） 4 4"), (474, "初習外国語 8 6"), (488, "その他外国語科目 4 2")]
+        return lines
+
+    page_lines = [status_lines() if i == status_page else course_lines() for i in range(pages)]
+    objs = []
+
+    def add(body):
+        objs.append(body)
+        return len(objs)
+
+    # CID = Unicode のコードポイント。使う文字だけ ToUnicode に載せる
+    used = sorted({ord(c) for lines in page_lines for _, t in lines for c in t})
+    bfchar = "".join(
+        f"{len(used[i:i + 100])} beginbfchar\n" + "".join(f"<{u:04X}> <{u:04X}>\n" for u in used[i:i + 100]) + "endbfchar\n"
+        for i in range(0, len(used), 100)
+    )
+    cmap = ("/CIDInit /ProcSet findresource begin 12 dict begin begincmap /CMapName /UCS def /CMapType 2 def\n"
+            "1 begincodespacerange <0000> <FFFF> endcodespacerange\n"
+            + bfchar + "endcmap CMapName currentdict /CMap defineresource pop end end")
+    to_unicode = add(f"<< /Length {len(cmap.encode())} >>\nstream\n{cmap}\nendstream")
+    descriptor = add("<< /Type /FontDescriptor /FontName /HeiseiKakuGo-W5 /Flags 4 /FontBBox [0 -120 1000 880]"
+                     " /ItalicAngle 0 /Ascent 880 /Descent -120 /CapHeight 700 /StemV 80 >>")
+    cid_font = add("<< /Type /Font /Subtype /CIDFontType2 /BaseFont /HeiseiKakuGo-W5 /CIDSystemInfo"
+                   f" << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> /FontDescriptor {descriptor} 0 R /DW 1000 >>")
+    font = add(f"<< /Type /Font /Subtype /Type0 /BaseFont /HeiseiKakuGo-W5 /Encoding /Identity-H"
+               f" /DescendantFonts [{cid_font} 0 R] /ToUnicode {to_unicode} 0 R >>")
+    pages_id = len(objs) + 1 + 2 * pages
+    kids = []
+    for lines in page_lines:
+        ops = "".join(f"BT /F1 9 Tf 40 {842 - top - 9:.1f} Td <{_cid_hex(t)}> Tj ET\n" for top, t in lines)
+        contents = add(f"<< /Length {len(ops.encode())} >>\nstream\n{ops}endstream")
+        kids.append(add(f"<< /Type /Page /Parent {pages_id} 0 R /MediaBox [0 0 595 842]"
+                        f" /Resources << /Font << /F1 {font} 0 R >> >> /Contents {contents} 0 R >>"))
+    add(f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}] /Count {pages} >>")
+    root = add(f"<< /Type /Catalog /Pages {pages_id} 0 R >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode()
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root {root} 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def bench_pdf_rows(users=10000, latency=0.001):
+    """
+    users は成績 PDF のページ数として使う（上限 200）。
+    抽出済みの行に対する従来の4パス（＋表範囲の2回計算）と、行モデル＋1パスの所要時間を比べる。
+    """
+    import tempfile
+    import pdfplumber
+    import pdf_reader
+
+    pages = max(1, min(users, 200))
+    path = os.path.join(tempfile.mkdtemp(), "transcript.pdf")
+    write_transcript_pdf(path, pages=pages)
+    start = time.perf_counter()
+    with pdfplumber.open(path) as pdf:
+        all_rows = []
+        for page in pdf.pages:
+            all_rows.extend(pdf_reader.extract_rows_from_page(page))
+    extract_s = time.perf_counter() - start
+
+    def legacy():
+        total = pdf_reader.find_total_from_summary_row(all_rows)
+        results = pdf_reader.extract_from_status_table(all_rows)
+        free_total = pdf_reader.extract_free_electives(all_rows)
+        foreign = pdf_reader.extract_foreign_details(all_rows)
+        return results, free_total, foreign, total
+
+    def single_pass():
+        model = pdf_reader.build_row_model(all_rows)
+        return pdf_reader.extract_all(model, pdf_reader.find_status_table_bounds_model(model))
+
+    assert legacy() == single_pass(), "single-pass extraction differs from the legacy extractors"
+    repeat = 20
+    timings = {}
+    for label, fn in (("legacy", legacy), ("single-pass", single_pass)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        timings[label] = (time.perf_counter() - start) / repeat * 1000
+
+    print(f"transcript pages={pages} rows={len(all_rows)} word extraction={extract_s * 1000:.0f} ms")
+    for label, ms in timings.items():
+        print(f"{label:12s}: {ms:8.2f} ms/parse")
+    print(f"speedup    : {timings['legacy'] / timings['single-pass']:.1f}x (row stage only)")
+
+
+def bench_pdf_upload(users=10000, latency=0.001):
+    """
+    users は成績 PDF のページ数として使う（上限 200）。
+    従来（全ページの単語抽出・ページを開いたまま）と、下見したページだけ抽出して早期終了する方式の
+    1アップロードあたりの時間と Python ヒープのピーク（tracemalloc）を比べる。表は先頭ページと最終ページの2通り。
+    """
+    import tempfile
+    import tracemalloc
+    import pdfplumber
+    import pdf_reader
+
+    pages = max(1, min(users, 200))
+
+    def legacy(path):
+        with pdfplumber.open(path) as pdf:
+            all_rows = []
+            for page in pdf.pages:
+                all_rows.extend(pdf_reader.extract_rows_from_page(page))
+            model = pdf_reader.build_row_model(all_rows)
+            return pdf_reader.extract_all(model, pdf_reader.find_status_table_bounds_model(model))
+
+    def targeted(path):
+        results, foreign, total = pdf_reader.parse_units_advanced(path)
+        return results, foreign, total
+
+    def measure(fn, path):
+        # 時間とメモリは別々に測る（tracemalloc 中は遅くなるため）
+        start = time.perf_counter()
+        out = fn(path)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        fn(path)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return out, elapsed * 1000, peak / 1024 / 1024
+
+    print(f"transcript pages={pages}")
+    for where, status_page in (("first", 0), ("last", pages - 1)):
+        path = os.path.join(tempfile.mkdtemp(), "transcript.pdf")
+        write_transcript_pdf(path, pages=pages, status_page=status_page)
+        _, legacy_ms, legacy_mb = measure(legacy, path)
+        (_, foreign, total), new_ms, new_mb = measure(targeted, path)
+        print(f"status table on {where:5s} page: legacy {legacy_ms:8.0f} ms {legacy_mb:7.1f} MiB peak"
+              f" | targeted {new_ms:7.0f} ms {new_mb:6.1f} MiB peak | total={total} foreign={foreign}")
+
+
+BENCHMARKS = {
+    "assignment_notify": bench_assignment_notify,
+    "syllabus": bench_syllabus,
+    "advice_prompt": bench_advice_prompt,
+    "pdf_rows": bench_pdf_rows,
+    "pdf_upload": bench_pdf_upload,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.001, help="1往復あたりの擬似遅延（秒）")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](users=args.users, latency=args.latency)
@@ -0,0 +1,67 @@
+# calendar_cache.py — academic_calendar をメモリに持ち、日付範囲を二分探索で返す
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+
+class CalendarCache:
+    """
+    loader() が返す予定（date 昇順、date は "YYYY-MM-DD"）を保持する。
+    初回参照時と ttl 秒経過後に読み直す。invalidate() で次回参照時に強制再読込。
+    version()（refresh_stamp.RefreshStamp.version など）の値が変わったときも読み直す。
+    """
+
+    def __init__(self, loader, ttl=3600, version=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = version
+        self._built_version = None
+        self._events = None
+        self._dates = []
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"loads": 0, "queries": 0, "last_load_ms": 0.0}
+
+    def _build(self):
+        start = time.perf_counter()
+        built_version = self.version() if self.version else None
+        events = sorted(self.loader(), key=lambda e: str(e.get("date") or ""))
+        self._events = events
+        self._dates = [str(e.get("date") or "")[:10] for e in events]
+        self._built_version = built_version
+        self._loaded_at = time.monotonic()
+        self._stats["loads"] += 1
+        self._stats["last_load_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    def between(self, start_date, end_date):
+        """start_date〜end_date（両端含む）の予定を date 昇順で返す"""
+        with self._lock:
+            if (
+                self._events is None
+                or time.monotonic() - self._loaded_at > self.ttl
+                or (self.version and self.version() != self._built_version)
+            ):
+                self._build()
+            self._stats["queries"] += 1
+            events, dates = self._events, self._dates
+        lo = bisect_left(dates, start_date.isoformat())
+        hi = bisect_right(dates, end_date.isoformat())
+        return events[lo:hi]
+
+    def invalidate(self):
+        with self._lock:
+            self._events = None
+
+    def refresh(self):
+        with self._lock:
+            self._build()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["loaded"] = self._events is not None
+            s["events"] = len(self._events) if self._events is not None else 0
+            s["age_s"] = round(time.monotonic() - self._loaded_at, 1) if self._events is not None else None
+            s["first_date"] = self._dates[0] if self._events else None
+            s["last_date"] = self._dates[-1] if self._events else None
+        return s
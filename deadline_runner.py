@@ -0,0 +1,136 @@
+# deadline_runner.py — 応答時間の上限（budget）付きで処理を実行し、超えたら後から結果を届ける
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from log_util import debug_log
+
+
+class Saturated(Exception):
+    """実行中＋待ちの件数が上限に達している（投入せずにすぐ返す）"""
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+class DeadlineRunner:
+    """
+    fn() を別スレッドで実行し、budget 秒以内に終われば (True, 結果) を返す。
+    超えた場合は (False, None) をすぐに返し、完了後に on_late(結果) を呼ぶ
+    （fn が例外を出した場合は on_late(None)）。
+    budget 内に出た例外は呼び出し元にそのまま投げ直す。
+    実行中＋待ちが workers + max_pending 件に達していれば投入せずに Saturated を投げる。
+    OpenAI の最初のトークンまでの時間（TTFT）もここに記録する。
+    """
+
+    def __init__(self, budget=8.0, workers=8, max_pending=8, samples=500):
+        self.budget = budget
+        self.workers = max(1, int(workers))
+        self.max_pending = max(0, int(max_pending))
+        self._pending = 0
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._ttft = deque(maxlen=samples)
+        self._elapsed = deque(maxlen=samples)
+        self._stats = {
+            "calls": 0,
+            "within_budget": 0,
+            "budget_exceeded": 0,
+            "late_delivered": 0,
+            "late_failed": 0,
+            "saturated": 0,
+        }
+
+    def _executor(self):
+        # fork 後のプロセスでは作り直す
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="deadline")
+                self._pid = os.getpid()
+                self._pending = 0
+            return self._pool
+
+    def _incr(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def run(self, fn, on_late, budget=None):
+        budget = self.budget if budget is None else budget
+        start = time.perf_counter()
+        executor = self._executor()
+        with self._lock:
+            if self._pending >= self.workers + self.max_pending:
+                self._stats["saturated"] += 1
+                raise Saturated(f"{self._pending} tasks pending")
+            self._pending += 1
+            self._stats["calls"] += 1
+        future = executor.submit(fn)
+        future.add_done_callback(self._done)
+        try:
+            value = future.result(timeout=budget)
+        except FutureTimeout:
+            self._incr("budget_exceeded")
+            debug_log(f"deadline exceeded ({budget}s), delivering later")
+            future.add_done_callback(lambda f: self._deliver_late(f, on_late, start))
+            return False, None
+        self._incr("within_budget")
+        self._record_elapsed(start)
+        return True, value
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _deliver_late(self, future, on_late, start):
+        self._record_elapsed(start)
+        exc = future.exception()
+        if exc is not None:
+            debug_log("deadline task error:", exc)
+            self._incr("late_failed")
+            value = None
+        else:
+            value = future.result()
+        try:
+            on_late(value)
+            if exc is None:
+                self._incr("late_delivered")
+        except Exception as e:
+            debug_log("deadline late delivery error:", e)
+            if exc is None:
+                self._incr("late_failed")
+
+    def _record_elapsed(self, start):
+        with self._lock:
+            self._elapsed.append((time.perf_counter() - start) * 1000)
+
+    def record_ttft(self, seconds):
+        with self._lock:
+            self._ttft.append(seconds * 1000)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["pending"] = self._pending
+            ttft = sorted(self._ttft)
+            elapsed = sorted(self._elapsed)
+        s["budget_s"] = self.budget
+        s["max_pending"] = self.workers + self.max_pending
+        s["exceeded_rate"] = round(s["budget_exceeded"] / s["calls"], 3) if s["calls"] else 0.0
+        s["ttft_ms"] = {
+            "samples": len(ttft),
+            "p50": round(_percentile(ttft, 0.5), 1) if ttft else None,
+            "p95": round(_percentile(ttft, 0.95), 1) if ttft else None,
+        }
+        s["elapsed_ms"] = {
+            "samples": len(elapsed),
+            "p50": round(_percentile(elapsed, 0.5), 1) if elapsed else None,
+            "p95": round(_percentile(elapsed, 0.95), 1) if elapsed else None,
+        }
+        return s
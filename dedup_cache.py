@@ -0,0 +1,132 @@
+# dedup_cache.py — LINE の再送 Webhook を webhookEventId で重複排除する
+import threading
+import time
+from collections import OrderedDict
+
+import local_sqlite
+
+
+class MemoryDedupBackend:
+    """プロセス内の TTL 付き LRU（ワーカー1つ向け）"""
+
+    def __init__(self, ttl=3600, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, event_id):
+        """未処理なら記録して True、処理済み（TTL 内）なら False"""
+        now = time.time()
+        with self._lock:
+            seen_at = self._data.get(event_id)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self._data.move_to_end(event_id)
+                return False
+            self._data[event_id] = now
+            self._data.move_to_end(event_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            return True
+
+    def release(self, event_id):
+        """処理に失敗した記録を消す（再送を処理し直せるように）"""
+        with self._lock:
+            self._data.pop(event_id, None)
+
+    def size(self):
+        with self._lock:
+            return len(self._data)
+
+
+class SQLiteDedupBackend:
+    """ローカル SQLite ファイルを使う実装（同一ホストの gunicorn ワーカー間で共有）"""
+
+    def __init__(self, path, ttl=3600, purge_every=500):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._conn = local_sqlite.LocalConnection(path)
+        self._claims = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_events (event_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_seen_at ON webhook_events (seen_at)")
+
+    def claim(self, event_id):
+        now = time.time()
+        conn = self._conn()
+        self._claims += 1
+        if self._claims % self.purge_every == 0:
+            conn.execute("DELETE FROM webhook_events WHERE seen_at < ?", (now - self.ttl,))
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO webhook_events (event_id, seen_at) VALUES (?, ?)", (event_id, now)
+        )
+        if cur.rowcount == 1:
+            return True
+        # TTL 切れの古い記録なら取り直す
+        cur = conn.execute(
+            "UPDATE webhook_events SET seen_at = ? WHERE event_id = ? AND seen_at < ?",
+            (now, event_id, now - self.ttl),
+        )
+        return cur.rowcount == 1
+
+    def release(self, event_id):
+        self._conn().execute("DELETE FROM webhook_events WHERE event_id = ?", (event_id,))
+
+    def size(self):
+        return self._conn().execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0]
+
+
+class EventDeduplicator:
+    """
+    処理前に webhookEventId を記録し、再送（isRedelivery=true）で既に記録済みのものを弾く。
+    初回配信は重複しえないので必ず処理し、後の再送に備えて記録だけ行う。
+    処理に失敗したら release で記録を消し、LINE の再送を処理し直す。
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._stats = {"first_delivery": 0, "redelivery": 0, "hits": 0, "misses": 0, "no_id": 0, "released": 0}
+
+    def should_process(self, event):
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id:
+            self._incr("no_id")
+            return True
+        ctx = getattr(event, "delivery_context", None)
+        is_redelivery = bool(getattr(ctx, "is_redelivery", False))
+        claimed = self.backend.claim(event_id)
+        if not is_redelivery:
+            self._incr("first_delivery")
+            return True
+        self._incr("redelivery")
+        self._incr("misses" if claimed else "hits")
+        return claimed
+
+    def release(self, event):
+        event_id = getattr(event, "webhook_event_id", None)
+        if event_id:
+            self.backend.release(event_id)
+            self._incr("released")
+
+    def _incr(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        s["size"] = self.backend.size()
+        return s
+
+
+def create_deduplicator(kind="memory", path="webhook_dedup.sqlite3", ttl=3600, max_size=10000):
+    """kind: memory / sqlite / off（off なら None）"""
+    if kind == "off":
+        return None
+    if kind == "sqlite":
+        return EventDeduplicator(SQLiteDedupBackend(path, ttl=ttl))
+    return EventDeduplicator(MemoryDedupBackend(ttl=ttl, max_size=max_size))
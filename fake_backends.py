@@ -0,0 +1,247 @@
+# fake_backends.py — ベンチマーク・負荷試験用のローカル代替（Supabase / LINE / OpenAI）
+import random
+import threading
+import time
+
+
+class FakeBackendError(Exception):
+    """error_rate で注入される擬似障害"""
+
+
+class _Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _Faults:
+    """latency（＋0〜jitter 秒の揺らぎ）の遅延と、error_rate の確率での例外を注入する"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.errors = 0
+        self._rnd = random.Random(seed)
+        self._faults_lock = threading.Lock()
+
+    def _inject(self, name):
+        delay = self.latency + (self._rnd.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        if self.error_rate:
+            with self._faults_lock:
+                fail = self._rnd.random() < self.error_rate
+                if fail:
+                    self.errors += 1
+            if fail:
+                raise FakeBackendError(f"injected {name} error")
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """supabase-py のクエリビルダのうち app.py が使う部分だけを真似る"""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table_name = table
+        self.filters = []
+        self.orders = []
+        self.limit_n = None
+        self.range_ = None
+        self.op = "select"
+        self.payload = None
+
+    # ---- 取得系 ----
+    def select(self, *cols, **kwargs):
+        self.op = "select"
+        return self
+
+    def eq(self, col, value):
+        self.filters.append(lambda r: r.get(col) == value)
+        return self
+
+    def in_(self, col, values):
+        values = set(values)
+        self.filters.append(lambda r: r.get(col) in values)
+        return self
+
+    def lte(self, col, value):
+        self.filters.append(lambda r: r.get(col) is not None and r.get(col) <= value)
+        return self
+
+    def gt(self, col, value):
+        self.filters.append(lambda r: r.get(col) is not None and r.get(col) > value)
+        return self
+
+    def gte(self, col, value):
+        self.filters.append(lambda r: r.get(col) is not None and r.get(col) >= value)
+        return self
+
+    def ilike(self, col, pattern):
+        needle = pattern.strip("%").lower()
+        self.filters.append(lambda r: needle in str(r.get(col) or "").lower())
+        return self
+
+    def order(self, col, desc=False):
+        self.orders.append((col, desc))
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def range(self, start, end):
+        self.range_ = (start, end)
+        return self
+
+    # ---- 書き込み系 ----
+    def insert(self, rows):
+        self.op = "insert"
+        self.payload = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def upsert(self, rows, on_conflict=None):
+        self.op = "upsert"
+        self.payload = rows if isinstance(rows, list) else [rows]
+        self.on_conflict = on_conflict
+        return self
+
+    def execute(self):
+        return self.db._execute(self)
+
+
+class FakeSupabase(_Faults):
+    """
+    テーブルを dict のリストで持つインメモリ Supabase。
+    execute() 1回を1往復として数え、latency 秒の遅延と error_rate の確率での失敗を入れられる。
+    max_rows は PostgREST の既定行数上限（超えた分は黙って切り捨て）を再現する。
+    """
+
+    def __init__(self, tables=None, latency=0.0, max_rows=1000, primary_keys=None, jitter=0.0, error_rate=0.0, seed=None):
+        _Faults.__init__(self, latency, jitter, error_rate, seed)
+        self.tables = {k: list(v) for k, v in (tables or {}).items()}
+        self.max_rows = max_rows
+        self.primary_keys = primary_keys or {"subscribers": "user_id", "users": "line_user_id"}
+        self.round_trips = 0
+        self.rows_returned = 0
+        self._lock = threading.Lock()
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def _execute(self, q):
+        self._inject("supabase")
+        with self._lock:
+            self.round_trips += 1
+            rows = self.tables.setdefault(q.table_name, [])
+            if q.op == "insert":
+                rows.extend(dict(r) for r in q.payload)
+                return FakeResponse(q.payload)
+            if q.op == "upsert":
+                key = getattr(q, "on_conflict", None) or self.primary_keys.get(q.table_name)
+                for r in q.payload:
+                    existing = next((x for x in rows if key and x.get(key) == r.get(key)), None)
+                    if existing is not None:
+                        existing.update(r)
+                    else:
+                        rows.append(dict(r))
+                return FakeResponse(q.payload)
+
+            out = [r for r in rows if all(f(r) for f in q.filters)]
+            for col, desc in reversed(q.orders):
+                out.sort(key=lambda r: (r.get(col) is None, r.get(col)), reverse=desc)
+            if q.range_:
+                out = out[q.range_[0]:q.range_[1] + 1]
+            if q.limit_n is not None:
+                out = out[:q.limit_n]
+            if self.max_rows:
+                out = out[:self.max_rows]
+            self.rows_returned += len(out)
+            return FakeResponse([dict(r) for r in out])
+
+
+class FakeLineBotApi(_Faults):
+    """
+    LineBotApi の送信系を記録だけするスタブ。
+    get_message_content はファイルメッセージの中身として content（既定は空の PDF）を返す。
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None, content=b"%PDF-1.4\n%%EOF\n"):
+        _Faults.__init__(self, latency, jitter, error_rate, seed)
+        self.content = content
+        self.calls = {"reply_message": 0, "push_message": 0, "multicast": 0, "get_message_content": 0}
+        self.recipients = 0
+        self._lock = threading.Lock()
+
+    def _record(self, kind, n):
+        self._inject("line")
+        with self._lock:
+            self.calls[kind] += 1
+            self.recipients += n
+
+    def reply_message(self, reply_token, messages, *args, **kwargs):
+        self._record("reply_message", 1)
+
+    def push_message(self, to, messages, *args, **kwargs):
+        self._record("push_message", 1)
+
+    def multicast(self, to, messages, *args, **kwargs):
+        if len(to) > 500:
+            raise ValueError("multicast accepts at most 500 recipients")
+        self._record("multicast", len(to))
+
+    def get_message_content(self, message_id, *args, **kwargs):
+        self._record("get_message_content", 0)
+        content = self.content
+        return _Obj(iter_content=lambda chunk_size=1024: (content[i:i + chunk_size] for i in range(0, len(content), chunk_size)))
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class FakeOpenAI(_Faults):
+    """
+    OpenAI クライアントの chat.completions.create だけを真似る。
+    最初のトークンまで first_token_latency + 入力トークン数 × per_input_token 秒、
+    以降は出力チャンクごとに per_chunk 秒かかる（入力が長いほど TTFT が伸びるのを再現）。
+    error_rate の確率で呼び出しが失敗する（429 などの代わり）。
+    """
+
+    def __init__(self, reply="了解しました。", first_token_latency=0.0, per_input_token=0.0, per_chunk=0.0, chunk_chars=8,
+                 jitter=0.0, error_rate=0.0, seed=None):
+        _Faults.__init__(self, 0.0, jitter, error_rate, seed)
+        self.reply = reply
+        self.first_token_latency = first_token_latency
+        self.per_input_token = per_input_token
+        self.per_chunk = per_chunk
+        self.chunk_chars = chunk_chars
+        self.calls = 0
+        self.input_tokens = 0
+        self._lock = threading.Lock()
+        self.chat = _Obj(completions=_Obj(create=self.create))
+
+    def create(self, model=None, messages=None, stream=False, **kwargs):
+        import advice_prompt
+        tokens = advice_prompt.count_message_tokens(messages or [])
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += tokens
+        self._inject("openai")
+        delay = self.first_token_latency + tokens * self.per_input_token
+        chunks = [self.reply[i:i + self.chunk_chars] for i in range(0, len(self.reply), self.chunk_chars)]
+        if not stream:
+            time.sleep(delay + self.per_chunk * len(chunks))
+            return _Obj(choices=[_Obj(message=_Obj(content=self.reply))])
+
+        def _gen():
+            time.sleep(delay)
+            for i, c in enumerate(chunks):
+                if i:
+                    time.sleep(self.per_chunk)
+                yield _Obj(choices=[_Obj(delta=_Obj(content=c))])
+        return _gen()
@@ -1,4 +1,5 @@
 import pandas as pd
+import urllib.request
 from supabase import create_client, Client
 import os
 
@@ -44,3 +45,11 @@ for i in range(0, len(df), chunk_size):
     chunk = df.iloc[i:i+chunk_size].to_dict(orient="records")
     res = supabase.table("syllabus").upsert(chunk).execute()
     print(f"✅ {i+1}〜{i+len(chunk)} 件目をインポート完了")
+
+# 稼働中の Bot のシラバス索引を作り直す（SYLLABUS_REFRESH_URL 例: https://xxx/syllabus_refresh）
+refresh_url = os.getenv("SYLLABUS_REFRESH_URL")
+if refresh_url:
+    req = urllib.request.Request(refresh_url, data=b"", method="POST",
+                                 headers={"X-Notify-Token": os.getenv("NOTIFY_SECRET", "")})
+    with urllib.request.urlopen(req, timeout=60) as res:
+        print("🔄 シラバス索引の再構築:", res.status, res.read().decode("utf-8"))
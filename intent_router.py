@@ -0,0 +1,175 @@
+# intent_router.py — テキストメッセージの意図判定（キーワード表を起動時に1回だけコンパイル）
+from collections import deque, namedtuple
+
+# 完全一致コマンド（リッチメニュー等）: 元テキスト → 意図
+EXACT_COMMANDS = {
+    "使い方ガイド": "guide",
+    "出席ランキング": "attendance_ranking",
+    "年間行事予定": "annual_schedule",
+    "プロフィール登録": "profile_register",
+    "授業登録": "class_register",
+    "課題登録": "assignment_register",
+}
+
+# キーワード意図（上にあるものほど優先）
+INTENT_TABLE = [
+    ("easy_class", ["楽単", "ラク単", "らくたん", "easy class"]),
+    ("subscribe", ["通知登録", "配信登録", "通知を受け取る", "subscribe", "登録する"]),
+    ("unsubscribe", ["通知停止", "配信停止", "unsubscribe", "停止する"]),
+    ("calendar", ["予定", "スケジュール", "今日の予定", "明日の予定", "今月の予定", "calendar", "予定表"]),
+    ("curriculum", ["履修条件", "卒業要件", "必要単位", "カリキュラム"]),
+    ("advice", ["アドバイス", "助言", "advice"]),
+    ("grades", ["成績", "単位", "成績確認"]),
+    ("office", ["事務室", "連絡先", "電話番号", "電話"]),
+]
+
+# 学部判定（簡易）
+DEPT_KEYWORDS = {
+    "経営": ["経営", "経営学部"],
+    "商学": ["商学", "商学部"],
+    "法学": ["法学", "法学部"],
+}
+
+Route = namedtuple("Route", ["intent", "intents", "dept", "text"])
+
+
+class KeywordMatcher:
+    """Aho-Corasick 法による複数キーワードの一括検索"""
+
+    def __init__(self, patterns):
+        # patterns: [(keyword, value), ...]
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for keyword, value in patterns:
+            node = 0
+            for ch in keyword:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(value)
+
+        # 失敗遷移を BFS で構築
+        q = deque(self.goto[0].values())
+        while q:
+            node = q.popleft()
+            for ch, nxt in self.goto[node].items():
+                q.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find_all(self, text):
+        """text に含まれるキーワードの value を集合で返す（1パス）"""
+        found = set()
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+
+def _compile():
+    patterns = []
+    for priority, (intent, keywords) in enumerate(INTENT_TABLE):
+        for k in keywords:
+            patterns.append((k.lower(), ("intent", priority, intent)))
+    for priority, (dept, variants) in enumerate(DEPT_KEYWORDS.items()):
+        for v in variants:
+            patterns.append((v.lower(), ("dept", priority, dept)))
+    return KeywordMatcher(patterns)
+
+
+_MATCHER = _compile()
+
+
+def match_exact(text_raw):
+    """完全一致コマンドの意図（無ければ None）"""
+    return EXACT_COMMANDS.get(text_raw)
+
+
+def classify(text):
+    """
+    正規化済みテキストを1パスで走査し、最優先の意図と学部を返す。
+    どの意図にも当たらなければ intent は None（シラバス検索→雑談へ）。
+    """
+    intents = []
+    depts = []
+    for kind, priority, label in _MATCHER.find_all(text):
+        if kind == "intent":
+            intents.append((priority, label))
+        else:
+            depts.append((priority, label))
+    intents.sort()
+    depts.sort()
+    return Route(
+        intent=intents[0][1] if intents else None,
+        intents=frozenset(label for _, label in intents),
+        dept=depts[0][1] if depts else None,
+        text=text,
+    )
+
+
+# ---- ベンチマーク ----
+SAMPLE_MESSAGES = [
+    "今日の予定", "明日の予定", "今月の予定", "予定 2025-09", "来週のスケジュール教えて",
+    "アドバイスください", "履修のアドバイスがほしい", "成績確認", "単位足りてる？", "成績",
+    "経営学部の事務室の電話番号", "商学部 連絡先", "事務室", "楽単ある？", "ラク単教えて",
+    "通知登録", "通知停止", "配信登録したい", "卒業要件を知りたい", "必要単位は？",
+    "マーケティング論", "経営戦略論 シラバス", "簿記原理を教えて", "山田先生の授業",
+    "図書館の開館時間は？", "履修登録はいつ？", "おはよう", "テスト期間っていつから？",
+    "ゼミの選び方を教えてください", "サークルのおすすめある？", "advice please", "calendar",
+]
+
+
+def _classify_linear(text):
+    """旧実装相当の線形スキャン（比較用）"""
+    flags = {intent: any(k.lower() in text for k in keywords) for intent, keywords in INTENT_TABLE}
+    dept = None
+    for key, variants in DEPT_KEYWORDS.items():
+        if any(v.lower() in text for v in variants):
+            dept = key
+            break
+    intent = next((i for i, _ in INTENT_TABLE if flags[i]), None)
+    return intent, dept
+
+
+def benchmark(rounds=2000):
+    import time
+
+    corpus = [m.strip().lower() for m in SAMPLE_MESSAGES]
+    for t in corpus:
+        r = classify(t)
+        assert (r.intent, r.dept) == _classify_linear(t), t
+
+    n = rounds * len(corpus)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for t in corpus:
+            _classify_linear(t)
+    linear = (time.perf_counter() - start) / n * 1e6
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for t in corpus:
+            classify(t)
+    compiled = (time.perf_counter() - start) / n * 1e6
+
+    print(f"messages: {len(corpus)} x {rounds} rounds")
+    print(f"linear cascade : {linear:.2f} µs/message")
+    print(f"compiled router: {compiled:.2f} µs/message")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,97 @@
+# job_store.py — バックグラウンドジョブ（/advice_precompute など）の状態をローカル SQLite に保存する
+# 同じホストの gunicorn ワーカー間で共有するので、どのワーカーに来た ?job= でも進み具合を返せ、
+# 別ワーカーで同じ種類のジョブを二重に始めることもない。
+import json
+import time
+
+import local_sqlite
+
+
+class JobStore:
+    """
+    1ジョブ1行 {"job_id", "kind", "state", ...}。state は running / done / error / lost。
+    stale_after 秒更新の無い running は落ちたワーカーのものとみなし lost にする（次のジョブを始められるように）。
+    kind ごとに直近 keep 件だけ残す。
+    """
+
+    def __init__(self, path, keep=20, stale_after=1800):
+        self.path = path
+        self.keep = keep
+        self.stale_after = stale_after
+        self._conn = local_sqlite.LocalConnection(path)
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY, kind TEXT NOT NULL, state TEXT NOT NULL,"
+            " data TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn().execute("CREATE INDEX IF NOT EXISTS idx_jobs_kind ON jobs (kind, state, created_at)")
+
+    @staticmethod
+    def _dump(data):
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+    def start(self, kind, job):
+        """
+        job（job_id を含む dict）を running で登録して (job, True) を返す。
+        同じ kind の running があれば登録せず (そのジョブ, False) を返す。
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")  # 確認と登録の間に他ワーカーが割り込まないように
+        try:
+            conn.execute(
+                "UPDATE jobs SET state = 'lost', updated_at = ? WHERE kind = ? AND state = 'running' AND updated_at < ?",
+                (now, kind, now - self.stale_after),
+            )
+            row = conn.execute(
+                "SELECT data FROM jobs WHERE kind = ? AND state = 'running' ORDER BY created_at DESC LIMIT 1",
+                (kind,),
+            ).fetchone()
+            if row is not None:
+                conn.execute("COMMIT")
+                return json.loads(row[0]), False
+            job = dict(job, state="running")
+            conn.execute(
+                "INSERT INTO jobs (job_id, kind, state, data, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job["job_id"], kind, "running", self._dump(job), now, now),
+            )
+            conn.execute(
+                "DELETE FROM jobs WHERE kind = ? AND state != 'running' AND job_id NOT IN"
+                " (SELECT job_id FROM jobs WHERE kind = ? ORDER BY created_at DESC LIMIT ?)",
+                (kind, kind, self.keep),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job, True
+
+    def update(self, job_id, **fields):
+        """ジョブの項目を書き換える（state も含めてよい）"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT state, data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return
+            job = json.loads(row[1])
+            job.update(fields)
+            state = fields.get("state", row[0])  # lost にされたジョブは進み具合の更新では running に戻さない
+            job["state"] = state
+            conn.execute(
+                "UPDATE jobs SET state = ?, data = ?, updated_at = ? WHERE job_id = ?",
+                (state, self._dump(job), time.time(), job_id),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, job_id):
+        row = self._conn().execute("SELECT state, data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = json.loads(row[1])
+        job["state"] = row[0]  # lost は start で列だけ書き換える
+        return job
@@ -0,0 +1,65 @@
+# last_seen.py — ユーザーの最終アクセス時刻をまとめて書き込む
+import os
+import threading
+
+from log_util import debug_log
+
+
+class LastSeenTracker:
+    """
+    メッセージごとの last_seen 更新をメモリ上で user_id ごとに1件へ畳み込み、
+    interval 秒ごとに flush(rows) で一括 upsert する（opt_in には触れない）。
+    """
+
+    def __init__(self, flush, interval=30.0):
+        self._flush_fn = flush
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stats = {"recorded": 0, "coalesced": 0, "flushes": 0, "rows_flushed": 0}
+
+    def record(self, user_id, seen_at):
+        self._ensure_started()
+        with self._lock:
+            if user_id in self._pending:
+                self._stats["coalesced"] += 1
+            self._pending[user_id] = seen_at
+            self._stats["recorded"] += 1
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        rows = [{"user_id": uid, "last_seen": seen_at} for uid, seen_at in pending.items()]
+        self._flush_fn(rows)
+        with self._lock:
+            self._stats["flushes"] += 1
+            self._stats["rows_flushed"] += len(rows)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="last-seen", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._wake.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                debug_log("last_seen flush error:", e)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["pending"] = len(self._pending)
+        s["interval_s"] = self.interval
+        return s
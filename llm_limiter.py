@@ -0,0 +1,137 @@
+# llm_limiter.py — OpenAI 呼び出しの流量制限（トークンバケット＋同時実行数上限＋優先度付き待ち行列）
+import heapq
+import itertools
+import threading
+import time
+
+# 優先度（小さいほど先に通す）
+PRIORITY_ADVICE = 0   # 成績アップロード済みユーザーのアドバイス
+PRIORITY_CHAT = 1     # 雑談フォールバック
+PRIORITY_BATCH = 2    # 夜間のアドバイス事前生成
+
+
+class Busy(Exception):
+    """待ち行列が深すぎる / 待ち時間の上限を超えた（すぐに「混雑中」を返す）"""
+
+
+class PriorityLimiter:
+    """
+    rate 回/秒（最大 burst 回まで貯められる）のトークンバケットと、
+    同時実行数 max_in_flight の上限を両方満たしたときに1件ずつ通す。
+    待っている間は優先度 → 到着順で並べ、先頭以外は通さない。
+    待ち件数が max_queue 以上なら即 Busy（ただし自分より低い優先度の待ち手がいれば、
+    その最後尾を押し出して代わりに並ぶ）。max_wait 秒待っても通れなければ Busy。
+
+        with limiter.slot(PRIORITY_CHAT):
+            client.chat.completions.create(...)
+    """
+
+    def __init__(self, rate=5.0, burst=10, max_in_flight=8, max_queue=50, max_wait=5.0):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_queue = int(max_queue)
+        self.max_wait = max_wait
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        self._waiting = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._preempted = set()
+        self._stats = {"admitted": 0, "shed_queue_full": 0, "shed_preempted": 0, "shed_timeout": 0,
+                       "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+        self._by_priority = {}
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _count(self, priority, key):
+        p = self._by_priority.setdefault(priority, {"admitted": 0, "shed": 0})
+        p[key] += 1
+
+    def acquire(self, priority=PRIORITY_CHAT):
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                worst = max(self._waiting) if self._waiting else None
+                if worst is None or worst[0] <= priority:
+                    self._stats["shed_queue_full"] += 1
+                    self._count(priority, "shed")
+                    raise Busy("queue full")
+                self._waiting.remove(worst)
+                heapq.heapify(self._waiting)
+                self._preempted.add(worst)
+                self._cond.notify_all()
+            me = (priority, next(self._seq))
+            heapq.heappush(self._waiting, me)
+            try:
+                while True:
+                    if me in self._preempted:
+                        self._preempted.discard(me)
+                        self._stats["shed_preempted"] += 1
+                        self._count(me[0], "shed")
+                        raise Busy("preempted")
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiting[0] == me and self._in_flight < self.max_in_flight and self._tokens >= 1:
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats["shed_timeout"] += 1
+                        self._count(priority, "shed")
+                        raise Busy("wait timeout")
+                    # トークン不足なら次のトークンが貯まるころに起きる
+                    wake = (1 - self._tokens) / self.rate if self._tokens < 1 and self.rate > 0 else remaining
+                    self._cond.wait(min(remaining, max(wake, 0.001)))
+            finally:
+                if me in self._waiting:
+                    self._waiting.remove(me)
+                    heapq.heapify(self._waiting)
+                # 先頭が入れ替わったので他の待ち手を起こす
+                self._cond.notify_all()
+            self._tokens -= 1
+            self._in_flight += 1
+            waited = (time.monotonic() - start) * 1000
+            self._stats["admitted"] += 1
+            self._count(priority, "admitted")
+            self._stats["wait_ms_total"] += waited
+            self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], waited)
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def slot(self, priority=PRIORITY_CHAT):
+        return _Slot(self, priority)
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s["in_flight"] = self._in_flight
+            s["queued"] = len(self._waiting)
+            s["tokens"] = round(self._tokens, 2)
+            s["by_priority"] = {str(k): dict(v) for k, v in self._by_priority.items()}
+        s["wait_ms_avg"] = round(s["wait_ms_total"] / s["admitted"], 2) if s["admitted"] else 0.0
+        s["wait_ms_total"] = round(s["wait_ms_total"], 1)
+        s["wait_ms_max"] = round(s["wait_ms_max"], 1)
+        s["limits"] = {"rate": self.rate, "burst": self.burst, "max_in_flight": self.max_in_flight,
+                       "max_queue": self.max_queue, "max_wait_s": self.max_wait}
+        return s
+
+
+class _Slot:
+    def __init__(self, limiter, priority):
+        self.limiter = limiter
+        self.priority = priority
+
+    def __enter__(self):
+        self.limiter.acquire(self.priority)
+        return self
+
+    def __exit__(self, *exc):
+        self.limiter.release()
+        return False
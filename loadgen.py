@@ -0,0 +1,312 @@
+# loadgen.py — 署名付き Webhook の負荷試験（ローカル代替の Supabase / LINE / OpenAI を使う）
+# 使い方: python loadgen.py --rate 50 --duration 20 --users 2000
+#         python loadgen.py --url http://localhost:5000 --secret $LINE_CHANNEL_SECRET --token $NOTIFY_SECRET
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import fake_backends
+
+# 種類ごとの発生比率（学期中の実トラフィックの目安）
+EVENT_MIX = {"text": 70, "postback": 15, "follow": 10, "file": 5}
+TEXT_SAMPLES = [
+    "時間割", "授業登録", "課題登録", "アドバイス", "成績確認", "事務室 経営", "年間予定",
+    "マーケティング論 シラバス", "簿記原理", "出席ランキング", "通知オン", "来週の予定",
+    "レポートの書き方を教えて", "図書館の開館時間は？", "おはよう",
+]
+SUBJECTS = ["マーケティング論", "簿記原理", "経営戦略論", "統計学", "英語（初級）", "組織論"]
+NOTIFY_ENDPOINTS = ["/notify", "/assignment_notify", "/class_notify", "/risk_notify"]
+
+
+def sign(body, secret):
+    """X-Line-Signature（channel secret をキーにした HMAC-SHA256 の base64）"""
+    digest = hmac.new(secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def _user_id(i):
+    return f"U{i:032d}"
+
+
+def _base_event(kind, uid):
+    ev = {
+        "type": kind,
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": uid},
+        "webhookEventId": uuid.uuid4().hex.upper()[:26],
+        "deliveryContext": {"isRedelivery": False},
+    }
+    if kind != "unfollow":
+        ev["replyToken"] = uuid.uuid4().hex
+    return ev
+
+
+def build_event(kind, uid, rnd):
+    if kind == "text":
+        ev = _base_event("message", uid)
+        ev["message"] = {"type": "text", "id": str(rnd.randrange(10 ** 17, 10 ** 18)), "quoteToken": uuid.uuid4().hex,
+                         "text": rnd.choice(TEXT_SAMPLES)}
+    elif kind == "postback":
+        ev = _base_event("postback", uid)
+        status = rnd.choice(["present", "present", "present", "late", "absent"])
+        ev["postback"] = {"data": f"attend:{rnd.choice(SUBJECTS)}:{status}"}
+    elif kind == "file":
+        ev = _base_event("message", uid)
+        ev["message"] = {"type": "file", "id": str(rnd.randrange(10 ** 17, 10 ** 18)), "fileName": "成績.pdf", "fileSize": 120000}
+    else:
+        ev = _base_event("follow", uid)
+        ev["follow"] = {"isUnblocked": False}
+    return ev
+
+
+def build_batch(kind, users, rnd, max_batch=3):
+    """同じ種類のイベント 1〜max_batch 件を1つの Webhook 本文にまとめる"""
+    events = [build_event(kind, _user_id(rnd.randrange(users)), rnd) for _ in range(rnd.randint(1, max_batch))]
+    return json.dumps({"destination": "U" + "0" * 32, "events": events}, ensure_ascii=False)
+
+
+def seed_tables(users, rnd):
+    """ローカル代替の Supabase に入れる初期データ"""
+    today = date.today()
+    tables = {
+        "subscribers": [], "users": [], "user_classes": [], "grades_text": [], "assignments": [],
+        "attendance_counters": [], "academic_calendar": [], "syllabus": [], "curriculum_docs": [], "inquiry_contacts": [],
+    }
+    for i in range(users):
+        uid = _user_id(i)
+        tables["subscribers"].append({"user_id": uid, "opt_in": rnd.random() < 0.8})
+        tables["users"].append({"line_user_id": uid, "faculty": "経営学部", "department": "経営学科"})
+        for subject in rnd.sample(SUBJECTS, 3):
+            tables["user_classes"].append({"user_id": uid, "subject": subject,
+                                           "day_of_week": rnd.choice("月火水木金"), "period": rnd.randint(1, 5)})
+            tables["attendance_counters"].append({"user_id": uid, "subject": subject, "present": rnd.randint(0, 10),
+                                                  "late": rnd.randint(0, 2), "absent": rnd.randint(0, 3)})
+        if rnd.random() < 0.5:
+            grades = [{"category": "学部必修科目区分", "earned": rnd.randint(0, 12), "required": 12},
+                      {"category": "教養科目区分", "earned": rnd.randint(0, 30), "required": 24}]
+            tables["grades_text"].append({"user_id": uid, "content": "取得済み単位数: 60", "raw_data": grades,
+                                          "created_at": today.isoformat()})
+        if rnd.random() < 0.3:
+            due = today + timedelta(days=rnd.randint(-2, 7))
+            tables["assignments"].append({"user_id": uid, "title": "レポート", "due_date": due.isoformat()})
+    for d in range(-30, 60, 3):
+        tables["academic_calendar"].append({"date": (today + timedelta(days=d)).isoformat(), "title": "授業日",
+                                            "category": "授業", "time": "", "note": ""})
+    for i in range(2000):
+        tables["syllabus"].append({"subject_teacher": f"{rnd.choice(SUBJECTS)} 教員{i % 50}", "units": "2",
+                                   "grade_year": "1", "semester": "春", "campus": "和泉",
+                                   "evaluation": "試験", "category": "専門"})
+    for cat, req in [("学部必修科目区分", 12), ("教養科目区分", 24), ("外国語科目区分", 16)]:
+        tables["curriculum_docs"].append({"faculty": "経営学部", "department": "経営学科",
+                                          "category_group": "A", "category": cat, "required_units": req})
+    tables["inquiry_contacts"].append({"department": "経営学部事務室", "target": "学部生", "phone": "03-0000-0000"})
+    return tables
+
+
+class InProcessTarget:
+    """app.py を同じプロセスに読み込み、Supabase / LINE / OpenAI をローカル代替に差し替えて叩く"""
+
+    def __init__(self, args):
+        import bench
+        os.environ.setdefault("WEBHOOK_ASYNC", "1" if args.async_webhook else "0")
+        os.environ.setdefault("CHAT_CACHE", "0")
+        rnd = random.Random(args.seed)
+        self.db = fake_backends.FakeSupabase(seed_tables(args.users, rnd), latency=args.supabase_latency,
+                                             jitter=args.supabase_latency, error_rate=args.error_rate, seed=args.seed)
+        self.line = fake_backends.FakeLineBotApi(latency=args.line_latency, jitter=args.line_latency,
+                                                 error_rate=args.error_rate, seed=args.seed,
+                                                 content=self._pdf_content(args, bench))
+        self.llm = fake_backends.FakeOpenAI(reply="履修計画についてのアドバイスです。" * 5,
+                                            first_token_latency=args.openai_latency, per_input_token=0.0002,
+                                            per_chunk=0.002, jitter=args.openai_latency,
+                                            error_rate=args.error_rate, seed=args.seed)
+        self.app = bench.load_app(self.db, self.line)
+        self.app.client = self.llm
+        self.secret = self.app.LINE_CHANNEL_SECRET
+        self.token = self.app.NOTIFY_SECRET or ""
+
+    @staticmethod
+    def _pdf_content(args, bench):
+        """ファイルイベントで返す PDF（--pdf が無ければ --pdf-pages ページの成績通知書を作る）"""
+        if args.pdf:
+            with open(args.pdf, "rb") as f:
+                return f.read()
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        try:
+            bench.write_transcript_pdf(path, pages=args.pdf_pages, seed=args.seed)
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+    def post_webhook(self, body, signature):
+        res = self.app.app.test_client().post(
+            "/callback", data=body.encode("utf-8"),
+            headers={"X-Line-Signature": signature, "Content-Type": "application/json"},
+        )
+        return res.status_code
+
+    def get(self, path):
+        return self.app.app.test_client().get(path, query_string={"token": self.token}).status_code
+
+    def drain(self, timeout=60):
+        """非同期モードならワーカーが処理し終えるのを待つ"""
+        deadline = time.monotonic() + timeout
+        while self.app.webhook_pool.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def backend_stats(self):
+        return {
+            "supabase": {"round_trips": self.db.round_trips, "errors": self.db.errors},
+            "line": dict(self.line.calls, errors=self.line.errors),
+            "openai": {"calls": self.llm.calls, "errors": self.llm.errors, "input_tokens": self.llm.input_tokens},
+            # 解析に失敗しても Webhook は 200 を返すので、保存された本文で数える
+            "pdf_parse_failed": sum(1 for r in self.db.tables.get("grades_text", [])
+                                    if str(r.get("content") or "").startswith("❌ PDFの解析に失敗")),
+            "webhook_queue": self.app.webhook_pool.stats(),
+        }
+
+
+class HttpTarget:
+    """起動済みのサーバー（ステージングなど）に HTTP で送る"""
+
+    def __init__(self, args):
+        self.url = args.url.rstrip("/")
+        self.secret = args.secret
+        self.token = args.token or ""
+
+    def _send(self, req):
+        try:
+            with urllib.request.urlopen(req, timeout=30) as res:
+                res.read()
+                return res.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def post_webhook(self, body, signature):
+        req = urllib.request.Request(self.url + "/callback", data=body.encode("utf-8"), method="POST",
+                                     headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+        return self._send(req)
+
+    def get(self, path):
+        return self._send(urllib.request.Request(f"{self.url}{path}?token={self.token}"))
+
+    def drain(self, timeout=60):
+        pass
+
+    def backend_stats(self):
+        return {}
+
+
+def _percentile(values, q):
+    i = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[i]
+
+
+def report(samples, elapsed):
+    print(f"{'type':26s} {'count':>6s} {'errors':>6s} {'rps':>7s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s}")
+    for kind in sorted(samples):
+        rows = samples[kind]
+        lat = sorted(ms for ms, _ in rows)
+        errors = sum(1 for _, status in rows if status != 200)
+        print(f"{kind:26s} {len(rows):6d} {errors:6d} {len(rows) / elapsed:7.1f}"
+              f" {_percentile(lat, 0.5):8.1f} {_percentile(lat, 0.95):8.1f} {_percentile(lat, 0.99):8.1f}")
+    total = sum(len(v) for v in samples.values())
+    print(f"total requests={total} elapsed={elapsed:.1f}s throughput={total / elapsed:.1f} req/s")
+
+
+def run(target, args):
+    rnd = random.Random(args.seed)
+    kinds = list(EVENT_MIX)
+    weights = [EVENT_MIX[k] for k in kinds]
+    samples = {}
+    lock = threading.Lock()
+
+    def record(kind, fn):
+        start = time.perf_counter()
+        try:
+            status = fn()
+        except Exception as e:
+            print("request error:", e)
+            status = -1
+        ms = (time.perf_counter() - start) * 1000
+        with lock:
+            samples.setdefault(kind, []).append((ms, status))
+
+    # 送信スケジュール（開ループ: 前の応答を待たずに rate 件/秒で送る）
+    schedule = []
+    n = int(args.rate * args.duration)
+    for i in range(n):
+        kind = rnd.choices(kinds, weights)[0]
+        body = build_batch(kind, args.users, rnd, args.max_batch)
+        schedule.append((i / args.rate, "webhook:" + kind, body))
+    if args.notify_interval > 0:
+        t, j = 0.0, 0
+        while t < args.duration:
+            schedule.append((t, "notify:" + NOTIFY_ENDPOINTS[j % len(NOTIFY_ENDPOINTS)], None))
+            t += args.notify_interval
+            j += 1
+    schedule.sort(key=lambda x: x[0])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for at, kind, body in schedule:
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if body is not None:
+                signature = sign(body, target.secret)
+                pool.submit(record, kind, lambda b=body, s=signature: target.post_webhook(b, s))
+            else:
+                path = kind.split(":", 1)[1]
+                pool.submit(record, kind, lambda p=path: target.get(p))
+    sent_elapsed = time.perf_counter() - start
+    target.drain()
+    drained_elapsed = time.perf_counter() - start
+
+    print(f"target rate={args.rate}/s duration={args.duration}s users={args.users} error_rate={args.error_rate}")
+    report(samples, sent_elapsed)
+    if drained_elapsed - sent_elapsed > 0.05:
+        print(f"async queue drained {drained_elapsed - sent_elapsed:.1f}s after the last request")
+    stats = target.backend_stats()
+    if stats:
+        print("backends:", json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=20, help="Webhook 送信数/秒")
+    parser.add_argument("--duration", type=float, default=10, help="秒")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--max-batch", type=int, default=3, help="1 Webhook あたりの最大イベント数")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時に送るリクエスト数の上限")
+    parser.add_argument("--notify-interval", type=float, default=5, help="通知エンドポイントを叩く間隔（秒、0 で無効）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="起動済みサーバーの URL（省略時はローカル代替で app を同じプロセスに読み込む）")
+    parser.add_argument("--secret", default=os.getenv("LINE_CHANNEL_SECRET", ""), help="--url 使用時の channel secret")
+    parser.add_argument("--token", default=os.getenv("NOTIFY_SECRET", ""), help="通知エンドポイントのトークン")
+    # ローカル代替の設定
+    parser.add_argument("--async-webhook", action="store_true", help="WEBHOOK_ASYNC=1 で読み込む")
+    parser.add_argument("--supabase-latency", type=float, default=0.005)
+    parser.add_argument("--line-latency", type=float, default=0.01)
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="各ローカル代替の失敗確率")
+    parser.add_argument("--pdf", help="ファイルイベントで返す成績 PDF（省略時は成績通知書を生成する）")
+    parser.add_argument("--pdf-pages", type=int, default=4, help="生成する成績通知書のページ数")
+    args = parser.parse_args()
+    target = HttpTarget(args) if args.url else InProcessTarget(args)
+    run(target, args)
@@ -0,0 +1,28 @@
+# local_sqlite.py — ローカル SQLite ファイルへのスレッドごとの接続（fork 後は作り直す）
+import os
+import sqlite3
+import threading
+
+
+class LocalConnection:
+    """
+    スレッドごとに1本の接続を持ち、呼ぶたびにそれを返す（autocommit・WAL）。
+    gunicorn の fork 後の子プロセスでは親の接続を使わずに開き直す。
+
+        conn = LocalConnection("cache.sqlite3")
+        conn().execute("SELECT 1")
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __call__(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
@@ -0,0 +1,6 @@
+# log_util.py — 共通のデバッグ出力
+import sys
+
+
+def debug_log(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
@@ -0,0 +1,99 @@
+# lru_cache.py — 件数上限と TTL 付きの LRU キャッシュ（ヒット率・追い出し数を記録）
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        # get_or_load の読み込み中に put / invalidate されたキーの世代（読み込み中のものが無ければ空にする）
+        self._gen = {}
+        self._gen_counter = 0
+        self._epoch = 0
+        self._loading = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0, "stale_loads": 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self._stats["misses"] += 1
+                return default
+            stored_at, value = item
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def get_or_load(self, key, loader):
+        """
+        キャッシュに無ければ loader() の結果を入れて返す（None も結果としてキャッシュする）。
+        読み込みはロック外で行うので、その間に put / invalidate されたキーには結果を入れない
+        （古い値で新しい値や無効化を上書きしないように）。
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            self._loading += 1
+            token = (self._epoch, self._gen.get(key, 0))
+        try:
+            value = loader()
+            with self._lock:
+                if (self._epoch, self._gen.get(key, 0)) == token:
+                    self._store(key, value)
+                else:
+                    self._stats["stale_loads"] += 1
+        finally:
+            with self._lock:
+                self._loading -= 1
+                if not self._loading:
+                    self._gen.clear()
+        return value
+
+    def _bump(self, key):
+        if self._loading:
+            self._gen_counter += 1
+            self._gen[key] = self._gen_counter
+
+    def _store(self, key, value):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def put(self, key, value):
+        with self._lock:
+            self._bump(key)
+            self._store(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._bump(key)
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["size"] = len(self._data)
+        s["max_size"] = self.max_size
+        lookups = s["hits"] + s["misses"]
+        s["hit_rate"] = round(s["hits"] / lookups, 3) if lookups else 0.0
+        return s
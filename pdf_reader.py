@@ -1,6 +1,12 @@
 import pdfplumber
 import re
 import unicodedata
+from collections import namedtuple
+
+try:
+    import pypdfium2  # pdfplumber の依存。ページのテキストを安く下見するのに使う
+except ImportError:
+    pypdfium2 = None
 
 # 単位区分の定義
 UNIT_REQUIREMENTS = {
@@ -36,6 +42,26 @@ FREE_ELECTIVES = [
     "他学部履修科目",  # 表記ゆれ対応
 ]
 
+# 行テキストの判定に使う正規表現（1回だけコンパイル）
+NUM_RE = re.compile(r'\d+')
+TOTAL_LABEL = "合 計"
+# 表の開始（表題か、年度ヘッダー「25 24 23 22」）
+STATUS_START_RE = re.compile(r'単位修得状況|単位取得状況|25.*24.*23.*22')
+# どれかの抽出に関係する語（区分名・自由履修対象科目・外国語必修内訳・合計行）
+KEYWORD_RE = re.compile("|".join(
+    re.escape(k) for k in [*UNIT_REQUIREMENTS, *FREE_ELECTIVES, *FOREIGN_LANG_REQ, TOTAL_LABEL]
+))
+FOREIGN_NOTES_MIN_TOP = 400  # 備考欄の範囲（y=400以降）
+# ページ下見: 単位修得状況表・合計行・備考欄がありそうなページだけを pdfplumber で解析する（空白を除いたテキストに対して）
+STATUS_TITLES = ("単位修得状況", "単位取得状況")
+PROBE_RE = re.compile(r'単位修得状況|単位取得状況|合計|備考|25.*24.*23.*22')
+CROP_MARGIN = 20  # 表題の少し上から切り出す（pt）
+
+# 前処理済みの行: 先頭の top 座標・連結済みテキスト・年度（2020〜2030）を除いた整数
+# （nums は KEYWORD_RE に当たる行だけ。それ以外の行はどの抽出にも使われないので空）
+Row = namedtuple("Row", ["top", "text", "nums"])
+
+
 def normalize_num_str(s):
     """数値文字列を正規化（全角→半角、非数字削除）"""
     if not s:
@@ -218,32 +244,198 @@ def find_total_from_summary_row(rows, debug_mode=False):
     
     return None
 
+def build_row_model(rows):
+    """単語の行リストを Row のリストにする（連結と数値の抽出は1行1回だけ）"""
+    model = []
+    for row in rows:
+        if not row:
+            continue
+        text = " ".join([w['text'] for w in row])
+        if KEYWORD_RE.search(text):
+            nums = [n for n in map(int, NUM_RE.findall(text)) if not (2020 <= n <= 2030)]
+        else:
+            nums = []
+        model.append(Row(row[0]['top'], text, nums))
+    return model
+
+
+def find_status_table_bounds_model(model):
+    """find_status_table_bounds の Row 版"""
+    start_y = None
+    end_y = None
+    for r in model:
+        if start_y is None and STATUS_START_RE.search(r.text):
+            start_y = r.top
+            continue
+        if TOTAL_LABEL in r.text and "124" in r.text:
+            end_y = r.top
+            break
+    return start_y, end_y
+
+
+def extract_all(model, bounds, debug_mode=False):
+    """
+    Row のリストを1回走査して、区分ごとの単位・自由履修対象科目の合計・外国語必修内訳・合計行の総取得単位を同時に取り出す。
+    （extract_from_status_table / extract_free_electives / extract_foreign_details / find_total_from_summary_row と同じ結果）
+    戻り値: (results, free_total, foreign_detail, total_from_summary)
+    """
+    start_y, end_y = bounds
+    bounded = bool(start_y and end_y)
+    results = {}
+    free_total = 0
+    foreign_detail = {}
+    total_from_summary = None
+
+    for r in model:
+        # 年度以外の数値が無い行はどの抽出にも使われない
+        if not r.nums:
+            continue
+        text = r.text
+        in_table = start_y <= r.top <= end_y if bounded else True
+
+        # 各区分名を含む行（最後の数値を取得単位とする）
+        if in_table:
+            for category, required in UNIT_REQUIREMENTS.items():
+                if category in text and category not in results:
+                    results[category] = (r.nums[-1], required)
+                    if debug_mode:
+                        print(f"区分発見: {category} = {r.nums[-1]}/{required} (y={r.top:.1f})")
+                    break
+
+        # 自由履修対象科目（科目名直後の最初の数値）
+        if bounded and in_table:
+            for free_cat in FREE_ELECTIVES:
+                cat_index = text.find(free_cat)
+                if cat_index == -1:
+                    continue
+                m = NUM_RE.search(text, cat_index + len(free_cat))
+                if m:
+                    value = int(m.group())
+                    if 0 < value <= 20:  # 常識的な単位数の範囲
+                        free_total += value
+                        if debug_mode:
+                            print(f"自由履修科目発見: {free_cat} = {value} (y={r.top:.1f})")
+                        break
+
+        # 備考欄の外国語必修内訳
+        if r.top > FOREIGN_NOTES_MIN_TOP and len(r.nums) >= 2:
+            for detail_cat, req in FOREIGN_LANG_REQ.items():
+                if detail_cat in text and detail_cat not in foreign_detail:
+                    foreign_detail[detail_cat] = (r.nums[-1], req)
+                    if debug_mode:
+                        print(f"必修内訳発見: {detail_cat} = {r.nums[-1]}/{req} (y={r.top:.1f})")
+
+        # 合計行（124, 年度別数値..., 総合計）
+        if total_from_summary is None and len(r.nums) >= 5 and TOTAL_LABEL in text and "124" in text:
+            total_from_summary = r.nums[-1]
+            if debug_mode:
+                print(f"合計行から総取得単位を検出: {total_from_summary}")
+
+    return results, free_total, foreign_detail, total_from_summary
+
+
+def probe_page(doc, index):
+    """
+    pdfium でページのテキストだけを取り出して下見する。
+    関係なさそうなページなら None、関係がありそうなら切り出し開始位置（top、表題が無ければ 0）を返す。
+    """
+    page = doc[index]
+    textpage = page.get_textpage()
+    try:
+        text = textpage.get_text_range().replace(" ", "").replace("\u3000", "")
+        if not PROBE_RE.search(text):
+            return None
+        for title in STATUS_TITLES:
+            searcher = textpage.search(title)
+            hit = searcher.get_next()
+            if hit:
+                _, _, _, char_top = textpage.get_charbox(hit[0])
+                return max(0.0, page.get_height() - char_top - CROP_MARGIN)
+        return 0.0
+    finally:
+        textpage.close()
+        page.close()
+
+
+def _update_targets(model, found):
+    """
+    model の行から合計行と外国語必修内訳（備考欄）を探して found に記録し、すべて揃ったかを返す。
+    found = {"total": bool, "foreign": set}。ページごとに新しい行だけを渡せばよい。
+    """
+    for r in model:
+        if not r.nums:
+            continue
+        if TOTAL_LABEL in r.text and "124" in r.text and len(r.nums) >= 5:
+            found["total"] = True
+        if r.top > FOREIGN_NOTES_MIN_TOP and len(r.nums) >= 2:
+            found["foreign"].update(c for c in FOREIGN_LANG_REQ if c in r.text)
+    return found["total"] and len(found["foreign"]) == len(FOREIGN_LANG_REQ)
+
+
+def collect_rows_all_pages(pdf, debug_mode=False):
+    """全ページの行を収集（下見できない場合の従来の方法）"""
+    all_rows = []
+    for page_num, page in enumerate(pdf.pages):
+        if debug_mode:
+            print(f"\n=== ページ {page_num + 1} 解析開始 ===")
+        all_rows.extend(extract_rows_from_page(page))
+        page.close()
+    return all_rows
+
+
+def collect_rows_targeted(pdf, pdf_path, debug_mode=False):
+    """
+    下見で当たったページ（の表題から下）だけ単語を抽出し、合計行と備考欄が揃ったら残りのページは読まない。
+    解析したページはすぐ close してキャッシュを解放する。下見できなければ None。
+    """
+    if pypdfium2 is None:
+        return None
+    try:
+        doc = pypdfium2.PdfDocument(pdf_path)
+    except Exception as e:
+        if debug_mode:
+            print(f"下見できません: {e}")
+        return None
+    all_rows = []
+    found = {"total": False, "foreign": set()}
+    try:
+        for page_num in range(len(doc)):
+            crop_top = probe_page(doc, page_num)
+            if crop_top is None:
+                continue
+            if debug_mode:
+                print(f"\n=== ページ {page_num + 1} 解析開始 (top>={crop_top:.1f}) ===")
+            page = pdf.pages[page_num]
+            try:
+                region = page.crop((0, crop_top, page.width, page.height)) if crop_top else page
+                rows = extract_rows_from_page(region)
+            finally:
+                page.close()
+            all_rows.extend(rows)
+            # 見つかった項目は found に残るので、判定はこのページの行だけで足りる
+            if _update_targets(build_row_model(rows), found):
+                break
+    finally:
+        doc.close()
+    return all_rows
+
+
 def parse_units_advanced(pdf_path):
     """改良版のPDF解析"""
     debug_mode = False  # 本番環境用：デバッグ出力OFF
     
     with pdfplumber.open(pdf_path) as pdf:
-        all_rows = []
+        # 表のあるページだけ解析し、見つからなければ全ページを解析
+        all_rows = collect_rows_targeted(pdf, pdf_path, debug_mode)
+        if not all_rows:
+            all_rows = collect_rows_all_pages(pdf, debug_mode)
         
-        # 全ページの行を収集
-        for page_num, page in enumerate(pdf.pages):
-            if debug_mode:
-                print(f"\n=== ページ {page_num + 1} 解析開始 ===")
-            
-            rows = extract_rows_from_page(page)
-            all_rows.extend(rows)
-        
-        # 合計行から直接総取得単位数を抽出
-        total_from_summary = find_total_from_summary_row(all_rows, debug_mode)
-        
-        # 各区分の単位数を抽出
-        results = extract_from_status_table(all_rows, debug_mode)
-        
-        # 自由履修対象科目を抽出
-        free_elective_total = extract_free_electives(all_rows, debug_mode)
-        
-        # 外国語必修内訳を抽出
-        foreign_detail = extract_foreign_details(all_rows, debug_mode)
+        # 行を1回だけ前処理し、表の範囲を求めてから全項目を1パスで抽出
+        model = build_row_model(all_rows)
+        bounds = find_status_table_bounds_model(model)
+        if debug_mode:
+            print(f"ステータス表範囲: y={bounds[0]} から y={bounds[1]}")
+        results, free_elective_total, foreign_detail, total_from_summary = extract_all(model, bounds, debug_mode)
         
         # 余剰単位を計算
         surplus_total = 0
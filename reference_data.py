@@ -0,0 +1,103 @@
+# reference_data.py — 年に数回しか変わらない参照テーブル（履修要件・事務室連絡先）のスナップショット
+import threading
+import time
+
+
+class ReferenceSnapshot:
+    """
+    curriculum_docs と inquiry_contacts をまとめて読み込み、
+    (faculty, department) と学部キーワードで引けるようにしたスナップショット。
+    読み込むたびに version を1つ進める。max_age 秒を超えたら stale とみなし、次の参照時に読み直す。
+    shared_version()（refresh_stamp.RefreshStamp.version など）の値が変わったときも stale とみなす。
+    loaders: {"curriculum_docs": fn, "inquiry_contacts": fn}
+    dept_keywords: 事前に索引を作っておく学部キーワード（例: ["経営", "商学", "法学"]）
+    """
+
+    def __init__(self, loaders, max_age=24 * 3600, dept_keywords=(), shared_version=None):
+        self.loaders = loaders
+        self.max_age = max_age
+        self.shared_version = shared_version
+        self._built_shared_version = None
+        self.dept_keywords = list(dept_keywords)
+        self.version = 0
+        self._data = None
+        self._loaded_at = 0.0
+        self._loaded_wall = None
+        self._lock = threading.Lock()
+        self._stats = {"loads": 0, "lookups": 0, "last_load_ms": 0.0}
+
+    def _build(self):
+        start = time.perf_counter()
+        built_shared_version = self.shared_version() if self.shared_version else None
+        curriculum = list(self.loaders["curriculum_docs"]())
+        contacts = list(self.loaders["inquiry_contacts"]())
+
+        by_dept = {}
+        for r in curriculum:
+            by_dept.setdefault((r.get("faculty"), r.get("department")), []).append(r)
+        for rows in by_dept.values():
+            rows.sort(key=lambda r: r.get("category_group") or "")
+
+        contacts_by_keyword = {
+            k: [r for r in contacts if k in (r.get("department") or "")] for k in self.dept_keywords
+        }
+
+        self._data = {
+            "curriculum_by_dept": by_dept,
+            "contacts": contacts,
+            "contacts_by_keyword": contacts_by_keyword,
+            "counts": {"curriculum_docs": len(curriculum), "inquiry_contacts": len(contacts)},
+        }
+        self.version += 1
+        self._built_shared_version = built_shared_version
+        self._loaded_at = time.monotonic()
+        self._loaded_wall = time.time()
+        self._stats["loads"] += 1
+        self._stats["last_load_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    def is_stale(self):
+        return (
+            self._data is None
+            or time.monotonic() - self._loaded_at > self.max_age
+            or (self.shared_version is not None and self.shared_version() != self._built_shared_version)
+        )
+
+    def _current(self):
+        with self._lock:
+            if self.is_stale():
+                self._build()
+            self._stats["lookups"] += 1
+            return self._data
+
+    def curriculum(self, faculty, department):
+        """履修要件（category_group 昇順）"""
+        return list(self._current()["curriculum_by_dept"].get((faculty, department), ()))
+
+    def contacts(self, dept_keyword=None, limit=50):
+        """事務室連絡先。dept_keyword があれば department に含むものだけ"""
+        data = self._current()
+        if not dept_keyword:
+            return data["contacts"][:limit]
+        rows = data["contacts_by_keyword"].get(dept_keyword)
+        if rows is None:
+            rows = [r for r in data["contacts"] if dept_keyword in (r.get("department") or "")]
+        return rows[:limit]
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+
+    def refresh(self):
+        with self._lock:
+            self._build()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["version"] = self.version
+            s["loaded"] = self._data is not None
+            s["stale"] = self.is_stale()
+            s["age_s"] = round(time.monotonic() - self._loaded_at, 1) if self._data is not None else None
+            s["loaded_at"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self._loaded_wall)) if self._loaded_wall else None
+            s["counts"] = self._data["counts"] if self._data is not None else {}
+        return s
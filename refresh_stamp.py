@@ -0,0 +1,46 @@
+# refresh_stamp.py — メモリ上の索引・キャッシュを gunicorn ワーカー間で作り直させるための版数ファイル
+import os
+import threading
+import time
+
+
+class RefreshStamp:
+    """
+    ローカルファイル（path）の更新時刻を版数として使う。
+    bump() でファイルを書き換えると、同じホストの全ワーカーで version() の値が変わる。
+    version() は stat を最大 check_interval 秒に1回だけ行う（参照のたびにファイルを見ない）。
+
+        stamp = RefreshStamp("/tmp/syllabus.stamp")
+        index = SyllabusIndex(loader, version=stamp.version)
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._value = None
+        self._checked_at = 0.0
+
+    def _read(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        return (st.st_mtime_ns, st.st_size)
+
+    def version(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._value is None or now - self._checked_at >= self.check_interval:
+                self._value = self._read()
+                self._checked_at = now
+            return self._value
+
+    def bump(self):
+        """版数を進める（このワーカーでは次の version() から新しい値になる）"""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(str(time.time_ns()))
+        os.replace(tmp, self.path)
+        with self._lock:
+            self._value = None
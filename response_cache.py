@@ -0,0 +1,133 @@
+# response_cache.py — 雑談（フォールバック）応答の SQLite キャッシュ
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+
+import local_sqlite
+
+# 個人情報を含みそうな入力はキャッシュしない（他の学生に同じ応答を返さないため）
+PERSONAL_DATA_PATTERNS = [
+    re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"),               # メールアドレス
+    re.compile(r"0\d{1,4}-?\d{1,4}-?\d{3,4}"),             # 電話番号
+    re.compile(r"\d{6,}"),                                 # 学籍番号など長い数字列
+    re.compile(r"(私|わたし|僕|ぼく|俺|自分)(の|は|が)"),      # 自分自身についての相談
+    re.compile(r"(名前|住所|学籍番号|生年月日|パスワード)"),
+]
+
+_TRAILING_RE = re.compile(r"[\s?？!！。.、,…〜~]+$")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(text):
+    """NFKC・小文字化・空白の圧縮・末尾の記号除去（「履修登録はいつ？」と「履修登録はいつ」を同一視）"""
+    s = unicodedata.normalize("NFKC", str(text or "")).lower().strip()
+    s = _SPACE_RE.sub(" ", s)
+    return _TRAILING_RE.sub("", s)
+
+
+def contains_personal_data(text):
+    s = unicodedata.normalize("NFKC", str(text or ""))
+    return any(p.search(s) for p in PERSONAL_DATA_PATTERNS)
+
+
+class ResponseCache:
+    """
+    (model, system プロンプト, 正規化したユーザー入力) をキーに応答を保存する。
+    SQLite ファイルなので再起動後も残り、同一ホストの gunicorn ワーカー間で共有される。
+    ttl 秒で期限切れ、max_entries を超えたら最終利用が古いものから削除する。
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=5000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn = local_sqlite.LocalConnection(path)
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._stats = {"hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evicted": 0}
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS chat_responses ("
+            " key TEXT PRIMARY KEY, model TEXT, prompt TEXT, response TEXT NOT NULL,"
+            " created_at REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn().execute("CREATE INDEX IF NOT EXISTS idx_chat_responses_last_used ON chat_responses (last_used)")
+
+    @staticmethod
+    def make_key(model, system_prompt, user_text):
+        raw = json.dumps([model, system_prompt, normalize_prompt(user_text)], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _incr(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def get(self, model, system_prompt, user_text):
+        if contains_personal_data(user_text):
+            self._incr("bypassed")
+            return None
+        key = self.make_key(model, system_prompt, user_text)
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT response, created_at FROM chat_responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            self._incr("misses")
+            return None
+        conn.execute("UPDATE chat_responses SET hits = hits + 1, last_used = ? WHERE key = ?", (now, key))
+        self._incr("hits")
+        return row[0]
+
+    def put(self, model, system_prompt, user_text, response):
+        if response is None or contains_personal_data(user_text):
+            return
+        key = self.make_key(model, system_prompt, user_text)
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO chat_responses (key, model, prompt, response, created_at, last_used, hits)"
+            " VALUES (?, ?, ?, ?, ?, ?, 0)"
+            " ON CONFLICT(key) DO UPDATE SET response = excluded.response,"
+            " created_at = excluded.created_at, last_used = excluded.last_used",
+            (key, model, normalize_prompt(user_text), response, now, now),
+        )
+        self._incr("stores")
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % 50 == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """期限切れと上限超過分を削除する"""
+        conn = self._conn()
+        now = time.time()
+        cur = conn.execute("DELETE FROM chat_responses WHERE created_at < ?", (now - self.ttl,))
+        removed = cur.rowcount
+        cur = conn.execute(
+            "DELETE FROM chat_responses WHERE key IN ("
+            " SELECT key FROM chat_responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        removed += cur.rowcount
+        self._incr("evicted", removed)
+        return removed
+
+    def top_entries(self, limit=10):
+        """よく使われている応答（hits 降順）"""
+        rows = self._conn().execute(
+            "SELECT prompt, hits, created_at FROM chat_responses ORDER BY hits DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [{"prompt": p, "hits": h, "age_s": round(time.time() - c)} for p, h, c in rows]
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        s["entries"] = self._conn().execute("SELECT COUNT(*) FROM chat_responses").fetchone()[0]
+        lookups = s["hits"] + s["misses"]
+        s["hit_rate"] = round(s["hits"] / lookups, 3) if lookups else 0.0
+        s["top"] = self.top_entries(5)
+        return s
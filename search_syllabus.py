@@ -1,5 +1,6 @@
 from supabase import create_client
 import os
+from syllabus_index import SyllabusIndex
 
 # Supabaseの接続情報
 url = "https://zqihsfkgjaenzndopzpk.supabase.co"
@@ -7,17 +8,26 @@ key = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJpc3MiOiJzdXBhYmFzZSIsInJlZiI6Inpx
 
 supabase = create_client(url, key)
 
-def search_syllabus(keyword: str):
-    # ① 完全一致を探す
-    response = supabase.table("syllabus").select("*").eq("subject_teacher", keyword).execute()
-    data = response.data
+def load_syllabus():
+    rows = []
+    offset = 0
+    while True:
+        page = supabase.table("syllabus").select("*") \
+            .order("subject_teacher", desc=False) \
+            .order("id", desc=False) \
+            .range(offset, offset + 999).execute().data or []
+        rows.extend(page)
+        if len(page) < 1000:
+            return rows
+        offset += 1000
+
 
-    # ② 無ければ前方一致
-    if not data:
-        response = supabase.table("syllabus").select("*").ilike("subject_teacher", f"{keyword}%").execute()
-        data = response.data
+index = SyllabusIndex(load_syllabus)
 
-    return data
+
+def search_syllabus(keyword: str):
+    # 表記ゆれ（全角/半角・カナ/かな）を吸収した n-gram 索引で検索（完全一致が先頭）
+    return index.search(keyword, k=10)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+# state_store.py — 会話フロー（プロフィール登録・授業登録・課題登録・SPI）の状態保存
+# 1フロー1ユーザー1レコード {"step": int, "data": dict}。ttl 秒操作が無ければ破棄する。
+# advance / finish は「今の step が期待どおりなら」だけ成功する（複数ワーカーでの二重処理防止）。
+import json
+import threading
+import time
+
+import local_sqlite
+
+
+class MemoryStateStore:
+    """プロセス内 dict（ワーカー1つのとき用）"""
+
+    def __init__(self, ttl=1800):
+        self.ttl = ttl
+        self._data = {}  # user_id -> {flow: (step, data, updated_at)}
+        self._lock = threading.Lock()
+        self._ops = 0
+
+    def _alive(self, rec, now):
+        return rec is not None and now - rec[2] <= self.ttl
+
+    def _rec(self, flow, user_id):
+        return self._data.get(user_id, {}).get(flow)
+
+    def _drop(self, flow, user_id):
+        flows = self._data.get(user_id)
+        if flows is not None:
+            flows.pop(flow, None)
+            if not flows:
+                del self._data[user_id]
+
+    def get_all(self, user_id):
+        """{flow: {"step", "data"}}（有効なものだけ）"""
+        now = time.time()
+        with self._lock:
+            return {
+                flow: {"step": rec[0], "data": dict(rec[1])}
+                for flow, rec in self._data.get(user_id, {}).items()
+                if self._alive(rec, now)
+            }
+
+    def get(self, flow, user_id):
+        return self.get_all(user_id).get(flow)
+
+    def start(self, flow, user_id, data=None):
+        with self._lock:
+            self._data.setdefault(user_id, {})[flow] = (1, dict(data or {}), time.time())
+            self._maybe_purge()
+
+    def advance(self, flow, user_id, from_step, to_step, data):
+        now = time.time()
+        with self._lock:
+            rec = self._rec(flow, user_id)
+            if not self._alive(rec, now) or rec[0] != from_step:
+                return False
+            self._data[user_id][flow] = (to_step, dict(data), now)
+            return True
+
+    def finish(self, flow, user_id, from_step=None):
+        now = time.time()
+        with self._lock:
+            rec = self._rec(flow, user_id)
+            if not self._alive(rec, now) or (from_step is not None and rec[0] != from_step):
+                return False
+            self._drop(flow, user_id)
+            return True
+
+    def _maybe_purge(self):
+        self._ops += 1
+        if self._ops % 200:
+            return
+        now = time.time()
+        for user_id, flows in list(self._data.items()):
+            for flow in [f for f, rec in flows.items() if not self._alive(rec, now)]:
+                self._drop(flow, user_id)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            by_flow = {}
+            for flows in self._data.values():
+                for flow, rec in flows.items():
+                    if self._alive(rec, now):
+                        by_flow[flow] = by_flow.get(flow, 0) + 1
+        return {"backend": "memory", "active": by_flow, "ttl_s": self.ttl}
+
+
+class SQLiteStateStore:
+    """ローカル SQLite ファイル（同一ホストの gunicorn ワーカー間で共有）"""
+
+    def __init__(self, path, ttl=1800):
+        self.path = path
+        self.ttl = ttl
+        self._conn = local_sqlite.LocalConnection(path)
+        self._ops = 0
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS flow_states ("
+            " flow TEXT NOT NULL, user_id TEXT NOT NULL, step INTEGER NOT NULL,"
+            " data TEXT NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (flow, user_id))"
+        )
+        self._conn().execute("CREATE INDEX IF NOT EXISTS idx_flow_states_user ON flow_states (user_id)")
+
+    @staticmethod
+    def _dump(data):
+        return json.dumps(data or {}, ensure_ascii=False, separators=(",", ":"))
+
+    def get_all(self, user_id):
+        rows = self._conn().execute(
+            "SELECT flow, step, data FROM flow_states WHERE user_id = ? AND updated_at >= ?",
+            (user_id, time.time() - self.ttl),
+        ).fetchall()
+        return {flow: {"step": step, "data": json.loads(data)} for flow, step, data in rows}
+
+    def get(self, flow, user_id):
+        return self.get_all(user_id).get(flow)
+
+    def start(self, flow, user_id, data=None):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO flow_states (flow, user_id, step, data, updated_at) VALUES (?, ?, 1, ?, ?)",
+            (flow, user_id, self._dump(data), time.time()),
+        )
+        self._maybe_purge()
+
+    def advance(self, flow, user_id, from_step, to_step, data):
+        now = time.time()
+        cur = self._conn().execute(
+            "UPDATE flow_states SET step = ?, data = ?, updated_at = ?"
+            " WHERE flow = ? AND user_id = ? AND step = ? AND updated_at >= ?",
+            (to_step, self._dump(data), now, flow, user_id, from_step, now - self.ttl),
+        )
+        return cur.rowcount == 1
+
+    def finish(self, flow, user_id, from_step=None):
+        now = time.time()
+        if from_step is None:
+            cur = self._conn().execute(
+                "DELETE FROM flow_states WHERE flow = ? AND user_id = ? AND updated_at >= ?",
+                (flow, user_id, now - self.ttl),
+            )
+        else:
+            cur = self._conn().execute(
+                "DELETE FROM flow_states WHERE flow = ? AND user_id = ? AND step = ? AND updated_at >= ?",
+                (flow, user_id, from_step, now - self.ttl),
+            )
+        return cur.rowcount == 1
+
+    def _maybe_purge(self):
+        self._ops += 1
+        if self._ops % 200:
+            return
+        self._conn().execute("DELETE FROM flow_states WHERE updated_at < ?", (time.time() - self.ttl,))
+
+    def stats(self):
+        rows = self._conn().execute(
+            "SELECT flow, COUNT(*) FROM flow_states WHERE updated_at >= ? GROUP BY flow",
+            (time.time() - self.ttl,),
+        ).fetchall()
+        return {"backend": "sqlite", "active": dict(rows), "ttl_s": self.ttl}
+
+
+def create_state_store(kind="memory", path="flow_states.sqlite3", ttl=1800):
+    if kind == "sqlite":
+        return SQLiteStateStore(path, ttl=ttl)
+    return MemoryStateStore(ttl=ttl)
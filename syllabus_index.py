@@ -0,0 +1,203 @@
+# syllabus_index.py — syllabus テーブルの n-gram 転置インデックス（授業名・教員名検索）
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+_SPACE_RE = re.compile(r"[\s・、,，/／()（）「」]+")
+
+
+def normalize(text):
+    """NFKC 正規化 → 小文字化 → カタカナをひらがなに → 空白・区切り記号を除去"""
+    s = unicodedata.normalize("NFKC", str(text or "")).lower()
+    s = "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in s)
+    return _SPACE_RE.sub("", s)
+
+
+def ngrams(s, sizes=(2, 3)):
+    grams = set()
+    for n in sizes:
+        for i in range(len(s) - n + 1):
+            grams.add(s[i:i + n])
+    return grams
+
+
+class SyllabusIndex:
+    """
+    subject_teacher の正規化文字列から 2-gram / 3-gram の転置インデックスを作り、
+    1回の参照で順位付きの上位 k 件を返す。
+    loader() は syllabus の全行を返す関数。ttl 秒経過後か invalidate() 後に作り直す。
+    version()（refresh_stamp.RefreshStamp.version など）の値が変わったときも作り直す。
+    作り直しはロック外で1スレッドだけが行い、その間の検索は古い索引で答える。
+    """
+
+    def __init__(self, loader, ttl=24 * 3600, version=None, retry_backoff=5.0, max_backoff=300.0):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = version
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self._built_version = None
+        self._rows = None
+        self._texts = []
+        self._postings = {}
+        self._loaded_at = 0.0
+        self._stale = False
+        self._building = False
+        self._failures = 0
+        self._retry_at = 0.0
+        self._last_error = None
+        self._lock = threading.Lock()        # 索引の差し替え・統計用（短時間しか持たない）
+        self._build_lock = threading.Lock()  # 作り直しは1スレッドだけ
+        self._stats = {"builds": 0, "queries": 0, "last_build_ms": 0.0, "build_errors": 0}
+
+    def _needs_build(self):
+        return (
+            self._rows is None
+            or self._stale
+            or time.monotonic() - self._loaded_at > self.ttl
+            or (self.version and self.version() != self._built_version)
+        )
+
+    def _current(self):
+        return self._rows, self._texts, self._postings
+
+    def _build(self):
+        """全件を読み込んで索引を作る。読み込みはロック外で行い、完成したら差し替える。"""
+        start = time.perf_counter()
+        try:
+            built_version = self.version() if self.version else None
+            rows = list(self.loader())
+            texts = [normalize(r.get("subject_teacher")) for r in rows]
+            postings = defaultdict(list)
+            for doc_id, t in enumerate(texts):
+                for g in ngrams(t):
+                    postings[g].append(doc_id)
+        except Exception as e:
+            with self._lock:
+                # 失敗したら一定時間（失敗が続くほど長く）作り直しを試みない
+                self._failures += 1
+                delay = min(self.max_backoff, self.retry_backoff * 2 ** (self._failures - 1))
+                self._retry_at = time.monotonic() + delay
+                self._last_error = repr(e)
+                self._stats["build_errors"] += 1
+            raise
+        with self._lock:
+            self._rows = rows
+            self._texts = texts
+            self._postings = dict(postings)
+            self._built_version = built_version
+            self._loaded_at = time.monotonic()
+            self._stale = False
+            self._failures = 0
+            self._retry_at = 0.0
+            self._last_error = None
+            self._stats["builds"] += 1
+            self._stats["last_build_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    def _snapshot(self):
+        """
+        古い索引があるうちは、作り直しを1スレッドに任せて他のスレッドは古い索引で答える。
+        索引がまだ無いときだけ、最初の読み込みが終わるのを待つ。
+        読み込みに失敗した後は retry_at まで作り直さない（索引が無ければ例外で DB 検索に回す）。
+        """
+        with self._lock:
+            self._stats["queries"] += 1
+            if not self._needs_build():
+                return self._current()
+            if time.monotonic() < self._retry_at:
+                if self._rows is None:
+                    raise RuntimeError("syllabus index unavailable: %s" % self._last_error)
+                return self._current()
+            if self._rows is not None:
+                if self._building:
+                    return self._current()
+                self._building = True  # このスレッドが作り直す
+                try_build = True
+            else:
+                try_build = False
+
+        if try_build:
+            try:
+                with self._build_lock:
+                    self._build()
+            except Exception:
+                pass  # 古い索引で答え続ける（次の試行は retry_at 以降）
+            finally:
+                with self._lock:
+                    self._building = False
+            with self._lock:
+                return self._current()
+
+        # 索引がまだ無い: 1スレッドだけが読み込み、他はそれを待って結果を使う
+        with self._build_lock:
+            with self._lock:
+                if self._rows is not None and not self._needs_build():
+                    return self._current()
+                if time.monotonic() < self._retry_at and self._rows is None:
+                    raise RuntimeError("syllabus index unavailable: %s" % self._last_error)
+            self._build()
+        with self._lock:
+            return self._current()
+
+    def search(self, keyword, k=5, min_coverage=1.0):
+        """
+        クエリの n-gram を idf で重み付けして候補を採点する。
+        既定では全 n-gram を含む行だけを返す（従来の部分一致と同じ厳しさ）。
+        並び順: 完全一致 → 部分一致 → スコア → 短い名前。
+        完全一致の行は k を超えても全件返す（従来の eq 検索と同じ）。
+        """
+        rows, texts, postings = self._snapshot()
+        q = normalize(keyword)
+        if not q or not rows:
+            return []
+
+        grams = ngrams(q)
+        if not grams:
+            # 1文字クエリは n-gram が作れないので線形に部分一致
+            hits = [i for i, t in enumerate(texts) if q in t]
+            hits.sort(key=lambda i: (texts[i] != q, len(texts[i])))
+            exact = sum(1 for i in hits if texts[i] == q)
+            return [rows[i] for i in hits[:max(k, exact)]]
+
+        n_docs = len(rows)
+        weights = {}
+        for g in grams:
+            df = len(postings.get(g, ()))
+            if df == 0 and min_coverage >= 1.0:
+                return []
+            weights[g] = math.log(1 + n_docs / (1 + df))
+        total = sum(weights.values())
+
+        scores = defaultdict(float)
+        for g, w in weights.items():
+            for doc_id in postings.get(g, ()):
+                scores[doc_id] += w
+
+        candidates = [(i, sc / total) for i, sc in scores.items() if sc / total >= min_coverage - 1e-9]
+        candidates.sort(key=lambda x: (texts[x[0]] != q, q not in texts[x[0]], -x[1], len(texts[x[0]])))
+        exact = sum(1 for i, _ in candidates if texts[i] == q)
+        return [rows[i] for i, _ in candidates[:max(k, exact)]]
+
+    def invalidate(self):
+        """次の検索で作り直す。作り直しが終わるまで他のスレッドは古い索引を使う。"""
+        with self._lock:
+            self._stale = True
+
+    def refresh(self):
+        with self._build_lock:
+            self._build()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["loaded"] = self._rows is not None
+            s["rows"] = len(self._rows) if self._rows is not None else 0
+            s["grams"] = len(self._postings)
+            s["age_s"] = round(time.monotonic() - self._loaded_at, 1) if self._rows is not None else None
+            s["building"] = self._building
+            s["last_error"] = self._last_error
+            s["retry_in_s"] = round(max(0.0, self._retry_at - time.monotonic()), 1) if self._retry_at else None
+        return s
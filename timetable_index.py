@@ -0,0 +1,97 @@
+# timetable_index.py — user_classes を (曜日, 時限) で引けるようにメモリに持つ
+import sys
+import threading
+import time
+
+
+def _deep_sizeof(obj, seen=None):
+    """dict / list / tuple / str の入れ子のおおよそのメモリ使用量（バイト）"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_sizeof(x, seen) for x in obj)
+    return size
+
+
+class TimetableIndex:
+    """
+    {(day_of_week, period): [(user_id, subject), ...]} の索引。
+    loader() は user_classes の行（user_id, subject, day_of_week, period）を返す関数。
+    初回参照時と ttl 秒経過後に loader で作り直す。授業登録時は add() で差分反映する。
+    ttl は他の gunicorn ワーカーで登録された授業を取り込むまでの最大遅延になる。
+    version()（refresh_stamp.RefreshStamp.version など）の値が変わったときも作り直す。
+    """
+
+    def __init__(self, loader, ttl=300, version=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = version
+        self._built_version = None
+        self._index = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"loads": 0, "lookups": 0, "incremental_adds": 0, "last_load_ms": 0.0}
+
+    def _build(self):
+        start = time.perf_counter()
+        built_version = self.version() if self.version else None
+        index = {}
+        for r in self.loader():
+            try:
+                key = (r["day_of_week"], int(r["period"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            index.setdefault(key, []).append((r["user_id"], r["subject"]))
+        self._index = index
+        self._built_version = built_version
+        self._loaded_at = time.monotonic()
+        self._stats["loads"] += 1
+        self._stats["last_load_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    def _ensure_fresh(self):
+        if (
+            self._index is None
+            or time.monotonic() - self._loaded_at > self.ttl
+            or (self.version and self.version() != self._built_version)
+        ):
+            self._build()
+
+    def lookup(self, day_of_week, period):
+        """その曜日・時限の (user_id, subject) のリスト"""
+        with self._lock:
+            self._ensure_fresh()
+            self._stats["lookups"] += 1
+            return list(self._index.get((day_of_week, int(period)), ()))
+
+    def add(self, user_id, subject, day_of_week, period):
+        """授業登録フローから呼ぶ（未ロードなら次回ロード時に含まれるので何もしない）"""
+        with self._lock:
+            if self._index is None:
+                return
+            self._index.setdefault((day_of_week, int(period)), []).append((user_id, subject))
+            self._stats["incremental_adds"] += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+    def refresh(self):
+        with self._lock:
+            self._build()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            index = self._index
+            s["loaded"] = index is not None
+            s["age_s"] = round(time.monotonic() - self._loaded_at, 1) if index is not None else None
+            s["slots"] = len(index) if index is not None else 0
+            s["entries"] = sum(len(v) for v in index.values()) if index is not None else 0
+            s["memory_bytes"] = _deep_sizeof(index) if index is not None else 0
+        return s
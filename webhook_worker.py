@@ -0,0 +1,96 @@
+# webhook_worker.py — Webhook イベントを非同期に処理するワーカープール
+import os
+import queue
+import threading
+import time
+
+from log_util import debug_log
+
+
+class WebhookWorkerPool:
+    """
+    有界キューに積まれたイベントを固定数のスレッドで順次処理する。
+    dispatch(event) は1イベントを処理する関数（例外は内部で握りつぶす）。
+    キューが満杯の場合は put_timeout 秒だけ待ち、それでも入らなければ破棄する。
+    """
+
+    def __init__(self, dispatch, workers=4, maxsize=1000, put_timeout=0.05):
+        self.dispatch = dispatch
+        self.workers = max(1, int(workers))
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._stats = {
+            "enqueued": 0,
+            "processed": 0,
+            "failed": 0,
+            "dropped": 0,
+            "backpressure": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+
+    def start(self):
+        """ワーカースレッドを起動（fork 後のプロセスでは作り直す）"""
+        with self._lock:
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, event):
+        """イベントをキューに積む。破棄した場合は False"""
+        if self._pid != os.getpid():
+            self.start()
+        item = (time.monotonic(), event)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self._incr("backpressure")
+            try:
+                self.queue.put(item, timeout=self.put_timeout)
+            except queue.Full:
+                self._incr("dropped")
+                debug_log("webhook queue full, dropping event")
+                return False
+        self._incr("enqueued")
+        return True
+
+    def _run(self):
+        while True:
+            enqueued_at, event = self.queue.get()
+            wait_ms = (time.monotonic() - enqueued_at) * 1000
+            with self._lock:
+                self._stats["wait_ms_total"] += wait_ms
+                if wait_ms > self._stats["wait_ms_max"]:
+                    self._stats["wait_ms_max"] = wait_ms
+            try:
+                self.dispatch(event)
+                self._incr("processed")
+            except Exception as e:
+                self._incr("failed")
+                debug_log("webhook worker error:", e)
+            finally:
+                self.queue.task_done()
+
+    def _incr(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        done = s["processed"] + s["failed"]
+        s["wait_ms_avg"] = round(s["wait_ms_total"] / done, 2) if done else 0.0
+        s["wait_ms_total"] = round(s["wait_ms_total"], 2)
+        s["wait_ms_max"] = round(s["wait_ms_max"], 2)
+        s["depth"] = self.queue.qsize()
+        s["capacity"] = self.queue.maxsize
+        s["workers"] = self.workers
+        return s
@@ -0,0 +1,202 @@
+# write_buffer.py — Supabase への書き込みをまとめて後から流す（write-behind）
+import os
+import threading
+import time
+
+from log_util import debug_log
+
+
+class WriteBehindBuffer:
+    """
+    テーブルごとに行を溜め、件数（max_batch）か経過時間（flush_interval 秒）で
+    まとめて insert / upsert する。失敗したバッチは max_retries 回まで次回に再送する。
+    key 付き upsert の再送では、後から同じ key・同じ列に入った値を古い値で上書きしないよう、
+    新しい行が既に受け付けた列を落としてから書く（key 以外の列が残らなければ行ごと捨てる）。
+    execute(table, op, rows) が実際の一括書き込みを行う。
+    enabled=False の場合は add した時点で同期的に書き込む（フォールバック）。
+    """
+
+    def __init__(self, execute, max_batch=200, flush_interval=1.0, max_retries=3, enabled=True):
+        self.execute = execute
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.enabled = enabled
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = {}   # (table, op, key, columns) -> [(seq, row), ...]
+        self._retry = []     # [(table, op, key, [(seq, row), ...], attempts), ...]
+        self._seq = 0
+        self._newest = {}    # (table, key, key の値, 列) -> その列を最後に受け付けた行の seq（key 付き upsert のみ）
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._stats = {
+            "rows_added": 0,
+            "rows_written": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "retries": 0,
+            "rows_dropped": 0,
+            "rows_superseded": 0,
+            "flush_ms_last": 0.0,
+            "flush_ms_max": 0.0,
+            "flush_ms_total": 0.0,
+            "flushes": 0,
+        }
+
+    # ---- 書き込み受付 ----
+    def add(self, table, row, op="insert", key=None):
+        self.add_many(table, [row], op=op, key=key)
+
+    def add_many(self, table, rows, op="insert", key=None):
+        """
+        key を指定した upsert は同一バッチ内で key ごとに最後の行だけを残す
+        （同じ行を2回 upsert すると PostgREST がエラーになるため）。
+        列の組み合わせが違う行は別バッチにする（一括 upsert では欠けた列が NULL になるため）。
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        if not self.enabled:
+            self.execute(table, op, rows)
+            with self._cond:
+                self._stats["rows_added"] += len(rows)
+                self._stats["rows_written"] += len(rows)
+                self._stats["batches"] += 1
+            return
+        self._ensure_started()
+        with self._cond:
+            for row in rows:
+                self._seq += 1
+                if key and op == "upsert":
+                    for col in row:
+                        if col != key:
+                            self._newest[(table, key, row.get(key), col)] = self._seq
+                buf = self._pending.setdefault((table, op, key, tuple(sorted(row))), [])
+                buf.append((self._seq, row))
+                if len(buf) >= self.max_batch:
+                    self._cond.notify()
+            self._stats["rows_added"] += len(rows)
+
+    # ---- フラッシュ ----
+    def flush(self):
+        """溜まっている行をすべて書き込む"""
+        with self._flush_lock:
+            with self._cond:
+                pending, self._pending = self._pending, {}
+                retry, self._retry = self._retry, []
+                flushed_seq = self._seq
+            if not pending and not retry:
+                return
+            start = time.perf_counter()
+            batches = []
+            for table, op, key, rows, attempts in retry:
+                batches.extend(self._without_superseded(table, op, key, rows, attempts))
+            for (table, op, key, _), rows in pending.items():
+                for i in range(0, len(rows), self.max_batch):
+                    batches.append((table, op, key, rows[i:i + self.max_batch], 0))
+            for table, op, key, rows, attempts in batches:
+                self._write_batch(table, op, key, rows, attempts)
+            ms = (time.perf_counter() - start) * 1000
+            with self._cond:
+                if not self._retry:
+                    # 再送待ちが無ければ、ここまでに書いた行の記録は要らない
+                    self._newest = {k: seq for k, seq in self._newest.items() if seq > flushed_seq}
+                self._stats["flushes"] += 1
+                self._stats["flush_ms_last"] = ms
+                self._stats["flush_ms_total"] += ms
+                if ms > self._stats["flush_ms_max"]:
+                    self._stats["flush_ms_max"] = ms
+
+    def _without_superseded(self, table, op, key, rows, attempts):
+        """再送する行から、後から受け付けた行が上書き済みの列を落とし、列の組み合わせごとのバッチにし直す"""
+        if not key or op != "upsert":
+            return [(table, op, key, rows, attempts)]
+        regrouped = {}
+        with self._cond:
+            for seq, row in rows:
+                kept = {
+                    col: v for col, v in row.items()
+                    if col == key or self._newest.get((table, key, row.get(key), col), seq) <= seq
+                }
+                if len(kept) < len(row):
+                    self._stats["rows_superseded"] += 1
+                if len(kept) > 1:
+                    regrouped.setdefault(tuple(sorted(kept)), []).append((seq, kept))
+        return [(table, op, key, r, attempts) for r in regrouped.values()]
+
+    def _write_batch(self, table, op, key, entries, attempts):
+        rows = [row for _, row in entries]
+        if key:
+            dedup = {}
+            for seq, r in entries:
+                dedup[r.get(key)] = (seq, r)
+            entries = list(dedup.values())
+            rows = [row for _, row in entries]
+        try:
+            self.execute(table, op, rows)
+            with self._cond:
+                self._stats["rows_written"] += len(rows)
+                self._stats["batches"] += 1
+        except Exception as e:
+            debug_log(f"write-behind {op} {table} failed (attempt {attempts + 1}):", e)
+            with self._cond:
+                self._stats["failed_batches"] += 1
+                if attempts + 1 < self.max_retries:
+                    self._stats["retries"] += 1
+                    self._retry.append((table, op, key, entries, attempts + 1))
+                else:
+                    self._stats["rows_dropped"] += len(rows)
+
+    # ---- バックグラウンドスレッド ----
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and not self._full():
+                    self._cond.wait(timeout=self.flush_interval)
+                stopping = self._stopping
+            try:
+                self.flush()
+            except Exception as e:
+                debug_log("write-behind flush error:", e)
+            if stopping:
+                return
+
+    def _full(self):
+        return any(len(rows) >= self.max_batch for rows in self._pending.values())
+
+    def shutdown(self, timeout=10):
+        """停止時に残りを書き出す（atexit 用）"""
+        thread = self._thread
+        if thread is not None and self._pid == os.getpid() and thread.is_alive():
+            with self._cond:
+                self._stopping = True
+                self._cond.notify()
+            thread.join(timeout)
+        for _ in range(self.max_retries):
+            self.flush()
+            if not self._retry:
+                break
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s["queued_rows"] = sum(len(r) for r in self._pending.values())
+            s["retry_rows"] = sum(len(b[3]) for b in self._retry)
+        s["enabled"] = self.enabled
+        s["flush_ms_avg"] = round(s["flush_ms_total"] / s["flushes"], 2) if s["flushes"] else 0.0
+        for k in ("flush_ms_last", "flush_ms_max", "flush_ms_total"):
+            s[k] = round(s[k], 2)
+        return s